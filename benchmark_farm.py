@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""Drives simulated Flamenco Managers against a Flamenco Server.
+
+First create a farm on a throw-away database of a test server:
+
+    ./manage.py flamenco create_benchmark_farm -e owner@example.com -p 4 -m 20 -j 2
+
+Then run this script with the file written by that command:
+
+    ./benchmark_farm.py benchmark-farm.json --server http://localhost:5001 --duration 300
+
+Every simulated Manager announces itself with a startup notification, polls
+the depsgraph (incrementally, using the depsgraph cursor), "executes" the
+runnable tasks by posting task update batches, and uploads task logs when the
+server requests them. At the end the latency and throughput per endpoint are
+reported, so that different server versions can be compared.
+"""
+
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import typing
+
+import requests
+
+log = logging.getLogger('benchmark_farm')
+
+LOG_LINE = 'Fra:1 Mem:1024.00M (Peak 2048.00M) | Time:00:01.23 | Rendering 1 / 64 samples\n'
+
+
+class Stats:
+    """Thread-safe collection of request durations per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations: typing.DefaultDict[str, typing.List[float]] = \
+            collections.defaultdict(list)
+        self.errors: typing.Counter[str] = collections.Counter()
+
+    def record(self, endpoint: str, duration: float, ok: bool):
+        with self._lock:
+            self.durations[endpoint].append(duration)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def report(self, elapsed: float) -> dict:
+        report = {}
+        with self._lock:
+            for endpoint, durations in sorted(self.durations.items()):
+                durations = sorted(durations)
+                report[endpoint] = {
+                    'requests': len(durations),
+                    'errors': self.errors[endpoint],
+                    'throughput': len(durations) / elapsed,
+                    'p50_ms': percentile(durations, 50) * 1000,
+                    'p99_ms': percentile(durations, 99) * 1000,
+                    'max_ms': durations[-1] * 1000,
+                }
+        return report
+
+
+def percentile(sorted_values: typing.List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def now_iso() -> str:
+    return datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+
+
+def new_update_id() -> str:
+    """Returns a new, random ObjectId-compatible ID for a task update."""
+    return '%08x' % int(time.time()) + os.urandom(8).hex()
+
+
+class SimulatedManager(threading.Thread):
+    def __init__(self, args, manager: dict, stats: Stats, deadline: float):
+        super().__init__(name=f'manager-{manager["_id"]}', daemon=True)
+        self.args = args
+        self.manager_id = manager['_id']
+        self.stats = stats
+        self.deadline = deadline
+
+        self.session = requests.Session()
+        self.session.auth = (manager['token'], '')
+        self.base_url = f'{args.server.rstrip("/")}/api/flamenco/managers/{self.manager_id}'
+
+        self.depsgraph_cursor: typing.Optional[str] = None
+        self.tasks: typing.Dict[str, dict] = {}  # task ID to task, for unfinished tasks.
+        self.running: typing.Dict[str, int] = {}  # task ID to progress percentage.
+        self.finished: typing.Set[str] = set()
+        self.pending_updates: typing.List[dict] = []
+        self.task_logs: typing.Dict[str, typing.List[str]] = collections.defaultdict(list)
+
+    def request(self, endpoint: str, method: str, path: str, **kwargs) \
+            -> typing.Optional[requests.Response]:
+        start = time.perf_counter()
+        try:
+            resp = self.session.request(method, self.base_url + path,
+                                        timeout=self.args.timeout, **kwargs)
+        except requests.RequestException as ex:
+            self.stats.record(endpoint, time.perf_counter() - start, False)
+            log.warning('%s: %s %s failed: %s', self.name, method, path, ex)
+            return None
+        self.stats.record(endpoint, time.perf_counter() - start, resp.status_code < 400)
+        if resp.status_code >= 400:
+            log.warning('%s: %s %s returned %d: %s', self.name, method, path,
+                        resp.status_code, resp.text[:200])
+        return resp
+
+    def run(self):
+        self.request('startup', 'POST', '/startup', json={
+            'manager_url': f'http://{self.name}.benchmark.local/',
+            'variables': {},
+            'path_replacement': {},
+            'nr_of_workers': self.args.workers,
+            'worker_task_types': ['sleep', 'blender-render', 'file-management',
+                                  'exr-merge', 'video-encoding'],
+        })
+
+        next_depsgraph = next_update = time.monotonic()
+        update_interval = 1.0 / self.args.update_rate
+        while time.monotonic() < self.deadline:
+            if time.monotonic() >= next_depsgraph:
+                self.fetch_depsgraph()
+                next_depsgraph = time.monotonic() + self.args.depsgraph_interval
+            if time.monotonic() >= next_update:
+                self.work()
+                self.post_updates()
+                next_update = time.monotonic() + update_interval
+            time.sleep(max(0.0, min(next_depsgraph, next_update) - time.monotonic()))
+
+    def fetch_depsgraph(self):
+        headers = {}
+        if self.depsgraph_cursor:
+            headers['X-Flamenco-Depsgraph-Cursor'] = self.depsgraph_cursor
+
+        params = {}
+        if self.args.page_size:
+            params['page_size'] = self.args.page_size
+
+        while True:
+            resp = self.request('depsgraph', 'GET', '/depsgraph', headers=headers, params=params)
+            if resp is None or resp.status_code >= 400:
+                return
+            if resp.status_code == 200:
+                for task in resp.json()['depsgraph']:
+                    if task['_id'] not in self.finished:
+                        self.tasks[task['_id']] = task
+
+            continuation = resp.headers.get('X-Flamenco-Depsgraph-Continuation')
+            if not continuation:
+                self.depsgraph_cursor = resp.headers.get('X-Flamenco-Depsgraph-Cursor',
+                                                         self.depsgraph_cursor)
+                return
+            params['continuation'] = continuation
+
+    def is_runnable(self, task: dict) -> bool:
+        if task['status'] not in {'queued', 'claimed-by-manager', 'soft-failed'}:
+            return False
+        # Parents that are not in the depsgraph have been finished earlier.
+        return all(parent not in self.tasks or parent in self.finished
+                   for parent in task.get('parents') or ())
+
+    def work(self):
+        """Progresses the running tasks, and starts new ones on idle workers."""
+
+        for task_id, progress in list(self.running.items()):
+            progress = min(100, progress + self.args.progress_step)
+            self.running[task_id] = progress
+            line = LOG_LINE * self.args.log_lines
+            self.task_logs[task_id].append(line)
+            update = {
+                '_id': new_update_id(),
+                'task_id': task_id,
+                'received_on_manager': now_iso(),
+                'task_progress_percentage': progress,
+                'activity': f'Rendering, {progress}% done',
+                'log': line,
+            }
+            if progress >= 100:
+                update['task_status'] = 'completed'
+                del self.running[task_id]
+                self.finished.add(task_id)
+                self.tasks.pop(task_id, None)
+            self.pending_updates.append(update)
+
+        idle_workers = self.args.workers - len(self.running)
+        for task in list(self.tasks.values()):
+            if idle_workers <= 0:
+                break
+            if task['_id'] in self.running or not self.is_runnable(task):
+                continue
+            task['status'] = 'active'
+            self.running[task['_id']] = 0
+            self.pending_updates.append({
+                '_id': new_update_id(),
+                'task_id': task['_id'],
+                'received_on_manager': now_iso(),
+                'task_status': 'active',
+                'activity': 'Starting',
+                'worker': f'{self.name}-worker',
+            })
+            idle_workers -= 1
+
+    def post_updates(self):
+        while self.pending_updates:
+            batch = self.pending_updates[:self.args.batch_size]
+            resp = self.request('task-update-batch', 'POST', '/task-update-batch', json=batch)
+            if resp is None or resp.status_code >= 400:
+                return
+
+            result = resp.json()
+            handled = set(result.get('handled_update_ids') or ())
+            self.pending_updates = [update for update in self.pending_updates
+                                    if update['_id'] not in handled]
+
+            for task_id in result.get('cancel_task_ids') or ():
+                self.cancel_task(task_id)
+            # The server queues {'job': job_id, 'task': task_id} dicts.
+            for queued in result.get('upload_task_file_queue') or ():
+                self.upload_log(queued['job'], queued['task'])
+
+            if not handled:
+                # Don't keep sending the same batch when the server doesn't accept it.
+                return
+
+    def cancel_task(self, task_id: str):
+        self.running.pop(task_id, None)
+        self.tasks.pop(task_id, None)
+        self.finished.add(task_id)
+        self.pending_updates.append({
+            '_id': new_update_id(),
+            'task_id': task_id,
+            'received_on_manager': now_iso(),
+            'task_status': 'canceled',
+        })
+
+    def upload_log(self, job_id: str, task_id: str):
+        logfile = gzip.compress(''.join(self.task_logs.get(task_id, [LOG_LINE])).encode())
+        # The server finds the job via the task, so only the file name mentions it,
+        # like the log files of a real Manager.
+        self.request('attach-task-log', 'POST', f'/attach-task-log/{task_id}',
+                     files={'logfile': (f'job-{job_id}-task-{task_id}.log.gz', logfile)})
+
+
+def print_report(report: dict, elapsed: float):
+    print(f'Ran for {elapsed:.1f} seconds')
+    print(f'{"endpoint":<20} {"requests":>9} {"errors":>7} {"req/s":>8} '
+          f'{"p50 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for endpoint, stats in report.items():
+        print(f'{endpoint:<20} {stats["requests"]:>9} {stats["errors"]:>7} '
+              f'{stats["throughput"]:>8.2f} {stats["p50_ms"]:>8.1f} '
+              f'{stats["p99_ms"]:>8.1f} {stats["max_ms"]:>8.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('farm', help='JSON file written by "manage.py flamenco '
+                                     'create_benchmark_farm"')
+    parser.add_argument('--server', default='http://localhost:5001')
+    parser.add_argument('--duration', type=float, default=60, help='in seconds')
+    parser.add_argument('--managers', type=int, default=0,
+                        help='number of Managers to simulate; default all in the farm file')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of tasks each Manager runs concurrently')
+    parser.add_argument('--depsgraph-interval', type=float, default=5,
+                        help='seconds between depsgraph requests of a Manager')
+    parser.add_argument('--update-rate', type=float, default=1,
+                        help='task update batches per second per Manager')
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help='maximum number of task updates per batch')
+    parser.add_argument('--progress-step', type=int, default=10,
+                        help='task progress percentage per update; 100 finishes a task per '
+                             'update')
+    parser.add_argument('--log-lines', type=int, default=5,
+                        help='log lines per task update')
+    parser.add_argument('--page-size', type=int, default=0,
+                        help='depsgraph page size; default unpaged')
+    parser.add_argument('--timeout', type=float, default=30, help='HTTP timeout in seconds')
+    parser.add_argument('--json', dest='json_output',
+                        help='also write the report as JSON to this file')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(threadName)s %(message)s')
+
+    with open(args.farm) as infile:
+        farm = json.load(infile)
+    managers = farm['managers']
+    if args.managers:
+        managers = managers[:args.managers]
+    if not managers:
+        print('No Managers in the farm file', file=sys.stderr)
+        raise SystemExit(1)
+
+    stats = Stats()
+    start = time.monotonic()
+    deadline = start + args.duration
+    threads = [SimulatedManager(args, manager, stats, deadline) for manager in managers]
+    log.info('Simulating %d Managers for %.0f seconds', len(threads), args.duration)
+    for thread in threads:
+        thread.start()
+        # Spread the requests of the Managers over time.
+        time.sleep(random.uniform(0, 1.0 / args.update_rate / len(threads)))
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - start
+    report = stats.report(elapsed)
+    print_report(report, elapsed)
+
+    if args.json_output:
+        with open(args.json_output, 'w') as outfile:
+            json.dump({'elapsed': elapsed, 'managers': len(threads), 'endpoints': report},
+                      outfile, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,9 @@ class FlamencoExtension(PillarExtension):
     celery_task_modules = [
         'flamenco.celery.job_archival',
         'flamenco.celery.job_cleanup',
+        'flamenco.celery.job_compilation',
         'flamenco.celery.job_runnability_check',
+        'flamenco.celery.task_log_retention',
     ]
     user_roles = {
         'flamenco-admin',
@@ -70,8 +72,31 @@ class FlamencoExtension(PillarExtension):
 
         return {
             'FLAMENCO_RESUME_ARCHIVING_AGE': datetime.timedelta(days=1),
+            'FLAMENCO_ARCHIVE_STREAMING': True,
+            # Maximum size in bytes of the ZIP file that streaming archival stages in the
+            # temporary directory. None only limits it to the free space of that directory.
+            'FLAMENCO_ARCHIVE_MAX_SIZE': None,
+            'FLAMENCO_ARCHIVE_CHUNK_SIZE': 1000,  # tasks per Celery task, when not streaming
+            'FLAMENCO_ARCHIVE_PARALLEL_CHUNKS': 4,
+            'FLAMENCO_ARCHIVE_PURGE_BATCH_SIZE': 1000,  # tasks per delete
+            'FLAMENCO_ARCHIVE_PURGE_PAUSE': datetime.timedelta(milliseconds=100),
+            # Age at which task log entries are compacted into a log file, and per-project
+            # overrides as {project ID: age or None to keep the entries forever}.
+            'FLAMENCO_TASK_LOG_RETENTION': datetime.timedelta(days=90),
+            'FLAMENCO_TASK_LOG_RETENTION_PER_PROJECT': {},
+            # Age at which MongoDB deletes task log entries, compacted or not.
+            'FLAMENCO_TASK_LOG_TTL': None,
             'FLAMENCO_WAITING_FOR_FILES_MAX_AGE': datetime.timedelta(days=1),
             'FLAMENCO_JWT_TOKEN_EXPIRY': datetime.timedelta(hours=4),
+            'FLAMENCO_ASYNC_JOB_COMPILATION': True,
+            # Jobs that are under construction for this long get their compilation resumed.
+            'FLAMENCO_RESUME_CONSTRUCTION_AGE': datetime.timedelta(hours=1),
+            'FLAMENCO_RUNNABILITY_CHECK_ON_FAILURE': True,
+            'FLAMENCO_RUNNABILITY_CHECK_DELAY': datetime.timedelta(seconds=30),
+            # Number of (service account, Manager) pairs for which the result of the
+            # Manager authorisation check is cached, and for how long. 0 disables the cache.
+            'FLAMENCO_MANAGER_AUTH_CACHE_SIZE': 1000,
+            'FLAMENCO_MANAGER_AUTH_CACHE_TTL': datetime.timedelta(seconds=60),
         }
 
     def eve_settings(self):
@@ -131,13 +156,21 @@ class FlamencoExtension(PillarExtension):
         with app.app_context():
             self._create_collections(app.db())
 
-        from . import managers, jobs, tasks, jwt
+        from . import managers, jobs, tasks, jwt, request_cache
 
+        request_cache.setup_app(app)
         managers.setup_app(app)
         jobs.setup_app(app)
         tasks.setup_app(app)
         jwt.setup_app(app)
 
+        from .managers.auth_cache import ManagerAuthCache
+
+        self.manager_manager.auth_cache = ManagerAuthCache(
+            max_size=app.config['FLAMENCO_MANAGER_AUTH_CACHE_SIZE'],
+            ttl=app.config['FLAMENCO_MANAGER_AUTH_CACHE_TTL'],
+        )
+
         private_path = app.config.get('FLAMENCO_JWT_PRIVATE_KEY_PATH')
         public_path = app.config.get('FLAMENCO_JWT_PUBLIC_KEYS_PATH')
         if private_path and public_path:
@@ -168,7 +201,7 @@ class FlamencoExtension(PillarExtension):
         ORPHAN_FINDER_SKIP_COLLECTIONS.add('flamenco_manager_linking_keys')
 
     def _create_collections(self, db):
-        import pymongo
+        from . import indexes
 
         # flamenco_task_logs
         if 'flamenco_task_logs' not in db.list_collection_names():
@@ -180,15 +213,6 @@ class FlamencoExtension(PillarExtension):
         else:
             self._log.debug('Not creating flamenco_task_logs collection, already exists.')
 
-        self._log.info('Creating index on flamenco_task_logs collection')
-        db.flamenco_task_logs.create_index(
-            [('task', pymongo.ASCENDING),
-             ('received_on_manager', pymongo.ASCENDING)],
-            background=True,
-            unique=False,
-            sparse=False,
-        )
-
         # flamenco_tasks
         collection_names = {coll['name'] for coll in db.list_collections()}
         if 'flamenco_tasks' not in collection_names:
@@ -200,20 +224,6 @@ class FlamencoExtension(PillarExtension):
         else:
             self._log.debug('Not creating flamenco_tasks collection, already exists.')
 
-        self._log.info('Creating index on flamenco_tasks collection')
-        db.flamenco_tasks.create_index(
-            [('manager', pymongo.ASCENDING)],
-            background=False,
-            unique=False,
-            sparse=False,
-        )
-        db.flamenco_tasks.create_index(
-            [('_updated', pymongo.DESCENDING)],
-            background=False,
-            unique=False,
-            sparse=False,
-        )
-
         # Manager linking keys
         if 'flamenco_manager_linking_keys' not in collection_names:
             self._log.info('Creating flamenco_manager_linking_keys collection.')
@@ -222,8 +232,8 @@ class FlamencoExtension(PillarExtension):
             self._log.debug(
                 'Not creating flamenco_manager_linking_keys collection, already exists.')
 
-        self._log.info('Creating index on flamenco_manager_linking_keys')
-        db.flamenco_manager_linking_keys.create_index('remove_after', expireAfterSeconds=0)
+        self._log.info('Creating indexes on Flamenco collections')
+        indexes.create_indexes(db, flask.current_app.config)
 
     def flamenco_projects(self, *, projection: dict = None):
         """Returns projects set up for Flamenco.
@@ -377,7 +387,13 @@ class FlamencoExtension(PillarExtension):
         if extra_unset:
             update['$unset'] = {field_name: True for field_name in extra_unset}
 
-        result = collection.update_many(query, update)
+        if collection_name == 'tasks':
+            with self.task_manager.allocate_change_seq() as change_seq:
+                update['$set']['change_seq'] = change_seq
+                # Keeps the task status counters of the jobs up to date.
+                result = self.task_manager.update_tasks(query, update)
+        else:
+            result = collection.update_many(query, update)
         self._log.debug('Updated status of %i %s %s to %s',
                         result.modified_count, singular_name, query, new_status)
 
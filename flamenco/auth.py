@@ -78,7 +78,7 @@ class Auth(object):
 
         from pillar.api.projects.utils import user_rights_in_project
         import pillar.auth
-        from flamenco import current_flamenco
+        from flamenco import current_flamenco, request_cache
 
         # Get the actual user object to prevent multiple passes through the LocalProxy.
         user: pillar.auth.UserClass = current_user._get_current_object()
@@ -93,8 +93,8 @@ class Auth(object):
             return False
 
         # TODO Sybren: possibly split this up into a manager-fetching func + authorisation func.
-        # TODO: possibly store the user rights on the current project in the current_user object?
-        allowed_on_proj = user_rights_in_project(project_id)
+        allowed_on_proj = request_cache.cache('project_rights').get(
+            project_id, lambda: user_rights_in_project(project_id))
         if not allowed_on_proj.intersection(PROJECT_METHODS_TO_USE_FLAMENCO):
             self._log.info('User %s has no %s access to project %s.',
                            user.user_id, PROJECT_METHODS_TO_USE_FLAMENCO, project_id)
@@ -105,6 +105,7 @@ class Auth(object):
             return True
 
         managers_coll = current_flamenco.db('managers')
-        managers_count = managers_coll.count_documents({'projects': project_id})
+        managers_count = request_cache.cache('project_manager_counts').get(
+            project_id, lambda: managers_coll.count_documents({'projects': project_id}))
 
         return managers_count > 0
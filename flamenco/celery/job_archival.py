@@ -1,5 +1,6 @@
 import logging
 import pathlib
+import typing
 
 import bson
 
@@ -15,6 +16,10 @@ class ArchivalError(Exception):
     """Raised when there was an error archiving a job."""
 
 
+# Number of tasks fetched per query when reading tasks and their logs.
+TASK_BATCH_SIZE = 1000
+
+
 @current_app.celery.task(ignore_result=True)
 def archive_job(job_id: str):
     """Archives a given job.
@@ -23,6 +28,13 @@ def archive_job(job_id: str):
     - For each task, de-chunks the task logs and gz-compresses them.
     - Creates a ZIP file with the job+task definitions in JSON and compressed logs.
     - Uploads the ZIP to the project's file storage.
+
+    When FLAMENCO_ARCHIVE_STREAMING is True, the above is done in this Celery task,
+    streaming the tasks and logs from MongoDB straight into the ZIP file.
+    Otherwise each task is written to a temporary directory by a separate
+    Celery task, after which that directory is zipped.
+
+    Finally:
     - Records the link of the ZIP in the job document.
     - Deletes the tasks and task logs in MongoDB.
     - Sets the job status to "archived".
@@ -46,8 +58,29 @@ def archive_job(job_id: str):
         log.info('Job %s already archived, not archiving again', job_oid)
         return
 
+    if job.get('archive_blob_name'):
+        # The ZIP was uploaded, but purging the tasks was interrupted. The remaining
+        # tasks are already in the ZIP, so don't archive them again.
+        log.info('Job %s already has archive %s, resuming purge of its tasks',
+                 job_oid, job['archive_blob_name'])
+        update_mongo(job['archive_blob_name'], job_id)
+        return
+
     log.info('Archiving job %s', job_oid)
 
+    # Write the job to JSON.
+    pre_archive_status = job.get('pre_archive_status')
+    if pre_archive_status:
+        job['status'] = pre_archive_status
+        del job['pre_archive_status']
+    job_json = dumps(job, indent=4, sort_keys=True)
+
+    if current_app.config['FLAMENCO_ARCHIVE_STREAMING']:
+        _set_job_archiving(job_oid)
+        archive_blob_name = stream_job_archive(job, job_json)
+        update_mongo(archive_blob_name, job_id)
+        return
+
     # Create a temporary directory for the file operations.
     storage_path = tempfile.mkdtemp(prefix=f'job-archival-{job_id}-')
     zip_path = pathlib.Path(storage_path) / f'flamenco-job-{job_id}.zip'
@@ -55,25 +88,23 @@ def archive_job(job_id: str):
 
     # TODO: store the ZIP link in the job JSON in MongoDB.
 
-    # Write the job to JSON.
-    pre_archive_status = job.get('pre_archive_status')
-    if pre_archive_status:
-        job['status'] = pre_archive_status
-        del job['pre_archive_status']
-
     job_json_path = pathlib.Path(storage_path) / f'job-{job_id}.json'
     with job_json_path.open(mode='w', encoding='utf8') as outfile:
-        outfile.write(dumps(job, indent=4, sort_keys=True))
+        outfile.write(job_json)
 
-    # Set job status to 'archiving'.
-    res = current_flamenco.job_manager.api_set_job_status(job_oid, 'archiving')
-    if res.matched_count != 1:
-        raise ArchivalError(f'Unable to update job {job_oid}, matched count={res.matched_count}')
+    _set_job_archiving(job_oid)
 
-    # Run each task log compression in a separate Celery task.
+    # Run the task log compression in Celery tasks, each handling a range of tasks.
+    chunk_size = current_app.config['FLAMENCO_ARCHIVE_CHUNK_SIZE']
+    parallel_chunks = current_app.config['FLAMENCO_ARCHIVE_PARALLEL_CHUNKS']
     tasks_coll = current_flamenco.db('tasks')
-    tasks = tasks_coll.find({'job': job_oid}, {'_id': 1})
-    tasks_count = tasks_coll.count_documents({'job': job_oid})
+    task_ids = sorted(task['_id'] for task in tasks_coll.find({'job': job_oid}, {'_id': 1}))
+    chunks = [
+        download_tasks_and_logs.si(storage_path, job_id,
+                                   str(task_ids[start]),
+                                   str(task_ids[min(start + chunk_size, len(task_ids)) - 1]))
+        for start in range(0, len(task_ids), chunk_size)
+    ]
 
     # The chain of everything except downloading tasks & logs. Celery can't handle empty
     # groups, so we have to be careful in constructing the download_tasks group.
@@ -83,15 +114,160 @@ def archive_job(job_id: str):
             cleanup.si(storage_path)
     )
 
-    if tasks_count:
+    if chunks:
+        # Spread the chunks over a limited number of chains, so that at most
+        # 'parallel_chunks' chunks are processed at the same time.
+        log.info('Archiving %d tasks of job %s in %d chunks, %d in parallel',
+                 len(task_ids), job_oid, len(chunks), parallel_chunks)
         download_tasks = celery.group(*(
-            download_task_and_log.si(storage_path, str(task['_id']))
-            for task in tasks))
+            celery.chain(*chunks[lane::parallel_chunks])
+            for lane in range(min(parallel_chunks, len(chunks)))))
         chain = download_tasks | chain
 
     chain()
 
 
+def _set_job_archiving(job_oid: bson.ObjectId):
+    res = current_flamenco.job_manager.api_set_job_status(job_oid, 'archiving')
+    if res.matched_count != 1:
+        raise ArchivalError(f'Unable to update job {job_oid}, matched count={res.matched_count}')
+
+
+def stream_job_archive(job: dict, job_json: str) -> str:
+    """Writes the job, its tasks and their logs to a ZIP file, and uploads it.
+
+    The ZIP has the same contents as the one created by create_upload_zip().
+    Tasks are fetched in batches of TASK_BATCH_SIZE; log entries are written
+    while they are read.
+
+    The ZIP is not uploaded while it is written: Pillar's storage blobs are
+    created from a file of known size, and do not support multipart or chunked
+    uploads. It is written to an anonymous temporary file instead, which is the
+    only copy on local disk. Its size is limited to FLAMENCO_ARCHIVE_MAX_SIZE
+    and to the free space of the temporary directory; ArchivalError is raised
+    before writing beyond that limit.
+
+    Returns the name of the storage blob the ZIP is stored in.
+    """
+
+    import gzip
+    import tempfile
+    import zipfile
+
+    job_id = job['_id']
+    zip_name = f'flamenco-job-{job_id}.zip'
+    max_size = _archive_size_limit()
+    log.info('Streaming job %s to ZIP file of at most %d bytes', job_id, max_size)
+
+    with tempfile.TemporaryFile(prefix=f'job-archival-{job_id}-', suffix='.zip') as zip_file:
+        limited_file = _SizeLimitedFile(zip_file, max_size)
+        with zipfile.ZipFile(limited_file, mode='w', compression=zipfile.ZIP_DEFLATED) as zipped:
+            zipped.writestr(f'job-{job_id}.json', job_json)
+
+            task_count = 0
+            for task, log_entries in _tasks_and_logs({'job': job_id}):
+                task_id = task['_id']
+                zipped.writestr(f'task-{task_id}.json', dumps(task, indent=4, sort_keys=True))
+                with zipped.open(f'task-{task_id}.log.gz', mode='w') as zipped_log, \
+                        gzip.GzipFile(fileobj=zipped_log, mode='wb') as outfile:
+                    _write_log_entries(outfile, log_entries)
+                task_count += 1
+        log.info('Wrote %d tasks of job %s to ZIP file', task_count, job_id)
+
+        file_size = zip_file.tell()
+        zip_file.seek(0)
+        return _upload_zip(str(job['project']), zip_name, zip_file, file_size)
+
+
+def _archive_size_limit() -> int:
+    """Returns the maximum size in bytes of a ZIP file staged in the temporary directory."""
+
+    import shutil
+    import tempfile
+
+    free_space = shutil.disk_usage(tempfile.gettempdir()).free
+    max_size = current_app.config['FLAMENCO_ARCHIVE_MAX_SIZE']
+    if max_size is None:
+        return free_space
+    return min(max_size, free_space)
+
+
+class _SizeLimitedFile:
+    """Wraps a file object, refusing to let it grow beyond max_size bytes."""
+
+    def __init__(self, file_obj: typing.BinaryIO, max_size: int):
+        self._file_obj = file_obj
+        self._max_size = max_size
+
+    def write(self, data: bytes) -> int:
+        if self._file_obj.tell() + len(data) > self._max_size:
+            raise ArchivalError(f'Job archive would exceed the maximum size of '
+                                f'{self._max_size} bytes')
+        return self._file_obj.write(data)
+
+    def __getattr__(self, name: str):
+        return getattr(self._file_obj, name)
+
+
+def _tasks_and_logs(task_query: dict) \
+        -> typing.Iterator[typing.Tuple[dict, typing.Iterable[dict]]]:
+    """Yields (task, log entries) tuples for all tasks matching the query.
+
+    Tasks are fetched in batches of TASK_BATCH_SIZE, and the log entries
+    of each batch with a single query.
+
+    The log entries of a task have to be consumed before the next tuple is requested.
+    """
+
+    import itertools
+    import operator
+    import pymongo
+
+    tasks_coll = current_flamenco.db('tasks')
+    logs_coll = current_flamenco.db('task_logs')
+
+    tasks = tasks_coll.find(task_query).batch_size(TASK_BATCH_SIZE)
+    while True:
+        batch = list(itertools.islice(tasks, TASK_BATCH_SIZE))
+        if not batch:
+            break
+        batch.sort(key=operator.itemgetter('_id'))
+
+        # Sort on the task and reception time, so that the log entries can be matched
+        # with the (sorted) tasks in one pass. The (job, task, received_on_manager) index
+        # provides this order per job.
+        log_query = _task_logs_query({task['job'] for task in batch},
+                                     [task['_id'] for task in batch])
+        logs = logs_coll.find(log_query, projection={'task': True, 'log': True}).sort([
+            ('task', pymongo.ASCENDING),
+            ('received_on_manager', pymongo.ASCENDING),
+        ]).hint([
+            ('job', pymongo.ASCENDING),
+            ('task', pymongo.ASCENDING),
+            ('received_on_manager', pymongo.ASCENDING),
+        ])
+        logs_per_task = itertools.groupby(logs, key=operator.itemgetter('task'))
+        task_logs = next(logs_per_task, None)
+        for task in batch:
+            if task_logs is None or task_logs[0] != task['_id']:
+                yield task, ()
+                continue
+            yield task, task_logs[1]
+            task_logs = next(logs_per_task, None)
+
+
+def _task_logs_query(job_ids: typing.Iterable[bson.ObjectId],
+                     task_ids: typing.List[bson.ObjectId]) -> dict:
+    """Returns the query for the log entries of the given tasks of the given jobs.
+
+    Querying on the job lets MongoDB use the (job, task, received_on_manager) index.
+    Log entries stored before they got a job ID are matched with job=None; use
+    'manage.py flamenco backfill_task_log_jobs' to give them one.
+    """
+    return {'job': {'$in': [*job_ids, None]},
+            'task': {'$in': task_ids}}
+
+
 @current_app.celery.task(ignore_result=True)
 def resume_job_archiving():
     """Resumes archiving of jobs that are stuck in status "archiving".
@@ -119,25 +295,37 @@ def resume_job_archiving():
 def download_task_and_log(storage_path: str, task_id: str):
     """Downloads task + task log and stores them."""
 
-    import gzip
-    import pymongo
-
     task_oid = bson.ObjectId(task_id)
     log.info('Archiving task %s to %s', task_oid, storage_path)
 
-    tasks_coll = current_flamenco.db('tasks')
-    logs_coll = current_flamenco.db('task_logs')
+    for task, log_entries in _tasks_and_logs({'_id': task_oid}):
+        _write_task_and_log(pathlib.Path(storage_path), task, log_entries)
+
 
-    task = tasks_coll.find_one({'_id': task_oid})
+@current_app.celery.task(ignore_result=False)
+def download_tasks_and_logs(storage_path: str, job_id: str,
+                            first_task_id: str, last_task_id: str):
+    """Downloads the tasks + task logs of a range of task IDs of the job and stores them."""
 
-    # Use the exact same sort as we've created an index for.
-    logs = logs_coll.find({'task': task_oid}).sort([
-        ('task', pymongo.ASCENDING),
-        ('received_on_manager', pymongo.ASCENDING),
-    ])
+    log.info('Archiving tasks %s-%s of job %s to %s',
+             first_task_id, last_task_id, job_id, storage_path)
 
-    # Save the task as JSON
     spath = pathlib.Path(storage_path)
+    query = {
+        'job': bson.ObjectId(job_id),
+        '_id': {'$gte': bson.ObjectId(first_task_id),
+                '$lte': bson.ObjectId(last_task_id)},
+    }
+    for task, log_entries in _tasks_and_logs(query):
+        _write_task_and_log(spath, task, log_entries)
+
+
+def _write_task_and_log(spath: pathlib.Path, task: dict, log_entries: typing.Iterable[dict]):
+    import gzip
+
+    task_id = task['_id']
+
+    # Save the task as JSON
     task_path = spath / f'task-{task_id}.json'
     with open(task_path, mode='w', encoding='utf8') as outfile:
         outfile.write(dumps(task, indent=4, sort_keys=True))
@@ -145,13 +333,17 @@ def download_task_and_log(storage_path: str, task_id: str):
     # Get the task log bits and write to compressed file.
     log_path = spath / f'task-{task_id}.log.gz'
     with gzip.open(log_path, mode='wb') as outfile:
-        for log_entry in logs:
-            try:
-                log_contents = log_entry['log']
-            except KeyError:
-                # No 'log' in this log entry. Bit weird, but we shouldn't crash on it.
-                continue
-            outfile.write(log_contents.encode())
+        _write_log_entries(outfile, log_entries)
+
+
+def _write_log_entries(outfile: typing.BinaryIO, log_entries: typing.Iterable[dict]):
+    for log_entry in log_entries:
+        try:
+            log_contents = log_entry['log']
+        except KeyError:
+            # No 'log' in this log entry. Bit weird, but we shouldn't crash on it.
+            continue
+        outfile.write(log_contents.encode())
 
 
 @current_app.celery.task(ignore_result=True)
@@ -165,10 +357,6 @@ def create_upload_zip(project_id: str, storage_path: str, zip_path: str) -> str:
 
     import itertools
     import zipfile
-    import secrets
-    import datetime
-
-    from pillar.api.file_storage_backends import default_storage_backend
 
     log.info('Creating ZIP %s', zip_path)
     spath = pathlib.Path(storage_path)
@@ -179,6 +367,24 @@ def create_upload_zip(project_id: str, storage_path: str, zip_path: str) -> str:
                                      spath.glob('*.json')):
             outfile.write(fpath, fpath.name)
 
+    file_size = zpath.stat().st_size
+    with zpath.open(mode='rb') as stream_to_upload:
+        return _upload_zip(project_id, zpath.name, stream_to_upload, file_size)
+
+
+def _upload_zip(project_id: str, zip_name: str, stream_to_upload: typing.BinaryIO,
+                file_size: int) -> str:
+    """Uploads the ZIP file to a new blob in the storage backend.
+
+    Returns the name of the storage blob the ZIP is stored in.
+    """
+
+    import secrets
+    import datetime
+
+    from pillar.api.file_storage_backends import default_storage_backend
+
+    zpath = pathlib.PurePath(zip_name)
     bucket = default_storage_backend(project_id)
     blob = bucket.blob(f'flamenco-jobs/{zpath.name}')
     while blob.exists():
@@ -188,41 +394,25 @@ def create_upload_zip(project_id: str, storage_path: str, zip_path: str) -> str:
         new_zipname = f'{zpath.stem}-{uniquifier}{zpath.suffix}'
         blob = bucket.blob(f'flamenco-jobs/{new_zipname}')
 
-    log.info('Uploading ZIP %s to %s', zpath, blob)
-
-    file_size = zpath.stat().st_size
-    with zpath.open(mode='rb') as stream_to_upload:
-        blob.create_from_file(stream_to_upload,
-                              file_size=file_size,
-                              content_type='application/zip')
-
+    log.info('Uploading ZIP %s to %s', zip_name, blob)
+    blob.create_from_file(stream_to_upload,
+                          file_size=file_size,
+                          content_type='application/zip')
     return blob.name
 
 
 @current_app.celery.task(ignore_result=True)
 def update_mongo(archive_blob_name: str, job_id: str):
-    """Updates MongoDB by removing tasks and logs, and setting the job status."""
+    """Updates MongoDB by removing tasks and logs, and setting the job status.
+
+    The job's archive blob name is stored before the tasks are purged, so that
+    archive_job() resumes the purge when it is interrupted, instead of creating
+    a new archive of the tasks that are left.
+    """
 
     job_oid = bson.ObjectId(job_id)
-    tasks_coll = current_flamenco.db('tasks')
-    logs_coll = current_flamenco.db('task_logs')
     jobs_coll = current_flamenco.db('jobs')
 
-    log.info('Purging Flamenco tasks and task logs for job %s', job_id)
-
-    # Task log entries don't have a job ID, so we have to fetch the task IDs first.
-    task_ids = [
-        task['_id']
-        for task in tasks_coll.find({'job': job_oid})
-    ]
-
-    delete_result = logs_coll.delete_many({'task': {'$in': task_ids}})
-    log.info("  deleted %d task log entries for job %s: %s", delete_result.deleted_count, job_oid,
-             delete_result.raw_result)
-
-    delete_result = tasks_coll.delete_many({'job': job_oid})
-    log.info("  deleted %d tasks for job %s", delete_result.deleted_count, job_oid)
-
     # Update the job's archive blob name
     res = jobs_coll.update_one({'_id': job_oid},
                                {'$set': {'archive_blob_name': archive_blob_name}})
@@ -231,6 +421,9 @@ def update_mongo(archive_blob_name: str, job_id: str):
             f"Unable to update job {job_oid} to set archive_blob_name={archive_blob_name!r}, "
             f"matched count={res.matched_count}")
 
+    log.info('Purging Flamenco tasks and task logs for job %s', job_id)
+    _purge_tasks_and_logs(job_oid)
+
     # Update the job status to 'archived'
     res = current_flamenco.job_manager.api_set_job_status(job_oid, 'archived')
     if res.matched_count != 1:
@@ -239,6 +432,46 @@ def update_mongo(archive_blob_name: str, job_id: str):
             f"matched count={res.matched_count}")
 
 
+def _purge_tasks_and_logs(job_oid: bson.ObjectId):
+    """Deletes the tasks of the job and their logs, in batches.
+
+    Each batch consists of FLAMENCO_ARCHIVE_PURGE_BATCH_SIZE tasks, and
+    batches are separated by FLAMENCO_ARCHIVE_PURGE_PAUSE to give other
+    database operations some room. The logs of a task are deleted before the
+    task itself, so that when this is interrupted it can simply be run again.
+    """
+
+    import time
+
+    batch_size = current_app.config['FLAMENCO_ARCHIVE_PURGE_BATCH_SIZE']
+    pause = current_app.config['FLAMENCO_ARCHIVE_PURGE_PAUSE'].total_seconds()
+
+    tasks_coll = current_flamenco.db('tasks')
+    logs_coll = current_flamenco.db('task_logs')
+
+    task_count = tasks_coll.count_documents({'job': job_oid})
+    purged_tasks = purged_logs = 0
+    while True:
+        task_ids = [task['_id'] for task in tasks_coll.find({'job': job_oid},
+                                                            projection={'_id': True},
+                                                            limit=batch_size)]
+        if not task_ids:
+            break
+        if purged_tasks and pause:
+            time.sleep(pause)
+
+        delete_result = logs_coll.delete_many(_task_logs_query([job_oid], task_ids))
+        purged_logs += delete_result.deleted_count
+
+        delete_result = tasks_coll.delete_many({'_id': {'$in': task_ids}})
+        if not delete_result.deleted_count:
+            raise ArchivalError(f'Unable to delete tasks of job {job_oid}')
+        purged_tasks += delete_result.deleted_count
+
+        log.info('  deleted %d of %d tasks and %d task log entries for job %s',
+                 purged_tasks, task_count, purged_logs, job_oid)
+
+
 @current_app.celery.task(ignore_result=True)
 def cleanup(storage_path: str):
     """Removes the temporary storage path."""
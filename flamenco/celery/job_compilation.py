@@ -0,0 +1,83 @@
+"""Compilation of jobs into tasks.
+
+Compiling a job with many tasks can take longer than a HTTP request is allowed
+to take, so jobs are compiled in a Celery task. While this happens the job
+remains in status 'under-construction'. Tasks are stored in batches, and the
+number of tasks created so far is available in the job's 'tasks_status.count'.
+
+When the Celery task gets lost, for example because the broker dropped it,
+the job would stay under construction forever. Schedule regular checks for
+such jobs in the CELERY_BEAT_SCHEDULE like this:
+
+{
+    'resume-job-compilation': {
+        'task': 'flamenco.celery.job_compilation.resume_job_compilation',
+        'schedule': 600,  # every N seconds
+    },
+}
+"""
+
+import logging
+
+from bson import ObjectId
+
+from pillar import current_app
+from pillar.api.utils import utcnow
+
+from flamenco import current_flamenco
+
+log = logging.getLogger(__name__)
+
+
+@current_app.celery.task(ignore_result=True)
+def compile_job(job_id: str, reason: str):
+    log.info('compiling job %s', job_id)
+    job_oid = ObjectId(job_id)
+
+    jobs_coll = current_flamenco.db('jobs')
+    job = jobs_coll.find_one({'_id': job_oid}, projection={'status': True, 'tasks_status': True})
+    if not job:
+        log.info('job %s does not exist (any more)', job_id)
+        return
+    if job['status'] != 'under-construction':
+        log.info('job %s is not under construction any more (status=%r now)',
+                 job_id, job['status'])
+        return
+    if job.get('tasks_status', {}).get('count'):
+        # Another compile_job task, re-sent by resume_job_compilation(), got here first.
+        log.info('job %s already has tasks, not compiling it again', job_id)
+        return
+
+    current_flamenco.job_manager.api_compile_job(job_oid, reason=reason)
+
+
+@current_app.celery.task(ignore_result=True)
+def resume_job_compilation():
+    """Resumes compilation of jobs that are stuck in status "under-construction".
+
+    Jobs without tasks get their compile_job task sent again. Jobs whose
+    compilation stopped halfway cannot be resumed without creating duplicate
+    tasks, so they are put into status "construction-failed".
+    """
+    age = current_app.config['FLAMENCO_RESUME_CONSTRUCTION_AGE']
+    jobs_coll = current_flamenco.db('jobs')
+    query = {
+        'status': 'under-construction',
+        '_updated': {'$lte': utcnow() - age},
+    }
+    stuck = jobs_coll.find(query, projection={'tasks_status': True})
+
+    log.info('Resume compilation of %d jobs', jobs_coll.count_documents(query))
+    for job in stuck:
+        job_id = job['_id']
+        if job.get('tasks_status', {}).get('count'):
+            log.warning('Compilation of job %s stopped halfway', job_id)
+            current_flamenco.job_manager.api_set_job_status(
+                job_id, 'construction-failed',
+                reason=f'Compilation did not finish within {age}')
+            continue
+
+        log.debug('Resume compilation of job %s', job_id)
+        # Bump _updated so that the job is only resumed again after another period.
+        jobs_coll.update_one({'_id': job_id}, {'$set': {'_updated': utcnow()}})
+        compile_job.delay(str(job_id), 'Compilation resumed after it did not start')
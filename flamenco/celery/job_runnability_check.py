@@ -4,12 +4,19 @@ A job can be in status 'active' but still unable to run any task. This happens
 when all tasks that are still queued are dependent on failed tasks, where the
 number of failed tasks is too low to trigger cancellation of the entire job.
 
-Schedule regular checks in the CELERY_BEAT_SCHEDULE like this:
+Such tasks can only appear when a task fails. When FLAMENCO_RUNNABILITY_CHECK_ON_FAILURE
+is True, the job of a failed task is marked for checking, and the children of
+its failed tasks are checked FLAMENCO_RUNNABILITY_CHECK_DELAY later. Failures
+within that period are checked together.
+
+Also schedule regular checks of all active jobs in the CELERY_BEAT_SCHEDULE like
+this; with the event-driven checks enabled, this is only a safety net and can
+run at a low frequency:
 
 {
     'job-runnability-check': {
         'task': 'flamenco.celery.job_runnability_check.schedule_checks',
-        'schedule': 600,  # every N seconds
+        'schedule': 3600,  # every N seconds
     },
 }
 
@@ -38,6 +45,34 @@ def schedule_checks():
         log.info('Scheduling runnability check of job %s', job['_id'])
         runnability_check.delay(str(job['_id']))
 
+    # Jobs that are still marked for checking may have lost their Celery task.
+    marked_coll = current_flamenco.db('runnability_checks')
+    for marked in marked_coll.find(projection={'_id': True}):
+        log.info('Scheduling check of failed tasks of job %s', marked['_id'])
+        failed_tasks_check.delay(str(marked['_id']))
+
+
+def mark_failed_tasks(job_id: ObjectId, task_ids: typing.Iterable[ObjectId]):
+    """Marks the job for a runnability check, because these of its tasks failed.
+
+    Only the first failure schedules a Celery task; subsequent failures are
+    added to the pending check.
+    """
+
+    marked_coll = current_flamenco.db('runnability_checks')
+    pending = marked_coll.find_one_and_update(
+        {'_id': job_id},
+        {'$addToSet': {'failed_tasks': {'$each': list(task_ids)}}},
+        projection={'_id': True},
+        upsert=True,
+    )
+    if pending is not None:
+        return
+
+    delay = current_app.config['FLAMENCO_RUNNABILITY_CHECK_DELAY']
+    log.info('Scheduling check of failed tasks of job %s in %s', job_id, delay)
+    failed_tasks_check.apply_async((str(job_id),), countdown=delay.total_seconds())
+
 
 @current_app.celery.task(ignore_result=True)
 def runnability_check(job_id: str):
@@ -54,12 +89,42 @@ def runnability_check(job_id: str):
         return
 
     unrunnable_task_ids = _nonrunnable_tasks(job_oid)
+    _fail_job_if_unrunnable(job_oid, unrunnable_task_ids)
+
+
+@current_app.celery.task(ignore_result=True)
+def failed_tasks_check(job_id: str):
+    """Checks the children of the tasks that failed since the job was marked."""
+
+    log.info('checking failed tasks of job %s', job_id)
+    job_oid = ObjectId(job_id)
+
+    marked_coll = current_flamenco.db('runnability_checks')
+    marked = marked_coll.find_one_and_delete({'_id': job_oid})
+    if not marked:
+        log.info('job %s is not marked for checking (any more)', job_id)
+        return
+
+    jobs_coll = current_flamenco.db('jobs')
+    job = jobs_coll.find_one({'_id': job_oid}, projection={'status': True})
+    if not job:
+        log.info('job %s does not exist (any more)', job_id)
+        return
+    if job['status'] != 'active':
+        log.info('job %s is not active any more (status=%r now)', job_id, job['status'])
+        return
+
+    unrunnable_task_ids = _nonrunnable_children(job_oid, marked['failed_tasks'])
+    _fail_job_if_unrunnable(job_oid, unrunnable_task_ids)
+
+
+def _fail_job_if_unrunnable(job_oid: ObjectId, unrunnable_task_ids: typing.List[ObjectId]):
     if not unrunnable_task_ids:
-        log.info('job %s has no non-runnable tasks', job_id)
+        log.info('job %s has no non-runnable tasks', job_oid)
         return
 
     log.info('Non-runnable tasks in job %s, failing job: %s',
-             job_id, ', '.join([str(tid) for tid in unrunnable_task_ids]))
+             job_oid, ', '.join([str(tid) for tid in unrunnable_task_ids]))
 
     reason = f'{len(unrunnable_task_ids)} tasks have a failed/cancelled parent ' \
         f'and will not be able to run.'
@@ -68,42 +133,37 @@ def runnability_check(job_id: str):
 
 
 def _nonrunnable_tasks(job_oid: ObjectId) -> typing.List[ObjectId]:
-    aggr = [
-        # Select only tasks that have a runnable status.
-        {'$match': {
-            'status': {'$in': list(QUEUED_TASK_STATES)},
-            'job': job_oid,
-        }},
-        # Unwind the parents array, so that we can do a lookup in the next stage.
-        # Remove any tasks that don't have a parent to begin with.
-        {"$unwind": {
-            "path": "$parents",
-            "preserveNullAndEmptyArrays": False,
-        }},
-        # Look up the parent document for each unwound task.
-        # This produces single-item "parent_doc" arrays.
-        {"$lookup": {
-            "from": "flamenco_tasks",
-            "localField": "parents",
-            "foreignField": "_id",
-            "as": "parent_doc",
-        }},
-        # Unwind again, to turn the single-item "parent_doc" arrays into a subdocument.
-        {"$unwind": {
-            "path": "$parent_doc",
-            "preserveNullAndEmptyArrays": False,
-        }},
-        # Match to find any runnable task with failed/cancelled parent. If this exists,
-        # the job will not be able to finish completely, and we'll be better off
-        # cancelling it immediately.
-        {"$match": {
-            'parent_doc.status': {'$in': list(FAILED_TASK_STATES)},
-        }},
-        # Prevent duplicate tasks (otherwise each task appears once for each of its failed parents).
-        {"$group": {"_id": "$_id"}},
-        {"$project": {"_id": 1}},
-    ]
+    """Returns the IDs of runnable tasks that have a failed/cancelled parent.
+
+    If such a task exists, the job will not be able to finish completely, and
+    we'll be better off cancelling it immediately.
+    """
+    from flamenco.jobs.graph import JobGraph
+
+    graph = JobGraph.load(job_oid)
+    return [task_id for task_id in graph.task_ids
+            if graph.status(task_id) in QUEUED_TASK_STATES
+            and any(graph.status(parent_id) in FAILED_TASK_STATES
+                    for parent_id in graph.parents(task_id))]
+
+
+def _nonrunnable_children(job_oid: ObjectId,
+                          failed_task_ids: typing.List[ObjectId]) -> typing.List[ObjectId]:
+    """Returns the IDs of runnable children of the given tasks, if they are still failed.
+
+    This is _nonrunnable_tasks() limited to the children of these tasks.
+    """
+
     tasks_coll = current_flamenco.task_manager.collection()
-    unrunnable_task_ids = [result['_id']
-                           for result in tasks_coll.aggregate(aggr)]
-    return unrunnable_task_ids
+    still_failed = [task['_id'] for task in tasks_coll.find(
+        {'_id': {'$in': failed_task_ids}, 'status': {'$in': list(FAILED_TASK_STATES)}},
+        projection={'_id': True})]
+    if not still_failed:
+        return []
+
+    children = tasks_coll.find({
+        'job': job_oid,
+        'parents': {'$in': still_failed},
+        'status': {'$in': list(QUEUED_TASK_STATES)},
+    }, projection={'_id': True})
+    return [child['_id'] for child in children]
@@ -0,0 +1,143 @@
+"""Retention of task log entries.
+
+Task log entries that Managers send in their task update batches are stored in
+the flamenco_task_logs collection until their job is archived. To keep that
+collection from growing without bounds, the log entries of tasks that have
+not logged anything for FLAMENCO_TASK_LOG_RETENTION are compacted into a
+gzipped log file, which is attached to the task in the same way as log files
+uploaded by Managers. FLAMENCO_TASK_LOG_RETENTION_PER_PROJECT can override the
+retention per project.
+
+Only log entries that have a job ID are compacted; use
+'manage.py flamenco backfill_task_log_jobs' to add it to older entries.
+
+Schedule regular compaction in the CELERY_BEAT_SCHEDULE like this:
+
+{
+    'task-log-compaction': {
+        'task': 'flamenco.celery.task_log_retention.compact_task_logs',
+        'schedule': 86400,  # every N seconds
+    },
+}
+
+
+"""
+
+import datetime
+import logging
+import typing
+
+from bson import ObjectId
+
+from pillar import current_app
+from pillar.api.utils import utcnow
+
+from flamenco import current_flamenco
+
+log = logging.getLogger(__name__)
+
+# Number of log entries deleted per query.
+DELETE_BATCH_SIZE = 10000
+
+
+@current_app.celery.task(ignore_result=True)
+def compact_task_logs():
+    """Compacts the log entries of all tasks that have been idle long enough."""
+
+    retention = current_app.config['FLAMENCO_TASK_LOG_RETENTION']
+    per_project = current_app.config['FLAMENCO_TASK_LOG_RETENTION_PER_PROJECT']
+
+    retentions = [age for age in [retention, *per_project.values()] if age]
+    if not retentions:
+        log.info('Task log retention is disabled, not compacting task logs')
+        return
+
+    now = utcnow()
+    logs_coll = current_flamenco.db('task_logs')
+    jobs_coll = current_flamenco.db('jobs')
+
+    job_ids = [job_id for job_id in logs_coll.distinct(
+        'job', {'received_on_manager': {'$lt': now - min(retentions)}}) if job_id]
+    project_ids = {job['_id']: job['project']
+                   for job in jobs_coll.find({'_id': {'$in': job_ids}},
+                                             projection={'project': True})}
+    log.info('Compacting old task logs of %d jobs', len(job_ids))
+
+    for job_id in job_ids:
+        try:
+            project_id = project_ids[job_id]
+        except KeyError:
+            # The job no longer exists; delete_orphan_task_logs takes care of those.
+            continue
+
+        job_retention = per_project.get(str(project_id), retention)
+        if not job_retention:
+            continue
+        compact_job_task_logs(job_id, now - job_retention)
+
+
+def compact_job_task_logs(job_id: ObjectId, cutoff: datetime.datetime):
+    """Compacts the log entries of the job's tasks that logged nothing since the cutoff."""
+
+    logs_coll = current_flamenco.db('task_logs')
+    tasks_coll = current_flamenco.db('tasks')
+
+    idle_tasks = logs_coll.aggregate([
+        {'$match': {'job': job_id}},
+        {'$group': {'_id': '$task', 'last_received': {'$max': '$received_on_manager'}}},
+        {'$match': {'last_received': {'$lt': cutoff}}},
+    ])
+
+    compacted = deleted = 0
+    for idle_task in idle_tasks:
+        # TaskManager.api_attach_log() needs the project and job IDs.
+        task = tasks_coll.find_one({'_id': idle_task['_id']},
+                                   projection={'project': True, 'job': True, 'log_file': True})
+        if task is None:
+            continue
+
+        # Log files uploaded by the Manager contain the entire log, so then
+        # the log entries can simply be removed. Only the entries that were
+        # read are deleted, so that entries arriving in the mean time are kept.
+        if task.get('log_file'):
+            entry_ids = [entry['_id'] for entry in logs_coll.find(
+                {'task': task['_id'], 'received_on_manager': {'$lte': idle_task['last_received']}},
+                projection={'_id': True})]
+        else:
+            entry_ids = _attach_compacted_log(task)
+            compacted += 1
+
+        for start in range(0, len(entry_ids), DELETE_BATCH_SIZE):
+            delete_result = logs_coll.delete_many(
+                {'_id': {'$in': entry_ids[start:start + DELETE_BATCH_SIZE]}})
+            deleted += delete_result.deleted_count
+
+    log.info('Compacted logs of %d tasks of job %s, deleted %d log entries',
+             compacted, job_id, deleted)
+
+
+def _attach_compacted_log(task: dict) -> typing.List[ObjectId]:
+    """Attaches the task's log entries as gzipped log file to the task.
+
+    :returns: the IDs of the log entries that were written to the log file.
+    """
+    import gzip
+    import tempfile
+
+    import pymongo
+
+    logs_coll = current_flamenco.db('task_logs')
+    entry_ids = []
+    log_entries = logs_coll.find({'task': task['_id']}, projection={'log': True}).sort([
+        ('task', pymongo.ASCENDING),
+        ('received_on_manager', pymongo.ASCENDING),
+    ])
+
+    with tempfile.TemporaryFile(prefix=f'task-{task["_id"]}-', suffix='.log.gz') as log_file:
+        with gzip.GzipFile(fileobj=log_file, mode='wb') as outfile:
+            for log_entry in log_entries:
+                outfile.write(log_entry.get('log', '').encode())
+                entry_ids.append(log_entry['_id'])
+        log_file.seek(0)
+        current_flamenco.task_manager.api_attach_log(task, log_file)
+    return entry_ids
@@ -1,7 +1,7 @@
 """Commandline interface for Flamenco."""
 
 import logging
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
 from flask import current_app
 from flask_script import Manager
@@ -217,11 +217,20 @@ def runability_check():
     job_runnability_check.schedule_checks()
 
 
-@manager_flamenco.command
-def delete_orphan_task_logs():
+@manager_flamenco.option('-s', '--set-difference', dest='set_difference', action='store_true',
+                         default=False,
+                         help='Check the distinct task IDs of the log entries in batches, '
+                              'instead of checking each log entry.')
+@manager_flamenco.option('-r', '--resume', dest='resume', action='store_true', default=False,
+                         help='With --set-difference, resume from the last checkpoint.')
+def delete_orphan_task_logs(set_difference=False, resume=False):
     """Remove all task log entries for non-existant tasks."""
     from flamenco import current_flamenco
 
+    if set_difference:
+        _delete_orphan_task_logs_set_difference(resume)
+        return
+
     removal_batch_size = 1000
 
     tasks_coll = current_flamenco.db('tasks')
@@ -286,3 +295,395 @@ def delete_orphan_task_logs():
 
     log.info('Deleted %d orphan task logs in total, estimated %d task log entries remaining',
              logs_removed, logs_coll.estimated_document_count())
+
+
+# Number of job or task IDs checked per query when deleting orphan task logs
+# using set differences.
+ORPHAN_LOG_BATCH_SIZE = 10000
+
+
+def _delete_orphan_task_logs_set_difference(resume: bool):
+    """Remove task log entries of non-existant jobs and tasks, using set differences.
+
+    First removes the log entries of jobs that no longer exist. Then walks the
+    distinct task IDs of the remaining log entries in order, grouped on the
+    server, and checks which of them exist in batches. The completion of the
+    job phase and the last task ID of each batch are stored as checkpoint, so
+    that an interrupted run can be resumed.
+    """
+    import pymongo
+
+    from flamenco import current_flamenco
+
+    batch_size = ORPHAN_LOG_BATCH_SIZE
+    checkpoint_id = 'delete_orphan_task_logs'
+
+    jobs_coll = current_flamenco.db('jobs')
+    tasks_coll = current_flamenco.db('tasks')
+    logs_coll = current_flamenco.db('task_logs')
+    checkpoints_coll = current_flamenco.db('cli_checkpoints')
+
+    log.info('Removing orphan task logs. Estimated log count before removal: %d',
+             logs_coll.estimated_document_count())
+
+    checkpoint = None
+    if resume:
+        checkpoint = checkpoints_coll.find_one({'_id': checkpoint_id})
+    else:
+        checkpoints_coll.delete_one({'_id': checkpoint_id})
+    checkpoint = checkpoint or {}
+
+    if checkpoint.get('jobs_done'):
+        log.info('Skipping the non-existant jobs, they were checked by a previous run')
+    else:
+        _delete_orphan_job_logs(batch_size)
+        checkpoints_coll.update_one({'_id': checkpoint_id},
+                                    {'$set': {'jobs_done': True}},
+                                    upsert=True)
+
+    query = {'task': {'$ne': None}}
+    if checkpoint.get('last_task'):
+        log.info('Resuming after task %s', checkpoint['last_task'])
+        query = {'task': {'$gt': checkpoint['last_task']}}
+
+    # The distinct task IDs are grouped on the server, using the (task,
+    # received_on_manager) index, and returned in order so that the last task
+    # ID of each batch can serve as checkpoint.
+    log_tasks = logs_coll.aggregate([
+        {'$match': query},
+        {'$sort': {'task': pymongo.ASCENDING}},
+        {'$group': {'_id': '$task'}},
+        {'$sort': {'_id': pymongo.ASCENDING}},
+    ], allowDiskUse=True, batchSize=batch_size, comment='Orphan task log cleanup')
+
+    tasks_seen = 0
+    logs_removed = 0
+    batch: List[ObjectId] = []
+
+    def remove_orphans_in_batch():
+        nonlocal tasks_seen, logs_removed
+
+        existing = {task['_id'] for task in tasks_coll.find({'_id': {'$in': batch}},
+                                                            projection={'_id': True})}
+        orphans = [task_id for task_id in batch if task_id not in existing]
+        if orphans:
+            delete_result = logs_coll.delete_many({'task': {'$in': orphans}})
+            logs_removed += delete_result.deleted_count
+        tasks_seen += len(batch)
+        log.info('  checked %d tasks, deleted %d orphan task log entries so far',
+                 tasks_seen, logs_removed)
+
+        checkpoints_coll.update_one({'_id': checkpoint_id},
+                                    {'$set': {'last_task': batch[-1]}},
+                                    upsert=True)
+        batch.clear()
+
+    try:
+        for log_task in log_tasks:
+            batch.append(log_task['_id'])
+            if len(batch) >= batch_size:
+                remove_orphans_in_batch()
+    except KeyboardInterrupt:
+        log.info('Received keyboard interrupt, stopping; use --resume to continue later')
+        return
+
+    if batch:
+        remove_orphans_in_batch()
+    checkpoints_coll.delete_one({'_id': checkpoint_id})
+
+    log.info('Deleted %d orphan task logs in total, estimated %d task log entries remaining',
+             logs_removed, logs_coll.estimated_document_count())
+
+
+def _delete_orphan_job_logs(batch_size: int):
+    """Remove the task log entries of jobs that no longer exist.
+
+    The job IDs are grouped on the server and returned with a cursor, as there
+    can be too many for distinct().
+    """
+    from flamenco import current_flamenco
+
+    jobs_coll = current_flamenco.db('jobs')
+    logs_coll = current_flamenco.db('task_logs')
+
+    job_batch: List[ObjectId] = []
+    orphan_jobs = orphan_job_logs_removed = 0
+
+    def remove_orphan_jobs_in_batch():
+        nonlocal orphan_jobs, orphan_job_logs_removed
+
+        existing = {job['_id'] for job in jobs_coll.find({'_id': {'$in': job_batch}},
+                                                         projection={'_id': True})}
+        orphans = [job_id for job_id in job_batch if job_id not in existing]
+        if orphans:
+            delete_result = logs_coll.delete_many({'job': {'$in': orphans}})
+            orphan_jobs += len(orphans)
+            orphan_job_logs_removed += delete_result.deleted_count
+        job_batch.clear()
+
+    log_jobs = logs_coll.aggregate([{'$match': {'job': {'$ne': None}}},
+                                    {'$group': {'_id': '$job'}}],
+                                   allowDiskUse=True,
+                                   batchSize=batch_size,
+                                   comment='Orphan task log cleanup')
+    for log_job in log_jobs:
+        job_batch.append(log_job['_id'])
+        if len(job_batch) >= batch_size:
+            remove_orphan_jobs_in_batch()
+    if job_batch:
+        remove_orphan_jobs_in_batch()
+    if orphan_jobs:
+        log.info('  deleted %d task log entries of %d non-existant jobs',
+                 orphan_job_logs_removed, orphan_jobs)
+
+
+@manager_flamenco.option('-n', '--jobs', dest='job_count', type=int, default=10,
+                         help='Number of largest jobs to report per project.')
+def task_log_usage(job_count=10):
+    """Reports the storage used by task log entries, per project and job."""
+    import collections
+
+    from flamenco import current_flamenco
+
+    logs_coll = current_flamenco.db('task_logs')
+    jobs_coll = current_flamenco.db('jobs')
+
+    per_job = list(logs_coll.aggregate([
+        {'$group': {
+            '_id': '$job',
+            'entries': {'$sum': 1},
+            'bytes': {'$sum': {'$strLenBytes': {'$ifNull': ['$log', '']}}},
+            'oldest': {'$min': '$received_on_manager'},
+        }},
+        {'$sort': {'bytes': -1}},
+    ], allowDiskUse=True))
+
+    job_ids = [usage['_id'] for usage in per_job if usage['_id']]
+    project_ids = {job['_id']: job['project']
+                   for job in jobs_coll.find({'_id': {'$in': job_ids}},
+                                             projection={'project': True})}
+
+    per_project = collections.defaultdict(list)
+    for usage in per_job:
+        per_project[project_ids.get(usage['_id'])].append(usage)
+
+    def mib(usages) -> float:
+        return sum(usage['bytes'] for usage in usages) / 2 ** 20
+
+    for project_id, usages in sorted(per_project.items(), key=lambda item: -mib(item[1])):
+        if project_id:
+            label = f'project {project_id}'
+        else:
+            label = 'log entries without (existing) job'
+        print(f'{label}: {mib(usages):.1f} MiB in '
+              f'{sum(usage["entries"] for usage in usages)} entries')
+        for usage in usages[:job_count]:
+            if not usage['_id']:
+                continue
+            print(f'    job {usage["_id"]}: {mib([usage]):.1f} MiB in {usage["entries"]} entries, '
+                  f'oldest from {usage["oldest"]}')
+
+
+@manager_flamenco.option('-j', '--job', dest='job_id', default=None,
+                         help='Only backfill the log entries of this job.')
+def backfill_task_log_jobs(job_id=None):
+    """Stores the job ID in task log entries that were stored without one."""
+    from flamenco import current_flamenco
+
+    batch_size = 1000
+
+    tasks_coll = current_flamenco.db('tasks')
+    logs_coll = current_flamenco.db('task_logs')
+
+    if job_id:
+        job_ids = [str2id(job_id)]
+    else:
+        job_ids = tasks_coll.distinct('job')
+
+    log.info('Backfilling job ID of task log entries of %d jobs', len(job_ids))
+    total_modified = 0
+
+    def backfill(job_oid: ObjectId, task_ids: List[ObjectId]) -> int:
+        result = logs_coll.update_many({'task': {'$in': task_ids}, 'job': {'$exists': False}},
+                                       {'$set': {'job': job_oid}})
+        return result.modified_count
+
+    for job_oid in job_ids:
+        job_modified = 0
+        task_ids = []
+        for task in tasks_coll.find({'job': job_oid}, projection={'_id': True}):
+            task_ids.append(task['_id'])
+            if len(task_ids) >= batch_size:
+                job_modified += backfill(job_oid, task_ids)
+                task_ids.clear()
+        if task_ids:
+            job_modified += backfill(job_oid, task_ids)
+
+        if job_modified:
+            log.info('  job %s: backfilled %d log entries', job_oid, job_modified)
+        total_modified += job_modified
+
+    log.info('Backfilled job ID of %d task log entries in total', total_modified)
+
+
+@manager_flamenco.option('-j', '--job', dest='job_id', default=None,
+                         help='Only recount the tasks of this job.')
+def recount_task_statuses(job_id=None):
+    """Rebuilds the per-status task counters of jobs from their tasks.
+
+    Without a job ID, rebuilds the counters of all jobs that are not archived.
+    """
+    from flamenco import current_flamenco
+    from flamenco.jobs import ARCHIVE_JOB_STATES
+
+    if job_id:
+        job_ids = [str2id(job_id)]
+    else:
+        jobs_coll = current_flamenco.db('jobs')
+        job_ids = [job['_id'] for job in jobs_coll.find(
+            {'status': {'$nin': list(ARCHIVE_JOB_STATES)}},
+            projection={'_id': True})]
+
+    log.info('Recounting task statuses of %d jobs', len(job_ids))
+    for job_id in job_ids:
+        tasks_status = current_flamenco.job_manager.api_recount_task_statuses(job_id)
+        log.debug('  job %s: %s', job_id, tasks_status)
+    log.info('Recounted task statuses of %d jobs', len(job_ids))
+
+
+@manager_flamenco.option('-c', '--create', dest='create', action='store_true', default=False,
+                         help='Build the missing indexes in the background.')
+def indexes(create=False):
+    """Compares the declared MongoDB indexes with the existing ones.
+
+    Reports missing indexes, indexes that are not declared in flamenco.indexes,
+    and indexes that have not been used since the mongod started.
+    """
+
+    from flamenco import indexes as flamenco_indexes
+
+    db = current_app.db()
+    report = flamenco_indexes.report(db)
+
+    for spec in report.missing:
+        print(f'missing: {spec.collection_name}.{spec.name} ({spec.used_by})')
+    for index in report.undeclared:
+        print(f'undeclared: {index.collection_name}.{index.name}')
+    for unused in report.unused:
+        print(f'unused since {unused.since}: {unused.collection_name}.{unused.name}')
+    if not (report.missing or report.undeclared or report.unused):
+        print('All declared indexes exist and are used.')
+
+    if not create or not report.missing:
+        return
+
+    log.info('Building %d missing indexes in the background', len(report.missing))
+    flamenco_indexes.create_indexes(db, current_app.config,
+                                    specs=report.missing, background=True)
+
+
+# Settings for the jobs of the benchmark farm, per job type. The frame range and
+# chunk size are set from the commandline.
+BENCHMARK_JOB_SETTINGS = {
+    'sleep': {
+        'time_in_seconds': 1,
+    },
+    'blender-render': {
+        'blender_cmd': '{blender}',
+        'filepath': '/benchmark/scene.blend',
+        'render_output': '/benchmark/render/frame-######',
+        'format': 'PNG',
+        'images_or_video': 'images',
+    },
+    'blender-render-progressive': {
+        'blender_cmd': '{blender}',
+        'filepath': '/benchmark/scene.blend',
+        'render_output': '/benchmark/render-progressive/frame-######',
+        'format': 'OPEN_EXR',
+        'fps': 24,
+        'cycles_sample_count': 100,
+        'cycles_sample_cap': 25,
+    },
+    'blender-video-chunks': {
+        'filepath': '/benchmark/edit.blend',
+        'render_output': '/benchmark/video/edit.mkv',
+        'fps': 24,
+        'output_file_extension': '.mkv',
+        'images_or_video': 'video',
+        'extract_audio': False,
+    },
+}
+
+
+@manager_flamenco.option('-e', '--owner', dest='owner_email', required=True,
+                         help='Email address of the user that owns the projects and Managers.')
+@manager_flamenco.option('-p', '--projects', dest='project_count', type=int, default=2)
+@manager_flamenco.option('-m', '--managers', dest='manager_count', type=int, default=4)
+@manager_flamenco.option('-j', '--jobs', dest='jobs_per_type', type=int, default=1,
+                         help='Number of jobs of each job type to create per Manager.')
+@manager_flamenco.option('-f', '--frames', dest='frames', default='1-200')
+@manager_flamenco.option('-c', '--chunk-size', dest='chunk_size', type=int, default=5)
+@manager_flamenco.option('-o', '--output', dest='output', default='benchmark-farm.json',
+                         help='File to write the Manager IDs and tokens to.')
+def create_benchmark_farm(owner_email, project_count=2, manager_count=4, jobs_per_type=1,
+                          frames='1-200', chunk_size=5, output='benchmark-farm.json'):
+    """Creates projects, Managers and jobs for benchmark_farm.py.
+
+    NEVER run this on a production database; it is meant for a throw-away
+    database of a test server.
+    """
+    import json
+    import os
+
+    from pillar.api.projects import utils as project_utils
+    from flamenco import current_flamenco
+
+    authentication.force_cli_user()
+
+    users_coll = current_app.db('users')
+    owner = users_coll.find_one({'email': owner_email}, projection={'_id': 1})
+    if not owner:
+        log.error('User with email %r not found', owner_email)
+        return 1
+
+    projects_coll = current_app.db('projects')
+    project_ids = []
+    for project_idx in range(project_count):
+        url = f'flamenco-benchmark-{project_idx}'
+        project = projects_coll.find_one({'url': url}, projection={'_id': 1})
+        if project is None:
+            project = project_utils.create_new_project(
+                f'Flamenco Benchmark {project_idx}', owner['_id'], {'url': url})
+        flamenco.setup.setup_for_flamenco(url)
+        project_ids.append(project['_id'])
+
+    managers = []
+    for mngr_idx in range(manager_count):
+        mngr_doc, _, token = flamenco.setup.create_manager(
+            owner_email, f'Benchmark Manager {mngr_idx}', 'Simulated by benchmark_farm.py')
+        project_id = project_ids[mngr_idx % project_count]
+        current_flamenco.manager_manager.api_assign_to_project(
+            mngr_doc['_id'], project_id, 'assign')
+
+        job_count = 0
+        for job_type, settings in BENCHMARK_JOB_SETTINGS.items():
+            for job_idx in range(jobs_per_type):
+                current_flamenco.job_manager.api_create_job(
+                    f'benchmark {job_type} {job_idx}',
+                    'Job created by create_benchmark_farm',
+                    job_type,
+                    {**settings, 'frames': frames, 'chunk_size': chunk_size},
+                    project_id, owner['_id'], mngr_doc['_id'])
+                job_count += 1
+
+        log.info('Created Manager %s with %d jobs on project %s',
+                 mngr_doc['_id'], job_count, project_id)
+        managers.append({'_id': str(mngr_doc['_id']), 'token': token['token']})
+
+    # The file contains authentication tokens, so keep it private.
+    fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'w') as outfile:
+        json.dump({'projects': [str(pid) for pid in project_ids], 'managers': managers},
+                  outfile, indent=4)
+    log.info('Wrote %d Managers to %s; run benchmark_farm.py %s to start the benchmark',
+             len(managers), output, output)
@@ -160,6 +160,19 @@ managers_schema = {
     },
 }
 
+TASK_STATUSES = [
+    'under-construction',  # Job is still being compiled, task must be ignored by Manager.
+    'paused',  # Job can go to queued, tasks must be ignored by Manager until then.
+    'queued',
+    'claimed-by-manager',
+    'completed',
+    'active',
+    'cancel-requested',
+    'canceled',
+    'failed',  # Failed and will not be re-tried.
+    'soft-failed',  # Failed but will be re-tried and should not fail the job.
+]
+
 jobs_schema = {
     'name': {
         'type': 'string',
@@ -245,13 +258,13 @@ jobs_schema = {
     },
     # Embedded summary of the status of all tasks of a job. Used when listing
     # all jobs via a graphical interface.
+    # Number of tasks of this job, in total ('count') and per task status.
+    # Maintained by Flamenco whenever tasks are created, deleted, or change status.
     'tasks_status': {
         'type': 'dict',
         'schema': {
             'count': {'type': 'integer'},
-            'completed': {'type': 'integer'},
-            'failed': {'type': 'integer'},
-            'canceled': {'type': 'integer'}
+            **{status: {'type': 'integer'} for status in TASK_STATUSES},
         }
     },
     # The most important part of a job. These custom values are parsed by the
@@ -305,18 +318,7 @@ tasks_schema = {
     },
     'status': {
         'type': 'string',
-        'allowed': [
-            'under-construction',  # Job is still being compiled, task must be ignored by Manager.
-            'paused',  # Job can go to queued, tasks must be ignored by Manager until then.
-            'queued',
-            'claimed-by-manager',
-            'completed',
-            'active',
-            'cancel-requested',
-            'canceled',
-            'failed',  # Failed and will not be re-tried.
-            'soft-failed',  # Failed but will be re-tried and should not fail the job.
-        ],
+        'allowed': TASK_STATUSES,
         'default': 'queued'
     },
     'priority': {
@@ -443,6 +445,17 @@ tasks_schema = {
             },
         },
     },
+
+    # Monotonically increasing change sequence number, stamped on every write
+    # to the task. Used by Managers to incrementally fetch their depsgraph.
+    'change_seq': {
+        'type': 'integer',
+    },
+    # Set while the task is being claimed by its Manager, to count the tasks claimed by one
+    # request. It is removed again after counting.
+    'claim_token': {
+        'type': 'objectid',
+    },
 }
 
 task_logs_schema = {
@@ -454,6 +467,15 @@ task_logs_schema = {
         },
         'required': True,
     },
+    # Only stored since Flamenco Server 2.3; use 'manage.py flamenco backfill_task_log_jobs'
+    # to set it on older log entries.
+    'job': {
+        'type': 'objectid',
+        'data_relation': {
+            'resource': 'flamenco_jobs',
+            'field': '_id',
+        },
+    },
     'received_on_manager': {
         'type': 'datetime',
         'required': True,
@@ -0,0 +1,260 @@
+"""Declarative registry of the MongoDB indexes used by Flamenco.
+
+Every index is declared here together with the queries it serves, so that
+changing a query shape and its index happen in the same place. The indexes are
+created when the application starts, in the background for the large
+collections; use 'manage.py flamenco indexes' to compare the declared indexes
+with those in the database, to build missing indexes in the background, and to
+find indexes that are never used.
+"""
+
+import datetime
+import logging
+import typing
+
+import attr
+import pymongo
+import pymongo.database
+import pymongo.errors
+
+log = logging.getLogger(__name__)
+
+ASC = pymongo.ASCENDING
+DESC = pymongo.DESCENDING
+
+KeyPattern = typing.Tuple[typing.Tuple[str, int], ...]
+
+# MongoDB cannot remove the TTL of an existing index; setting it to the
+# maximum of 68 years effectively stops documents from expiring.
+TTL_DISABLED_SECONDS = 2 ** 31 - 1
+
+
+@attr.s(frozen=True)
+class IndexSpec:
+    """Declaration of a single index."""
+
+    # Collection name without the 'flamenco_' prefix.
+    collection: str = attr.ib(validator=attr.validators.instance_of(str))
+    keys: KeyPattern = attr.ib(converter=tuple)
+    # Description of the queries served by this index.
+    used_by: str = attr.ib(validator=attr.validators.instance_of(str))
+    # Extra options for create_index(), such as sparse=True.
+    options: dict = attr.ib(default=attr.Factory(dict), hash=False)
+    # Whether to build in the background when creating the index at startup.
+    background: bool = attr.ib(default=False)
+    # Configuration key of the timedelta after which documents expire, if any.
+    ttl_setting: typing.Optional[str] = attr.ib(default=None)
+
+    @property
+    def collection_name(self) -> str:
+        return f'flamenco_{self.collection}'
+
+    @property
+    def name(self) -> str:
+        """The index name, as generated by MongoDB."""
+        return '_'.join(f'{field}_{direction}' for field, direction in self.keys)
+
+    def create_options(self, config: typing.Mapping[str, typing.Any]) -> dict:
+        options = dict(self.options)
+        if self.ttl_setting:
+            ttl: typing.Optional[datetime.timedelta] = config[self.ttl_setting]
+            if ttl:
+                options['expireAfterSeconds'] = int(ttl.total_seconds())
+        return options
+
+
+INDEXES: typing.List[IndexSpec] = [
+    # flamenco_tasks
+    IndexSpec('tasks', [('manager', ASC), ('status', ASC), ('job', ASC)],
+              'clean-slate depsgraph, tasks_cancel_requested() and Eve lookups of the tasks '
+              'of a Manager',
+              background=True),
+    IndexSpec('tasks', [('manager', ASC), ('change_seq', ASC)],
+              'incremental depsgraph (X-Flamenco-Depsgraph-Cursor)',
+              background=True),
+    IndexSpec('tasks', [('job', ASC), ('status', ASC)],
+              'all tasks of a job: task status counts, JobGraph.load(), status changes per '
+              'job, archival and job compilers',
+              background=True),
+    IndexSpec('tasks', [('job', ASC), ('parents', ASC)],
+              'children of failed tasks in the runnability check',
+              background=True),
+    IndexSpec('tasks', [('_updated', DESC)],
+              'latest modification of the depsgraph',
+              background=True),
+    IndexSpec('tasks', [('claim_token', ASC)],
+              'counting the tasks claimed by a depsgraph request; the token is removed '
+              'after counting, so this only contains claims in progress',
+              options={'sparse': True}, background=True),
+
+    # flamenco_task_logs
+    IndexSpec('task_logs', [('task', ASC), ('received_on_manager', ASC)],
+              'log entries of a task, in order, and orphan log cleanup',
+              background=True),
+    IndexSpec('task_logs', [('job', ASC), ('task', ASC), ('received_on_manager', ASC)],
+              'log entries of a job for archival and log retention',
+              background=True),
+    IndexSpec('task_logs', [('received_on_manager', ASC)],
+              'finding old log entries for log retention; expires them when '
+              'FLAMENCO_TASK_LOG_TTL is set',
+              background=True, ttl_setting='FLAMENCO_TASK_LOG_TTL'),
+
+    # flamenco_jobs
+    IndexSpec('jobs', [('manager', ASC), ('status', ASC)],
+              'runnable jobs of a Manager for the depsgraph'),
+    IndexSpec('jobs', [('project', ASC), ('status', ASC)],
+              'job lists and status summaries of a project'),
+    IndexSpec('jobs', [('status', ASC), ('_updated', ASC)],
+              'periodic checks: active jobs, stuck waiting-for-files jobs, resuming compilation '
+              'and archival'),
+
+    # flamenco_managers
+    IndexSpec('managers', [('projects', ASC)],
+              'Managers assigned to a project, used in permission checks'),
+    IndexSpec('managers', [('owner', ASC)],
+              'Managers owned by a user'),
+
+    # flamenco_manager_linking_keys
+    IndexSpec('manager_linking_keys', [('remove_after', ASC)],
+              'expiring unused linking keys',
+              options={'expireAfterSeconds': 0}),
+]
+
+
+@attr.s
+class ExistingIndex:
+    collection_name: str = attr.ib()
+    name: str = attr.ib()
+    keys: KeyPattern = attr.ib(converter=tuple)
+
+
+@attr.s
+class UnusedIndex:
+    collection_name: str = attr.ib()
+    name: str = attr.ib()
+    since: datetime.datetime = attr.ib()
+
+
+@attr.s
+class IndexReport:
+    """Differences between the declared and the existing indexes."""
+
+    missing: typing.List[IndexSpec] = attr.ib(default=attr.Factory(list))
+    undeclared: typing.List[ExistingIndex] = attr.ib(default=attr.Factory(list))
+    unused: typing.List[UnusedIndex] = attr.ib(default=attr.Factory(list))
+
+
+def create_index(db: pymongo.database.Database, spec: IndexSpec,
+                 config: typing.Mapping[str, typing.Any], *,
+                 background: typing.Optional[bool] = None):
+    """Creates the index, or updates the TTL of an existing TTL index."""
+
+    options = spec.create_options(config)
+    if background is None:
+        background = spec.background
+
+    coll = db[spec.collection_name]
+    if spec.ttl_setting and 'expireAfterSeconds' not in options:
+        existing = coll.index_information().get(spec.name)
+        if existing and 'expireAfterSeconds' in existing:
+            _disable_ttl(db, spec, existing['expireAfterSeconds'])
+            return
+
+    try:
+        coll.create_index(list(spec.keys), background=background, **options)
+        return
+    except pymongo.errors.OperationFailure as ex:
+        if not spec.ttl_setting or 'expireAfterSeconds' not in options:
+            log.warning('Unable to create index %s on %s: %s',
+                        spec.name, spec.collection_name, ex)
+            return
+        log.info('Updating TTL of index %s on %s to %d seconds',
+                 spec.name, spec.collection_name, options['expireAfterSeconds'])
+
+    # The index already exists with a different TTL.
+    try:
+        db.command('collMod', spec.collection_name, index={
+            'keyPattern': dict(spec.keys),
+            'expireAfterSeconds': options['expireAfterSeconds'],
+        })
+    except pymongo.errors.OperationFailure as ex:
+        log.warning('Unable to set TTL of index %s on %s, drop the index to recreate it: %s',
+                    spec.name, spec.collection_name, ex)
+
+
+def _disable_ttl(db: pymongo.database.Database, spec: IndexSpec, expire_after_seconds: int):
+    """Stops an existing TTL index from expiring documents, now that its TTL is unset."""
+
+    if expire_after_seconds >= TTL_DISABLED_SECONDS:
+        return
+
+    log.warning('%s is not set, disabling the TTL of index %s on %s; drop the index to '
+                'recreate it without TTL', spec.ttl_setting, spec.name, spec.collection_name)
+    try:
+        db.command('collMod', spec.collection_name, index={
+            'keyPattern': dict(spec.keys),
+            'expireAfterSeconds': TTL_DISABLED_SECONDS,
+        })
+    except pymongo.errors.OperationFailure as ex:
+        log.error('Unable to disable TTL of index %s on %s, documents keep expiring until '
+                  'the index is dropped: %s', spec.name, spec.collection_name, ex)
+
+def create_indexes(db: pymongo.database.Database, config: typing.Mapping[str, typing.Any], *,
+                   specs: typing.Optional[typing.Iterable[IndexSpec]] = None,
+                   background: typing.Optional[bool] = None):
+    """Creates the given indexes, defaulting to all declared indexes."""
+
+    if specs is None:
+        specs = INDEXES
+    for spec in specs:
+        log.debug('Creating index %s on %s', spec.name, spec.collection_name)
+        create_index(db, spec, config, background=background)
+
+
+def existing_indexes(db: pymongo.database.Database) -> typing.List[ExistingIndex]:
+    """Returns the indexes of the collections with declared indexes, except those on _id."""
+
+    existing = []
+    collection_names = set(db.list_collection_names())
+    for coll_name in sorted({spec.collection_name for spec in INDEXES}):
+        if coll_name not in collection_names:
+            continue
+        for index in db[coll_name].list_indexes():
+            if index['name'] == '_id_':
+                continue
+            existing.append(ExistingIndex(coll_name, index['name'], index['key'].items()))
+    return existing
+
+
+def unused_indexes(db: pymongo.database.Database) -> typing.List[UnusedIndex]:
+    """Returns the indexes that have not been used since the mongod (re)started.
+
+    Note that $indexStats only reports on the mongod it runs on.
+    """
+
+    unused = []
+    collection_names = set(db.list_collection_names())
+    for coll_name in sorted({spec.collection_name for spec in INDEXES}):
+        if coll_name not in collection_names:
+            continue
+        for stats in db[coll_name].aggregate([{'$indexStats': {}}]):
+            if stats['name'] == '_id_' or stats['accesses']['ops']:
+                continue
+            unused.append(UnusedIndex(coll_name, stats['name'], stats['accesses']['since']))
+    return unused
+
+
+def report(db: pymongo.database.Database) -> IndexReport:
+    """Compares the declared indexes with the existing ones."""
+
+    existing = existing_indexes(db)
+    existing_keys = {(index.collection_name, index.keys) for index in existing}
+    declared_keys = {(spec.collection_name, spec.keys) for spec in INDEXES}
+
+    return IndexReport(
+        missing=[spec for spec in INDEXES
+                 if (spec.collection_name, spec.keys) not in existing_keys],
+        undeclared=[index for index in existing
+                    if (index.collection_name, index.keys) not in declared_keys],
+        unused=unused_indexes(db),
+    )
@@ -12,12 +12,15 @@ class AbstractJobCompiler(object, metaclass=abc.ABCMeta):
     job_manager = attr.ib(cmp=False, hash=False)
     _log = attrs_extra.log('%s.AbstractJobCompiler' % __name__)
 
+    # Batch of tasks being created while compiling a job.
+    _task_batch = attr.ib(default=None, init=False, cmp=False, hash=False)
+
     REQUIRED_SETTINGS = []  # type: typing.List[str]
 
     def compile(self, job: dict):
         """Compiles the job into a list of tasks.
 
-        Calls self.task_manager.create_task(...) to create the task in the database.
+        The tasks are created in the database in bulk, see flamenco.tasks.TaskBatch.
         """
 
         if not isinstance(job.get('_id'), bson.ObjectId):
@@ -26,7 +29,12 @@ class AbstractJobCompiler(object, metaclass=abc.ABCMeta):
         if not isinstance(job, dict):
             raise TypeError('job should be a dict, not %s' % type(job))
 
-        self._compile(job)
+        self._task_batch = self.task_manager.task_batch()
+        try:
+            self._compile(job)
+            self._task_batch.flush()
+        finally:
+            self._task_batch = None
         self._flip_status(job)
 
     @abc.abstractmethod
@@ -46,7 +54,8 @@ class AbstractJobCompiler(object, metaclass=abc.ABCMeta):
 
         # Flip all tasks for this job from 'under-construction' to 'queued', and do the same
         # with the job. This must all happen using a single '_updated' timestamp to prevent
-        # race conditions.
+        # race conditions. The tasks are flipped with a single query, and the job status
+        # is evaluated only once.
         now = datetime.datetime.now(tz=tz_util.utc)
 
         # handle 'start paused' flag
@@ -66,12 +75,22 @@ class AbstractJobCompiler(object, metaclass=abc.ABCMeta):
         Use this to construct tasks, rather than calling self.task_manager.api_create_task directly.
         This is important to prevent race conditions between job compilation and the Manager
         fetching tasks.
+
+        During compilation the task is added to the task batch, and only inserted into
+        the database when the batch is flushed. The returned ID can be used as parent
+        of other tasks immediately.
         """
 
-        return self.task_manager.api_create_task(job, commands, name,
-                                                 task_type=task_type,
-                                                 status=status,
-                                                 **kwargs)
+        if self._task_batch is None:
+            return self.task_manager.api_create_task(job, commands, name,
+                                                     task_type=task_type,
+                                                     status=status,
+                                                     **kwargs)
+
+        return self._task_batch.add_task(job, commands, name,
+                                         task_type=task_type,
+                                         status=status,
+                                         **kwargs)
 
     def validate_job_settings(self, job: dict):
         """Raises an exception if required settings are missing.
@@ -142,15 +142,17 @@ class AbstractBlenderJobCompiler(AbstractJobCompiler, metaclass=abc.ABCMeta):
         # Update existing render tasks to have the new task as parent.
         new_etag = random_etag()
         now = utcnow()
-        result = tasks_coll.update_many({
-            'job': job['_id'],
-            'task_type': 'blender-render',
-            **parents_kwargs,
-        }, {'$set': {
-            '_etag': new_etag,
-            '_updated': now,
-            'parents': [task_id],
-        }})
+        with current_flamenco.task_manager.allocate_change_seq() as change_seq:
+            result = tasks_coll.update_many({
+                'job': job['_id'],
+                'task_type': 'blender-render',
+                **parents_kwargs,
+            }, {'$set': {
+                '_etag': new_etag,
+                '_updated': now,
+                'change_seq': change_seq,
+                'parents': [task_id],
+            }})
         self._log.debug('Updated %d task parent pointers to %s', result.modified_count, task_id)
         return task_id
 
@@ -166,12 +168,14 @@ class AbstractBlenderJobCompiler(AbstractJobCompiler, metaclass=abc.ABCMeta):
         cmd = rna_overrides_command(job)
         new_etag = random_etag()
         now = utcnow()
-        result = tasks_coll.update_one(task, {'$set': {
-            '_etag': new_etag,
-            '_updated': now,
-            'status': 'queued',
-            'commands': [cmd.to_dict()],
-        }})
+        with current_flamenco.task_manager.allocate_change_seq() as change_seq:
+            result = current_flamenco.task_manager.update_tasks(task, {'$set': {
+                '_etag': new_etag,
+                '_updated': now,
+                'change_seq': change_seq,
+                'status': 'queued',
+                'commands': [cmd.to_dict()],
+            }})
 
         self._log.info('Modified %d RNA override task (%s) of job %s',
                        result.modified_count, task['_id'], job['_id'])
@@ -17,6 +17,7 @@ from pillar.api.utils import random_etag, utcnow
 from pillar.web.system_util import pillar_api
 
 from flamenco import current_flamenco, job_compilers
+from flamenco.tasks import FAILED_TASK_STATES
 from flamenco.job_compilers import blender_render
 
 CANCELABLE_JOB_STATES = {'active', 'queued', 'failed'}
@@ -116,6 +117,18 @@ class JobManager(object):
             return {'_items': [], '_meta': {'total': 0}}
         return j
 
+    def job_doc(self, job_id: ObjectId) -> typing.Optional[dict]:
+        """Returns the job's ID, project and status, or None if the job does not exist.
+
+        The document is cached for the duration of the current request.
+        """
+        from flamenco import request_cache
+
+        jobs_coll = current_flamenco.db('jobs')
+        return request_cache.cache('jobs').get(
+            job_id, lambda: jobs_coll.find_one({'_id': job_id},
+                                               projection={'project': 1, 'status': 1}))
+
     def job_status_summary(self, project_id):
         """Returns number of shots per shot status for the given project.
 
@@ -151,10 +164,142 @@ class JobManager(object):
 
     def update_job_after_task_status_change(self, job_id, task_id, new_task_status):
         """Updates the job status based on the status of this task and other tasks in the job.
+
+        :param task_id: the task that changed status, or None when multiple tasks of
+            the job changed to the same status at once.
+        """
+
+        if task_id is not None and new_task_status in FAILED_TASK_STATES:
+            self._mark_failed_tasks(job_id, [task_id])
+
+        status_counts = _JobTaskStatusCounts(self, job_id)
+        self._update_job_after_task_status_change(job_id, task_id, new_task_status,
+                                                  status_counts)
+
+    def update_jobs_after_task_status_changes(
+            self, status_changes: typing.Iterable[typing.Tuple[ObjectId, ObjectId, str]]):
+        """Updates job statuses after a batch of task status changes.
+
+        Each affected job is re-evaluated once for each distinct new task status,
+        in the order in which each status was last seen in the batch. The task
+        status counts of the job are only fetched again when the job status
+        changed in the mean time.
+
+        :param status_changes: iterable of (job ID, task ID, new task status) tuples.
+        """
+
+        # Mapping from job ID to mapping from new task status to the last task with that status.
+        per_job: typing.MutableMapping[ObjectId, typing.MutableMapping[str, ObjectId]] = \
+            collections.OrderedDict()
+        failed_per_job: typing.MutableMapping[ObjectId, typing.List[ObjectId]] = \
+            collections.defaultdict(list)
+        for job_id, task_id, new_task_status in status_changes:
+            job_changes = per_job.setdefault(job_id, collections.OrderedDict())
+            job_changes.pop(new_task_status, None)  # move to the end
+            job_changes[new_task_status] = task_id
+            if new_task_status in FAILED_TASK_STATES:
+                failed_per_job[job_id].append(task_id)
+
+        for job_id, failed_task_ids in failed_per_job.items():
+            self._mark_failed_tasks(job_id, failed_task_ids)
+
+        for job_id, job_changes in per_job.items():
+            status_counts = _JobTaskStatusCounts(self, job_id)
+            for new_task_status, task_id in job_changes.items():
+                self._update_job_after_task_status_change(job_id, task_id, new_task_status,
+                                                          status_counts)
+
+    def _mark_failed_tasks(self, job_id: ObjectId, task_ids: typing.List[ObjectId]):
+        """Schedules a runnability check of the children of these failed tasks."""
+
+        if not current_app.config['FLAMENCO_RUNNABILITY_CHECK_ON_FAILURE']:
+            return
+
+        from flamenco.celery import job_runnability_check
+
+        job_runnability_check.mark_failed_tasks(job_id, task_ids)
+
+    def task_status_counts(self, job_id: ObjectId) -> typing.Dict[str, int]:
+        """Returns the number of tasks of the job, per task status.
+
+        Statuses that no task has are not included in the returned dict.
+
+        The counts are read from the job's 'tasks_status' counters. Jobs that do not
+        have those counters yet get them from counting their tasks.
         """
 
         jobs_coll = current_flamenco.db('jobs')
+        job = jobs_coll.find_one(job_id, projection={'tasks_status': 1})
+        tasks_status = (job or {}).get('tasks_status') or {}
+        if 'count' not in tasks_status:
+            tasks_status = self.api_recount_task_statuses(job_id, only_if_missing=True)
+
+        return {status: count for status, count in tasks_status.items()
+                if count and status != 'count'}
+
+    def api_recount_task_statuses(self, job_id: ObjectId, *,
+                                  only_if_missing=False) -> typing.Dict[str, int]:
+        """Rebuilds the job's 'tasks_status' counters by counting its tasks.
+
+        :param only_if_missing: only store the counters on the job when it does
+            not have any yet, so that counters maintained by concurrent requests
+            are not overwritten.
+        :returns: the counters, including the total in 'count'.
+        """
+
         tasks_coll = current_flamenco.db('tasks')
+        aggr = tasks_coll.aggregate([
+            {'$match': {'job': job_id}},
+            {'$group': {'_id': '$status', 'count': {'$sum': 1}}},
+        ])
+        tasks_status = {result['_id']: result['count'] for result in aggr}
+        tasks_status['count'] = sum(tasks_status.values())
+
+        query: typing.Dict[str, typing.Any] = {'_id': job_id}
+        if only_if_missing:
+            query['tasks_status.count'] = {'$exists': False}
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.update_one(query, {'$set': {'tasks_status': tasks_status}})
+
+        return tasks_status
+
+    def update_task_status_counts(
+            self, deltas: typing.Mapping[ObjectId, typing.Mapping[str, int]]):
+        """Atomically increments the 'tasks_status' counters of jobs.
+
+        Jobs that do not have counters yet are skipped; their counters are
+        created from the tasks themselves when they are first needed.
+
+        :param deltas: mapping from job ID to mapping from task status (or
+            'count' for the total number of tasks) to the increment.
+        """
+
+        import pymongo
+
+        operations = []
+        for job_id, job_deltas in deltas.items():
+            increments = {f'tasks_status.{status}': delta
+                          for status, delta in job_deltas.items() if delta}
+            if not increments:
+                continue
+            operations.append(pymongo.UpdateOne(
+                {'_id': job_id, 'tasks_status.count': {'$exists': True}},
+                {'$inc': increments}))
+
+        if not operations:
+            return
+
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.bulk_write(operations, ordered=False)
+
+    def _update_job_after_task_status_change(self, job_id, task_id, new_task_status,
+                                             status_counts: '_JobTaskStatusCounts'):
+        jobs_coll = current_flamenco.db('jobs')
+
+        def __set_job_status(new_job_status: str, **kwargs):
+            self.api_set_job_status(job_id, new_job_status, **kwargs)
+            # Changing the job status can change task statuses too.
+            status_counts.invalidate()
 
         def __job_status_if_a_then_b(if_status: str, then_new_status: str):
             """Set job to active if it was queued."""
@@ -163,7 +308,7 @@ class JobManager(object):
             if job['status'] == if_status:
                 self._log.info('Job %s became %s because one of its tasks %s changed '
                                'status to %s', job_id, then_new_status, task_id, new_task_status)
-                self.api_set_job_status(job_id, then_new_status)
+                __set_job_status(then_new_status)
 
         if new_task_status == 'queued':
             # Re-queueing a task on a completed job should re-queue the job too.
@@ -173,8 +318,7 @@ class JobManager(object):
         if new_task_status == 'claimed-by-manager':
             # See if there are any active tasks left. If the job was active, but a task
             # goes to 'claimed-by-manager', this means the task likely active and now re-queued.
-            statuses = tasks_coll.distinct('status', {'job': job_id})
-            if 'active' not in statuses:
+            if not status_counts().get('active'):
                 __job_status_if_a_then_b('active', 'queued')
             return
 
@@ -190,24 +334,24 @@ class JobManager(object):
             job_status = job['status']
             if job_status in {'cancel-requested', 'fail-requested'}:
                 # This could be the last cancel-requested task to go to 'canceled.
-                statuses = tasks_coll.distinct('status', {'job': job_id})
-                if 'cancel-requested' not in statuses:
+                if not status_counts().get('cancel-requested'):
                     self._log.info('Last task %s of job %s went from cancel-requested to canceled',
                                    task_id, job_id)
                     next_status = job_status.replace('-requested', 'ed')
-                    self.api_set_job_status(job_id, next_status)
+                    __set_job_status(next_status)
             return
 
         if new_task_status == 'failed':
             # Count the number of failed tasks. If it is more than 10%, fail the job.
-            total_count = tasks_coll.count_documents({'job': job_id})
-            fail_count = tasks_coll.count_documents({'job': job_id, 'status': 'failed'})
+            counts = status_counts()
+            total_count = sum(counts.values())
+            fail_count = counts.get('failed', 0)
             fail_perc = fail_count / float(total_count) * 100
             if fail_perc >= TASK_FAIL_JOB_PERCENTAGE:
                 msg = f'Failing job {job_id} because {fail_count} of its {total_count} tasks ' \
                     f'({int(fail_perc)}%) failed'
                 self._log.info(msg)
-                self.api_set_job_status(job_id, 'failed', reason=msg)
+                __set_job_status('failed', reason=msg)
             else:
                 self._log.info('Task %s of job %s failed; '
                                'only %i of its %i tasks failed (%i%%), so ignoring for now',
@@ -220,17 +364,17 @@ class JobManager(object):
             if job['status'] not in {'active', 'fail-requested', 'cancel-requested'}:
                 self._log.info('Job %s became active because one of its tasks %s changed '
                                'status to %s', job_id, task_id, new_task_status)
-                self.api_set_job_status(job_id, 'active')
+                __set_job_status('active')
             return
 
         if new_task_status == 'completed':
             # Maybe all tasks are completed, which should complete the job.
-            statuses = tasks_coll.distinct('status', {'job': job_id})
-            if statuses == ['completed']:
+            statuses = {status for status, count in status_counts().items() if count}
+            if statuses == {'completed'}:
                 self._log.info('All tasks (last one was %s) of job %s are completed, '
                                'setting job to completed.',
                                task_id, job_id)
-                self.api_set_job_status(job_id, 'completed')
+                __set_job_status('completed')
             else:
                 __job_status_if_a_then_b('queued', 'active')
             return
@@ -274,6 +418,8 @@ class JobManager(object):
             next_status = self.handle_job_status_change(job_id, old_status, new_status)
             old_status, new_status = new_status, next_status
 
+        from flamenco import request_cache
+        request_cache.invalidate('jobs', job_id)
         return result
 
     def handle_job_status_change(self, job_id: ObjectId,
@@ -373,9 +519,9 @@ class JobManager(object):
             followed by another one.
         """
 
-        tasks_coll = current_flamenco.db('tasks')
-        total_tasks = tasks_coll.count_documents({'job': job_id})
-        completed_tasks = tasks_coll.count_documents({'job': job_id, 'status': 'completed'})
+        status_counts = self.task_status_counts(job_id)
+        total_tasks = sum(status_counts.values())
+        completed_tasks = status_counts.get('completed', 0)
         if completed_tasks < total_tasks:
             # Not yet completed, so just stay at current status.
             self._log.debug('Job %s has %d of %d tasks completed, staying at status %r',
@@ -438,11 +584,13 @@ class JobManager(object):
                               result.matched_count, job_id, new_priority)
 
         tasks_coll = current_flamenco.db('tasks')
-        result = tasks_coll.update_many({'job': job_id},
-                                        {'$set': {'job_priority': new_priority,
-                                                  '_updated': now,
-                                                  '_etag': new_etag,
-                                                  }})
+        with current_flamenco.task_manager.allocate_change_seq() as change_seq:
+            result = tasks_coll.update_many({'job': job_id},
+                                            {'$set': {'job_priority': new_priority,
+                                                      '_updated': now,
+                                                      '_etag': new_etag,
+                                                      'change_seq': change_seq,
+                                                      }})
         self._log.debug('Matched %d tasks while setting job %s to priority %r',
                         result.matched_count, job_id, new_priority)
 
@@ -485,7 +633,13 @@ class JobManager(object):
                           job_id: ObjectId,
                           new_job_settings: typing.Optional[typing.Dict[str, typing.Any]]=None,
                           *, reason: str):
-        """Construct the tasks for a job."""
+        """Construct the tasks for a job.
+
+        The job is put into status 'under-construction', after which its tasks
+        are generated by the flamenco.celery.job_compilation.compile_job Celery
+        task. When FLAMENCO_ASYNC_JOB_COMPILATION is False, the tasks are
+        generated before this function returns.
+        """
 
         jobs_coll = current_flamenco.db('jobs')
         job = jobs_coll.find_one({'_id': job_id})
@@ -501,6 +655,34 @@ class JobManager(object):
                 raise ValueError(f'Could not find job {job_id} for updating new settings')
 
         self.api_set_job_status(job_id, 'under-construction', reason=reason)
+
+        if not current_app.config['FLAMENCO_ASYNC_JOB_COMPILATION']:
+            self.api_compile_job(job_id, reason=reason)
+            return
+
+        from flamenco.celery import job_compilation
+
+        self._log.info('Scheduling compilation of job %s', job_id)
+        try:
+            job_compilation.compile_job.delay(str(job_id), reason)
+        except Exception as ex:
+            # Without the Celery task nothing would ever take the job out of this status.
+            self._log.exception('Scheduling compilation of job %s failed', job_id)
+            self.api_set_job_status(
+                job_id, 'construction-failed',
+                reason=f'{reason}; scheduling compilation failed: {ex}')
+
+    def api_compile_job(self, job_id: ObjectId, *, reason: str):
+        """Generate the tasks for a job that is under construction.
+
+        When compilation fails, the job is put into status 'construction-failed'.
+        """
+
+        jobs_coll = current_flamenco.db('jobs')
+        job = jobs_coll.find_one({'_id': job_id})
+        if not job:
+            raise ValueError(f'Job {job_id} does not exist')
+
         self._log.info('Generating tasks for job %s', job_id)
 
         try:
@@ -511,6 +693,27 @@ class JobManager(object):
                 job_id, 'construction-failed', reason=f'{reason}; compilation failed: {ex}')
 
 
+@attr.s
+class _JobTaskStatusCounts:
+    """Per-status task counts of a single job.
+
+    The counts are fetched from MongoDB when they are first needed, and then
+    cached until invalidate() is called.
+    """
+
+    job_manager = attr.ib()
+    job_id = attr.ib()
+    _counts = attr.ib(default=None, init=False)  # type: typing.Optional[typing.Dict[str, int]]
+
+    def __call__(self) -> typing.Dict[str, int]:
+        if self._counts is None:
+            self._counts = self.job_manager.task_status_counts(self.job_id)
+        return self._counts
+
+    def invalidate(self):
+        self._counts = None
+
+
 def setup_app(app):
     from . import eve_hooks, patch
 
@@ -24,6 +24,9 @@ def before_inserting_jobs(jobs):
             # This will be set to 'queued' when job compilation is finished.
             job['status'] = 'under-construction'
 
+        # The task status counters are maintained by Flamenco, starting at zero tasks.
+        job['tasks_status'] = {'count': 0}
+
         try:
             job_compilers.validate_job(job)
         except exceptions.JobSettingError as ex:
@@ -131,6 +134,15 @@ def handle_job_status_update(job_doc, original_doc):
     current_flamenco.job_manager.handle_job_status_change(job_id, old_status, new_status)
 
 
+def keep_tasks_status(job_doc, original_doc):
+    """Prevents a PUT from overwriting the task status counters maintained by Flamenco."""
+
+    if 'tasks_status' in original_doc:
+        job_doc['tasks_status'] = original_doc['tasks_status']
+    else:
+        job_doc.pop('tasks_status', None)
+
+
 def reject_resource_deletion(*args):
     log.warning("Rejecting DELETE on jobs resource")
     raise wz_exceptions.Forbidden()
@@ -145,5 +157,6 @@ def setup_app(app):
     app.on_insert_flamenco_jobs += check_jobs_permissions_modify
     app.on_update_flamenco_jobs += check_job_permissions_modify
     app.on_replace_flamenco_jobs += check_job_permissions_modify
+    app.on_replace_flamenco_jobs += keep_tasks_status
     app.on_delete_item_flamenco_jobs += check_job_permissions_modify
     app.on_delete_resource_flamenco_jobs += reject_resource_deletion
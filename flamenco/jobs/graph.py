@@ -0,0 +1,181 @@
+"""In-memory representation of the task dependency graph of a job.
+
+The graph is loaded from MongoDB with a single query, after which it can be
+traversed without any further database access. Tasks are numbered in the order
+in which they were loaded; the adjacency lists in both directions are stored
+as arrays of those numbers.
+"""
+
+import array
+import collections
+import typing
+
+import attr
+from bson import ObjectId
+
+PROJECTION = {'_id': True, 'parents': True, 'status': True, 'priority': True}
+
+
+@attr.s(frozen=True)
+class _Adjacency:
+    """Adjacency lists of all nodes, stored in two flat arrays.
+
+    The neighbours of node N are targets[offsets[N]:offsets[N+1]].
+    """
+
+    offsets = attr.ib(validator=attr.validators.instance_of(array.array))
+    targets = attr.ib(validator=attr.validators.instance_of(array.array))
+
+    @classmethod
+    def from_lists(cls, neighbours: typing.Sequence[typing.Iterable[int]]) -> '_Adjacency':
+        offsets = array.array('l', [0])
+        targets = array.array('l')
+        for node_neighbours in neighbours:
+            targets.extend(node_neighbours)
+            offsets.append(len(targets))
+        return cls(offsets, targets)
+
+    def __getitem__(self, node: int) -> array.array:
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def degree(self, node: int) -> int:
+        return self.offsets[node + 1] - self.offsets[node]
+
+
+@attr.s(frozen=True)
+class JobGraph:
+    """Dependency graph of the tasks of a single job.
+
+    Construct with JobGraph.load(job_id) or JobGraph.from_tasks(job_id, tasks).
+    Parents that are not part of the job are ignored.
+    """
+
+    job_id = attr.ib(validator=attr.validators.instance_of(ObjectId))
+    task_ids: typing.List[ObjectId] = attr.ib()
+    statuses: typing.List[str] = attr.ib()
+    priorities: typing.List[int] = attr.ib()
+    _index: typing.Dict[ObjectId, int] = attr.ib(repr=False)
+    _parents: _Adjacency = attr.ib(repr=False)
+    _children: _Adjacency = attr.ib(repr=False)
+
+    @classmethod
+    def load(cls, job_id: ObjectId) -> 'JobGraph':
+        """Loads the graph of all tasks of the job from MongoDB."""
+        from flamenco import current_flamenco
+
+        tasks_coll = current_flamenco.db('tasks')
+        tasks = tasks_coll.find({'job': job_id}, projection=PROJECTION)
+        return cls.from_tasks(job_id, tasks)
+
+    @classmethod
+    def from_tasks(cls, job_id: ObjectId, tasks: typing.Iterable[dict]) -> 'JobGraph':
+        """Constructs the graph from task documents.
+
+        The task documents only need the fields in PROJECTION.
+        """
+
+        tasks = list(tasks)
+        index = {task['_id']: idx for idx, task in enumerate(tasks)}
+
+        parent_lists = [[index[parent_id] for parent_id in task.get('parents') or ()
+                         if parent_id in index]
+                        for task in tasks]
+        child_lists: typing.List[typing.List[int]] = [[] for _ in tasks]
+        for node, node_parents in enumerate(parent_lists):
+            for parent in node_parents:
+                child_lists[parent].append(node)
+
+        return cls(
+            job_id=job_id,
+            task_ids=[task['_id'] for task in tasks],
+            statuses=[task.get('status') for task in tasks],
+            priorities=[task.get('priority') for task in tasks],
+            index=index,
+            parents=_Adjacency.from_lists(parent_lists),
+            children=_Adjacency.from_lists(child_lists),
+        )
+
+    def __len__(self) -> int:
+        return len(self.task_ids)
+
+    def __contains__(self, task_id: ObjectId) -> bool:
+        return task_id in self._index
+
+    def status(self, task_id: ObjectId) -> str:
+        return self.statuses[self._index[task_id]]
+
+    def priority(self, task_id: ObjectId) -> int:
+        return self.priorities[self._index[task_id]]
+
+    def parents(self, task_id: ObjectId) -> typing.List[ObjectId]:
+        """Returns the IDs of the direct parents of the task."""
+        return self._ids(self._parents[self._index[task_id]])
+
+    def children(self, task_id: ObjectId) -> typing.List[ObjectId]:
+        """Returns the IDs of the tasks that directly depend on the task."""
+        return self._ids(self._children[self._index[task_id]])
+
+    def roots(self) -> typing.List[ObjectId]:
+        """Returns the IDs of the tasks that do not depend on any other task."""
+        return [task_id for node, task_id in enumerate(self.task_ids)
+                if not self._parents.degree(node)]
+
+    def enders(self) -> typing.List[ObjectId]:
+        """Returns the IDs of the tasks that are not a parent of any other task."""
+        return [task_id for node, task_id in enumerate(self.task_ids)
+                if not self._children.degree(node)]
+
+    def descendants(self, task_id: ObjectId) -> typing.List[ObjectId]:
+        """Returns the IDs of all tasks that depend on the task, directly or indirectly.
+
+        Every task is visited once, so cycles are harmless. The task itself
+        is only included when it is part of a cycle.
+        """
+        return self._ids(self._reachable(self._children, self._index[task_id]))
+
+    def ancestors(self, task_id: ObjectId) -> typing.List[ObjectId]:
+        """Returns the IDs of all tasks the task depends on, directly or indirectly.
+
+        Every task is visited once, so cycles are harmless. The task itself
+        is only included when it is part of a cycle.
+        """
+        return self._ids(self._reachable(self._parents, self._index[task_id]))
+
+    def topological_order(self) -> typing.List[ObjectId]:
+        """Returns the task IDs ordered such that parents come before their children.
+
+        :raises ValueError: when the graph contains a cycle.
+        """
+
+        in_degree = [self._parents.degree(node) for node in range(len(self))]
+        queue = collections.deque(node for node, degree in enumerate(in_degree) if not degree)
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for child in self._children[node]:
+                in_degree[child] -= 1
+                if not in_degree[child]:
+                    queue.append(child)
+
+        if len(order) != len(self):
+            raise ValueError(f'Task graph of job {self.job_id} contains a cycle')
+        return self._ids(order)
+
+    def _reachable(self, adjacency: _Adjacency, start: int) -> typing.List[int]:
+        """Breadth-first search, returning the nodes reachable from 'start'."""
+
+        visited = bytearray(len(self))
+        found = []
+        queue = collections.deque(adjacency[start])
+        while queue:
+            node = queue.popleft()
+            if visited[node]:
+                continue
+            visited[node] = True
+            found.append(node)
+            queue.extend(adjacency[node])
+        return found
+
+    def _ids(self, nodes: typing.Iterable[int]) -> typing.List[ObjectId]:
+        return [self.task_ids[node] for node in nodes]
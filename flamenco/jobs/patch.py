@@ -131,16 +131,21 @@ class JobPatchHandler(patch_handler.AbstractPatchHandler):
         current_flamenco.job_manager.api_update_rna_overrides(job_id, rna_overrides)
 
     def assert_job_access(self, job_id: bson.ObjectId) -> dict:
-        # TODO: possibly store job and project into flask.g to reduce the nr of Mongo queries.
-        job = current_flamenco.db('jobs').find_one({'_id': job_id},
-                                                   {'project': 1,
-                                                    'status': 1})
-        auth = current_flamenco.auth
+        """Raises an exception when the current user may not use Flamenco on the job.
+
+        :returns: the job document, with only its project and status.
+        """
+        job = current_flamenco.job_manager.job_doc(job_id)
+        if job is None:
+            log.info('User %s wants to PATCH non-existing job %s', current_user_id(), job_id)
+            raise wz_exceptions.NotFound()
 
-        if not auth.current_user_may(auth.Actions.USE, job['project']):
+        project_id = job['project']
+        auth = current_flamenco.auth
+        if not auth.current_user_may(auth.Actions.USE, project_id):
             log.info(
                 'User %s wants to PATCH job %s, but has no right to use Flamenco on project %s',
-                current_user_id(), job_id, job['project'])
+                current_user_id(), job_id, project_id)
             raise wz_exceptions.Forbidden('Denied Flamenco use on this project')
 
         return job
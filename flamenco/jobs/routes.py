@@ -19,6 +19,7 @@ from flamenco.routes import flamenco_project_view
 from flamenco import current_flamenco
 from flamenco.auth import Actions
 from flamenco.job_compilers import blender_render
+from flamenco.jobs.graph import JobGraph
 
 blueprint = Blueprint('flamenco.jobs', __name__, url_prefix='/jobs')
 perproject_blueprint = Blueprint('flamenco.jobs.perproject', __name__,
@@ -32,6 +33,11 @@ blueprint_for_archived = {
 
 log = logging.getLogger(__name__)
 
+# Maximum number of grandchildren shown in the depsgraph view.
+DEPSGRAPH_LIMITED_RESULT_COUNT = 8
+# Number of seconds the task graph of the depsgraph view is cached.
+DEPSGRAPH_DATA_CACHE_TIMEOUT = 300
+
 # The job statuses that can be set from the web-interface.
 ALLOWED_JOB_STATUSES_FROM_WEB = {'cancel-requested', 'queued', 'requeued'}
 
@@ -231,132 +237,125 @@ def view_job_depsgraph_data(project, job_id, focus_task_id=None):
     if not current_user.has_cap('flamenco-view'):
         raise wz_exceptions.Forbidden()
 
-    import collections
     from flask import jsonify
-    from flamenco.tasks import COLOR_FOR_TASK_STATUS
-    from pillar.web.utils import last_page_index
-
-    # Collect tasks page-by-page. Stored in a dict to prevent duplicates.
-    tasks = {}
-
-    LIMITED_RESULT_COUNT = 8
-
-    def query_tasks(extra_where, extra_update, limit_results: bool):
-        page_idx = 1
-        added_in_this_query = 0
-        while True:
-            task_page = current_flamenco.task_manager.tasks_for_job(
-                job_id,
-                page=page_idx,
-                max_results=LIMITED_RESULT_COUNT if limit_results else 250,
-                extra_where=extra_where)
-            for task in task_page._items:
-                if task._id in tasks:
-                    continue
-                task = task.to_dict()
-                task.update(extra_update)
-                tasks[task['_id']] = task
-                added_in_this_query += 1
-
-            if limit_results and added_in_this_query >= LIMITED_RESULT_COUNT:
-                break
-
-            if page_idx >= last_page_index(task_page._meta):
-                break
-            page_idx += 1
+    from pillar.api.utils import str2id
 
-    if focus_task_id is None:
-        # Get the top-level tasks as 'focus tasks'.
-        # TODO: Test for case of multiple top-level tasks.
-        extra_where = {
-            'parents': {'$exists': 0},
-        }
-    else:
-        # Otherwise just put in the focus task ID; querying like this ensures
-        # the returned task belongs to the current job.
-        extra_where = {'_id': focus_task_id}
+    job_oid = str2id(job_id)
+    jobs_coll = current_flamenco.db('jobs')
+    job = jobs_coll.find_one({'_id': job_oid, 'project': bson.ObjectId(project['_id'])},
+                             projection={'_etag': 1, 'tasks_status': 1})
+    if not job:
+        raise wz_exceptions.NotFound()
+
+    # The job's etag doesn't change when its tasks change status, but the
+    # task status counters do.
+    tasks_status = ','.join(f'{status}={count}'
+                            for status, count in sorted(job.get('tasks_status', {}).items()))
+    graph = _cached_job_graph(job_oid, f'{job["_etag"]}/{tasks_status}')
+
+    focus_task_oid = str2id(focus_task_id) if focus_task_id else None
+    return jsonify(**_depsgraph_elements(graph, focus_task_oid))
 
-    log.debug('Querying tasks, focused on %s', extra_where)
-    query_tasks(extra_where, {'_generation': 0}, False)
 
-    # Query for the children & parents of these tasks
-    already_queried_parents = set()
-    already_queried_children = set()
+def _cached_job_graph(job_id: bson.ObjectId, version: str) -> JobGraph:
+    """Returns the dependency graph of the job, loading it only once per job version.
+
+    The graph is shared by all focus tasks, so that looking around in the
+    depsgraph view of a large job doesn't reload all its tasks every time.
+    """
 
-    def add_parents_children(generation: int, is_outside: bool):
-        nonlocal already_queried_parents
-        nonlocal already_queried_children
+    cache_key = f'flamenco.depsgraph-graph/{job_id}/{version}'
+    graph = current_app.cache.get(cache_key)
+    if graph is None:
+        graph = JobGraph.load(job_id)
+        current_app.cache.set(cache_key, graph, timeout=DEPSGRAPH_DATA_CACHE_TIMEOUT)
+    return graph
 
-        if not tasks:
-            return
 
+def _depsgraph_elements(graph: JobGraph, focus_task_id: bson.ObjectId = None) -> dict:
+    """Returns the Cytoscape elements and root nodes for the depsgraph view.
+
+    The graph contains the focus tasks, their parents and children, and their
+    grandparents and (a limited number of) grandchildren.
+    """
+
+    from flamenco.tasks import COLOR_FOR_TASK_STATUS
+
+    if focus_task_id is None:
+        # Get the top-level tasks as 'focus tasks'.
+        focus_task_ids = graph.roots()
+    elif focus_task_id in graph:
+        focus_task_ids = [focus_task_id]
+    else:
+        focus_task_ids = []
+
+    # Maps task ID to its generation, relative to the focus tasks.
+    generations = {task_id: 0 for task_id in focus_task_ids}
+    outside = set()
+
+    def add_tasks(task_ids, generation: int, is_outside: bool, limit_results: bool):
+        ordered = sorted(set(task_ids) - generations.keys(),
+                         key=lambda task_id: (-graph.priority(task_id), task_id))
+        if limit_results:
+            ordered = ordered[:DEPSGRAPH_LIMITED_RESULT_COUNT]
+        for task_id in ordered:
+            generations[task_id] = generation
         if is_outside:
-            extra_update = {'_outside': True}
-        else:
-            extra_update = {}
-
-        parent_ids = {parent
-                      for task in tasks.values()
-                      for parent in task.get('parents', ())}
-
-        # Get the children of these tasks, but only those we haven't queried for already.
-        query_children = set(tasks.keys()) - already_queried_children
-        if query_children:
-            update = {'_generation': generation, **extra_update}
-            query_tasks({'parents': {'$in': list(query_children)}}, update, is_outside)
-            already_queried_children.update(query_children)
-
-        # Get the parents of these tasks, but only those we haven't queried for already.
-        query_parents = parent_ids - already_queried_parents
-        if query_parents:
-            update = {'_generation': -generation, **extra_update}
-            query_tasks({'_id': {'$in': list(query_parents)}}, update, False)
-            already_queried_parents.update(query_parents)
+            outside.update(ordered)
 
     # Add parents/children and grandparents/grandchildren.
-    # This queries too much, but that's ok for now; this is just a debugging tool.
-    log.debug('Querying first-level family')
-    add_parents_children(1, False)
-    log.debug('Querying second-level family')
-    add_parents_children(2, True)
+    for generation, is_outside in ((1, False), (2, True)):
+        task_ids = list(generations)
+        add_tasks((child_id for task_id in task_ids for child_id in graph.children(task_id)),
+                  generation, is_outside, is_outside)
+        add_tasks((parent_id for task_id in task_ids for parent_id in graph.parents(task_id)),
+                  -generation, is_outside, False)
+
+    tasks_coll = current_flamenco.db('tasks')
+    names = {task['_id']: task.get('name', '')
+             for task in tasks_coll.find({'_id': {'$in': list(generations)}},
+                                         projection={'name': 1})}
 
     # nodes and edges are only told apart by (not) having 'source' and 'target' properties.
     graph_items = []
     roots = []
     xpos_per_generation = collections.defaultdict(int)
-    for task in sorted(tasks.values(), key=lambda task: task['priority']):
-        gen = task['_generation']
+    for task_id in sorted(generations, key=graph.priority):
+        gen = generations[task_id]
         xpos = xpos_per_generation[gen]
         xpos_per_generation[gen] += 1
 
+        status = graph.status(task_id)
         graph_items.append({
             'group': 'nodes',
             'data': {
-                'id': task['_id'],
-                'label': task['name'],
-                'status': task['status'],
-                'color': COLOR_FOR_TASK_STATUS[task['status']],
-                'outside': task.get('_outside', False),
-                'focus': task['_id'] == focus_task_id,
+                'id': str(task_id),
+                'label': names.get(task_id, ''),
+                'status': status,
+                'color': COLOR_FOR_TASK_STATUS[status],
+                'outside': task_id in outside,
+                'focus': task_id == focus_task_id,
             },
             'position': {'x': xpos * 100, 'y': gen * -100},
         })
-        if task.get('parents'):
-            for parent in task['parents']:
-                # Skip edges to tasks that aren't even in the graph.
-                if parent not in tasks: continue
-
-                graph_items.append({
-                    'group': 'edges',
-                    'data': {
-                        'id': '%s-%s' % (task['_id'], parent),
-                        'target': task['_id'],
-                        'source': parent,
-                    }
-                })
-        else:
-            roots.append(task['_id'])
-    return jsonify(elements=graph_items, roots=roots)
+
+        parent_ids = graph.parents(task_id)
+        if not parent_ids:
+            roots.append(str(task_id))
+        for parent_id in parent_ids:
+            # Skip edges to tasks that aren't even in the graph.
+            if parent_id not in generations:
+                continue
+
+            graph_items.append({
+                'group': 'edges',
+                'data': {
+                    'id': '%s-%s' % (task_id, parent_id),
+                    'target': str(task_id),
+                    'source': str(parent_id),
+                }
+            })
+    return {'elements': graph_items, 'roots': roots}
 
 
 @perproject_blueprint.route('/<job_id>/recreate', methods=['POST'])
@@ -18,7 +18,8 @@ from pillar import attrs_extra, current_app
 from pillar.auth import current_user
 from pillar.api.utils import utcnow, random_etag
 
-from flamenco import current_flamenco
+from flamenco import current_flamenco, request_cache
+from flamenco.managers.auth_cache import ManagerAuthCache
 
 
 @attr.s
@@ -43,6 +44,8 @@ class ManagerManager(object):
     _log = attrs_extra.log('%s.ManagerManager' % __name__)
     ShareAction = ShareAction  # so you can use current_flamenco.manager_manager.ShareAction
 
+    auth_cache: ManagerAuthCache = attr.ib(default=attr.Factory(ManagerAuthCache))
+
     def collection(self) -> pymongo.collection.Collection:
         """Returns the Mongo database collection."""
         from flamenco import current_flamenco
@@ -131,17 +134,25 @@ class ManagerManager(object):
         return user_matches_roles(require_roles={'service', 'flamenco_manager'},
                                   require_all=True)
 
+    def manager_doc(self, manager_id: bson.ObjectId) -> typing.Optional[dict]:
+        """Returns the Manager document, or None if it does not exist.
+
+        The document is cached for the duration of the current request.
+        """
+
+        mngr_coll = current_flamenco.db('managers')
+        return request_cache.cache('managers').get(
+            manager_id, lambda: mngr_coll.find_one({'_id': manager_id}))
+
     def _get_manager(self,
                      mngr_doc_id: bson.ObjectId = None,
-                     mngr_doc: dict = None,
-                     projection: dict = None) -> typing.Tuple[bson.ObjectId, dict]:
+                     mngr_doc: dict = None) -> typing.Tuple[bson.ObjectId, dict]:
 
         assert (mngr_doc_id is None) != (mngr_doc is None), \
             'Either one or the other parameter must be given.'
 
         if mngr_doc is None:
-            mngr_coll = current_flamenco.db('managers')
-            mngr_doc = mngr_coll.find_one({'_id': mngr_doc_id}, projection)
+            mngr_doc = self.manager_doc(mngr_doc_id)
             if not mngr_doc:
                 self._log.warning('user_manages(%s): no such document (user=%s)',
                                   mngr_doc_id, current_user.user_id)
@@ -168,7 +179,7 @@ class ManagerManager(object):
             self._log.debug('user_is_owner(...): user %s does not have flamenco-use cap', user_id)
             return False
 
-        mngr_doc_id, mngr_doc = self._get_manager(mngr_doc_id, mngr_doc, {'owner': 1})
+        mngr_doc_id, mngr_doc = self._get_manager(mngr_doc_id, mngr_doc)
 
         owner_group = mngr_doc.get('owner')
         if not owner_group:
@@ -187,16 +198,21 @@ class ManagerManager(object):
             # User is not a Flamenco manager service account.
             return False
 
-        mngr_doc_id, mngr_doc = self._get_manager(mngr_doc_id, mngr_doc, {'service_account': 1})
+        user_id = current_user.user_id
+        if mngr_doc is None:
+            cached = self.auth_cache.get(user_id, mngr_doc_id)
+            if cached is not None:
+                return cached
+
+        mngr_doc_id, mngr_doc = self._get_manager(mngr_doc_id, mngr_doc)
 
         service_account = mngr_doc.get('service_account')
-        user_id = current_user.user_id
-        if service_account != user_id:
+        manages = service_account == user_id
+        self.auth_cache.put(user_id, mngr_doc_id, manages)
+        if not manages:
             self._log.debug('user_manages(%s): current user %s is not manager %s',
                             mngr_doc_id, user_id, service_account)
-            return False
-
-        return True
+        return manages
 
     def user_may_use(self, *, mngr_doc_id: bson.ObjectId = None, mngr_doc: dict = None) -> bool:
         """Returns True iff this user may use this Flamenco Manager.
@@ -209,8 +225,7 @@ class ManagerManager(object):
         if current_flamenco.auth.current_user_is_flamenco_admin():
             return True
 
-        mngr_doc_id, mngr_doc = self._get_manager(mngr_doc_id, mngr_doc,
-                                                  {'owner': 1, 'user_groups': 1})
+        mngr_doc_id, mngr_doc = self._get_manager(mngr_doc_id, mngr_doc)
 
         user_groups = set(current_user.group_ids)
         owner_group = mngr_doc.get('owner')
@@ -292,6 +307,9 @@ class ManagerManager(object):
             update['$unset']['user_groups'] = 1
 
         res: UpdateResult = mngr_coll.update_one({'_id': manager_id}, update)
+        request_cache.invalidate('managers', manager_id)
+        request_cache.invalidate('project_manager_counts', project_id)
+        self.auth_cache.invalidate_manager(manager_id)
 
         if res.matched_count < 1:
             self._log.error('Unable to update projects on Manager %s to %s: %s',
@@ -302,8 +320,7 @@ class ManagerManager(object):
         return True
 
     def find_service_account_id(self, manager_id: bson.ObjectId) -> bson.ObjectId:
-        _, manager = self._get_manager(mngr_doc_id=manager_id,
-                                       projection={'service_account': 1})
+        _, manager = self._get_manager(mngr_doc_id=manager_id)
         users_coll = current_app.db('users')
         service_account_id = manager['service_account']
         service_account = users_coll.find_one({'_id': service_account_id,
@@ -338,6 +355,7 @@ class ManagerManager(object):
 
         tokens_coll = current_app.db('tokens')
         result: pymongo.results.DeleteResult = tokens_coll.delete_many({'user': service_account_id})
+        self.auth_cache.invalidate_manager(manager_id)
 
         self._log.debug('Deleted %i authentication tokens of Manager %s',
                         result.deleted_count, manager_id)
@@ -386,6 +404,7 @@ class ManagerManager(object):
         }[share_action]
 
         users.user_group_action(subject_uid, owner_gid, group_action)
+        self.auth_cache.invalidate_manager(manager_id)
 
     def owning_users(self, owner_gid: bson.ObjectId) -> typing.List[dict]:
         assert isinstance(owner_gid, bson.ObjectId)
@@ -460,6 +479,7 @@ class ManagerManager(object):
                     '_etag': random_etag(),
                 },
             })
+        request_cache.invalidate('managers', manager_id)
 
 
 def setup_app(app):
@@ -1,4 +1,6 @@
+import collections
 import logging
+import typing
 
 from bson import ObjectId
 from flask import Blueprint, request, url_for
@@ -8,7 +10,7 @@ import werkzeug.datastructures
 from pillar import current_app
 from pillar.api.utils import authorization, authentication, utcnow, random_etag, str2id, jsonify
 
-from flamenco import current_flamenco
+from flamenco import current_flamenco, request_cache
 
 api_blueprint = Blueprint('flamenco.managers.api', __name__)
 log = logging.getLogger(__name__)
@@ -21,6 +23,9 @@ DEPSGRAPH_RUNNABLE_JOB_STATUSES = ['queued', 'active', 'cancel-requested', 'soft
 DEPSGRAPH_CLEAN_SLATE_TASK_STATUSES = ['queued', 'claimed-by-manager',
                                        'active', 'cancel-requested', 'soft-failed']
 DEPSGRAPH_MODIFIED_SINCE_TASK_STATUSES = ['queued', 'claimed-by-manager', 'soft-failed']
+DEPSGRAPH_CURSOR_PREFIX = 'seq1-'  # Prefix of the opaque depsgraph cursor, for versioning.
+DEPSGRAPH_CONTINUATION_PREFIX = 'page1-'  # Same, but for the depsgraph continuation token.
+DEPSGRAPH_STREAM_CHUNK_SIZE = 500  # Number of tasks per chunk of a streamed depsgraph.
 
 # Number of lines of logging to keep on the task itself.
 LOG_TAIL_LINES = 10
@@ -44,17 +49,26 @@ def manager_api_call(*args, pass_manager_doc=False):
                                      require_all=True)
         @functools.wraps(wrapped)
         def wrapper(manager_id, *args, **kwargs):
-            from pillar.api.utils import mongo
-
             manager_id = str2id(manager_id)
-            manager = mongo.find_one_or_404('flamenco_managers', manager_id)
-            if not current_flamenco.manager_manager.user_manages(mngr_doc=manager):
+            man_man = current_flamenco.manager_manager
+            try:
+                manages = man_man.user_manages(mngr_doc_id=manager_id)
+            except ValueError:
+                raise wz_exceptions.NotFound()
+            if not manages:
                 user_id = authentication.current_user_id()
                 log.warning(
                     'Service account %s called manager API endpoint for manager %s of another '
                     'service account', user_id, manager_id)
                 raise wz_exceptions.Unauthorized()
 
+            if pass_manager_doc:
+                # The authorisation check may have been answered from the cache,
+                # so the Manager may have been deleted in the mean time.
+                manager = man_man.manager_doc(manager_id)
+                if manager is None:
+                    raise wz_exceptions.NotFound()
+
             return wrapped(manager if pass_manager_doc else manager_id,
                            request.json,
                            *args, **kwargs)
@@ -121,6 +135,7 @@ def handle_notification(manager_id: str, notification: dict):
         updates['$unset'] = updates_unset
 
     update_res = mngr_coll.update_one({'_id': manager_id}, updates)
+    request_cache.invalidate('managers', manager_id)
     if update_res.matched_count != 1:
         log.warning('Updating manager %s matched %i documents.',
                     manager_id, update_res.matched_count)
@@ -173,6 +188,11 @@ def handle_task_update_batch(manager_id, task_updates):
     task ID is contained in 'tasks_to_cancel'; in that case only a transition to either
     'canceled', 'completed' or 'failed' is accepted.
 
+    All tasks referenced by the batch are fetched with a single query, and the task
+    modifications and log entries are written with one bulk write each. Multiple
+    updates for the same task are merged into a single write, in the order in which
+    they were received.
+
     :returns: tuple (total nr of modified tasks, handled update IDs)
     """
 
@@ -180,6 +200,7 @@ def handle_task_update_batch(manager_id, task_updates):
         return 0, []
 
     import dateutil.parser
+    import pymongo
     from pillar.api.utils import str2id
 
     from flamenco import current_flamenco, eve_settings
@@ -191,14 +212,28 @@ def handle_task_update_batch(manager_id, task_updates):
 
     valid_statuses = set(eve_settings.tasks_schema['status']['allowed'])
     handled_update_ids = []
-    total_modif_count = 0
+
+    # Fetch all the tasks this batch refers to in one query.
+    batch_task_ids = list({str2id(task_update['task_id']) for task_update in task_updates})
+    task_infos = {
+        task_info['_id']: task_info
+        for task_info in tasks_coll.find({'_id': {'$in': batch_task_ids}},
+                                         projection={'manager': 1, 'status': 1, 'job': 1})
+    }
+
+    original_statuses = {task_id: task_info['status'] for task_id, task_info in task_infos.items()}
+
+    # Mapping from task ID to the fields to $set on that task. Updates for the same task
+    # are merged, so that the unordered bulk write never has to apply them in order.
+    task_modifications: typing.Dict[ObjectId, dict] = {}
+    log_operations = []
+    status_changes = []  # list of (job ID, task ID, new task status) tuples.
 
     for task_update in task_updates:
         # Check that this task actually belongs to this manager, before we accept any updates.
         update_id = str2id(task_update['_id'])
         task_id = str2id(task_update['task_id'])
-        task_info = tasks_coll.find_one({'_id': task_id},
-                                        projection={'manager': 1, 'status': 1, 'job': 1})
+        task_info = task_infos.get(task_id)
 
         # For now, we just ignore updates to non-existing tasks. Someone might have just deleted
         # one, for example. This is not a reason to reject the entire batch.
@@ -229,10 +264,11 @@ def handle_task_update_batch(manager_id, task_updates):
             log_doc = {
                 '_id': update_id,
                 'task': task_id,
+                'job': task_info['job'],
                 'received_on_manager': received_on_manager,
                 'log': task_log
             }
-            logs_coll.replace_one({'_id': update_id}, log_doc, upsert=True)
+            log_operations.append(pymongo.ReplaceOne({'_id': update_id}, log_doc, upsert=True))
 
         # Modify the task, and append the log to the logs collection.
         updates = {
@@ -247,6 +283,9 @@ def handle_task_update_batch(manager_id, task_updates):
                                                task_update.get('task_status'), valid_statuses)
         if new_status:
             updates['status'] = new_status
+            # Subsequent updates of this task in the same batch should see the new status.
+            task_info['status'] = new_status
+            status_changes.append((task_info['job'], task_id, new_status))
 
         new_activity = task_update.get('activity')
         if new_activity:
@@ -269,19 +308,118 @@ def handle_task_update_batch(manager_id, task_updates):
         if task_log_tail:
             updates['log'] = task_log_tail
 
-        result = tasks_coll.update_one({'_id': task_id}, {'$set': updates})
-        total_modif_count += result.modified_count
-
+        task_modifications.setdefault(task_id, {}).update(updates)
         handled_update_ids.append(update_id)
 
-        # Update the task's job after updating the task itself.
-        if new_status:
-            current_flamenco.job_manager.update_job_after_task_status_change(
-                task_info['job'], task_id, new_status)
+    if log_operations:
+        logs_coll.bulk_write(log_operations, ordered=False)
+
+    total_modif_count = 0
+    # Mapping from task ID to its (old status, new status) tuple, for those tasks
+    # whose status was changed by someone else between fetching and updating them.
+    conflict_transitions: typing.Dict[ObjectId, typing.Tuple[str, str]] = {}
+    if task_modifications:
+        with current_flamenco.task_manager.allocate_change_seq() as change_seq:
+            requests = []
+            for task_id, updates in task_modifications.items():
+                query = {'_id': task_id}
+                if 'status' in updates:
+                    # Only change the status when it is still the one the counters are
+                    # based on; concurrent status changes are handled below.
+                    query['status'] = original_statuses[task_id]
+                requests.append(pymongo.UpdateOne(
+                    query, {'$set': {**updates, 'change_seq': change_seq}}))
+            result = tasks_coll.bulk_write(requests, ordered=False)
+            total_modif_count = result.modified_count
+
+            if result.matched_count < len(requests):
+                # Those tasks were not updated, so they still have an older change_seq.
+                status_task_ids = [task_id for task_id, updates in task_modifications.items()
+                                   if 'status' in updates]
+                conflicting_tasks = tasks_coll.find(
+                    {'_id': {'$in': status_task_ids}, 'change_seq': {'$ne': change_seq}},
+                    projection={'_id': 1})
+                for task in conflicting_tasks:
+                    task_id = task['_id']
+                    updates = {**task_modifications[task_id], 'change_seq': change_seq}
+                    transition = update_task_after_status_conflict(manager_id, task_id, updates)
+                    if transition is None:
+                        continue
+                    conflict_transitions[task_id] = transition
+                    total_modif_count += 1
+
+    # Maintain the task status counters of the jobs, based on the status each task had
+    # before this batch and the status it has now.
+    count_deltas = collections.defaultdict(collections.Counter)
+    for task_id, old_status in original_statuses.items():
+        task_info = task_infos[task_id]
+        old_status, new_status = conflict_transitions.get(
+            task_id, (old_status, task_info['status']))
+        if new_status == old_status:
+            continue
+        count_deltas[task_info['job']][old_status] -= 1
+        count_deltas[task_info['job']][new_status] += 1
+    current_flamenco.job_manager.update_task_status_counts(count_deltas)
+
+    # Status changes that were refused after a concurrent status change did not happen.
+    refused_task_ids = {task_id for task_id, (old_status, new_status)
+                        in conflict_transitions.items() if old_status == new_status}
+    status_changes = [change for change in status_changes if change[1] not in refused_task_ids]
+
+    # Update the tasks' jobs after updating the tasks themselves. Each job is
+    # re-evaluated once for the entire batch.
+    current_flamenco.job_manager.update_jobs_after_task_status_changes(status_changes)
 
     return total_modif_count, handled_update_ids
 
 
+def update_task_after_status_conflict(manager_id: ObjectId, task_id: ObjectId,
+                                      updates: dict) -> typing.Optional[typing.Tuple[str, str]]:
+    """Updates a task whose status was changed by someone else during a task update batch.
+
+    The status in the updates is only applied when the task's current status
+    allows it; the other updates are always applied.
+
+    :returns: tuple (old status, new status) of the task, or None if the task
+        no longer exists.
+    """
+
+    import pymongo
+
+    from flamenco import current_flamenco
+
+    tasks_coll = current_flamenco.db('tasks')
+    new_status = updates['status']
+
+    # This is the filter equivalent of determine_new_task_status().
+    refused_statuses = [new_status]
+    if new_status not in ACCEPTED_AFTER_CANCEL_REQUESTED:
+        refused_statuses.append('cancel-requested')
+
+    task = tasks_coll.find_one_and_update(
+        {'_id': task_id, 'status': {'$nin': refused_statuses}},
+        {'$set': updates},
+        projection={'status': 1},
+        return_document=pymongo.ReturnDocument.BEFORE)
+    if task is not None:
+        log.info('Task %s of manager %s changed status to %r concurrently, setting it to %r',
+                 task_id, manager_id, task['status'], new_status)
+        return task['status'], new_status
+
+    # The task's status does not allow the new status, so keep it and only apply the rest.
+    other_updates = {key: value for key, value in updates.items() if key != 'status'}
+    task = tasks_coll.find_one_and_update(
+        {'_id': task_id},
+        {'$set': other_updates},
+        projection={'status': 1},
+        return_document=pymongo.ReturnDocument.AFTER)
+    if task is None:
+        return None
+    log.info('Manager %s wants to set task %s to status %r, but that is not allowed '
+             'because the task is in status %s', manager_id, task_id, new_status, task['status'])
+    return task['status'], task['status']
+
+
 def determine_new_task_status(manager_id, task_id, current_task_info, new_status, valid_statuses):
     """Returns the new task status, or None if the task should not get a new status."""
 
@@ -327,94 +465,334 @@ def tasks_cancel_requested(manager_id):
     return task_ids
 
 
-@api_blueprint.route('/<manager_id>/depsgraph')
-@manager_api_call()
-def get_depsgraph(manager_id, request_json):
-    """Returns the dependency graph of all tasks assigned to the given Manager.
+def encode_depsgraph_cursor(change_seq: int) -> str:
+    """Returns the opaque depsgraph cursor for the given task change sequence number."""
+    return f'{DEPSGRAPH_CURSOR_PREFIX}{change_seq:x}'
+
+
+def decode_depsgraph_cursor(cursor: str) -> int:
+    """Returns the task change sequence number encoded in the depsgraph cursor.
 
-    Use the HTTP header X-Flamenco-If-Updated-Since to limit the dependency
-    graph to tasks that have been modified since that timestamp.
+    :raises werkzeug.exceptions.BadRequest: when the cursor is invalid.
     """
+    if not cursor.startswith(DEPSGRAPH_CURSOR_PREFIX):
+        raise wz_exceptions.BadRequest(f'Invalid depsgraph cursor {cursor!r}')
+    try:
+        return int(cursor[len(DEPSGRAPH_CURSOR_PREFIX):], 16)
+    except ValueError:
+        raise wz_exceptions.BadRequest(f'Invalid depsgraph cursor {cursor!r}')
 
-    import dateutil.parser
-    from pillar.api.utils import jsonify, bsonify
-    from flamenco import current_flamenco
-    from flamenco.utils import report_duration
 
-    modified_since = request.headers.get('X-Flamenco-If-Updated-Since')
+def encode_depsgraph_continuation(after_task_id: ObjectId, change_seq: int) -> str:
+    """Returns the opaque continuation token for the next depsgraph page.
 
-    with report_duration(log, 'depsgraph query'):
-        tasks_coll = current_flamenco.db('tasks')
-        jobs_coll = current_flamenco.db('jobs')
+    The change sequence number of the first page is included, so that every
+    page returns the same depsgraph cursor.
+    """
+    return f'{DEPSGRAPH_CONTINUATION_PREFIX}{after_task_id}-{change_seq:x}'
 
-        # Get runnable jobs first, as non-runnable jobs are not interesting.
-        # Note that jobs going from runnable to non-runnable should have their
-        # tasks set to cancel-requested, which is communicated to the Manager
-        # through a different channel.
-        jobs = jobs_coll.find({
+
+def decode_depsgraph_continuation(continuation: str) -> typing.Tuple[ObjectId, int]:
+    """Returns the (task ID, change sequence number) encoded in the continuation token.
+
+    :raises werkzeug.exceptions.BadRequest: when the continuation token is invalid.
+    """
+    if continuation.startswith(DEPSGRAPH_CONTINUATION_PREFIX):
+        after_task_id, _, change_seq = \
+            continuation[len(DEPSGRAPH_CONTINUATION_PREFIX):].partition('-')
+        if ObjectId.is_valid(after_task_id):
+            try:
+                return ObjectId(after_task_id), int(change_seq, 16)
+            except ValueError:
+                pass
+    raise wz_exceptions.BadRequest(f'Invalid depsgraph continuation token {continuation!r}')
+
+
+def depsgraph_page_size() -> typing.Optional[int]:
+    """Returns the 'page_size' request parameter, or None if not given.
+
+    :raises werkzeug.exceptions.BadRequest: when the page size is not a positive integer.
+    """
+    page_size = request.args.get('page_size')
+    if not page_size:
+        return None
+    try:
+        page_size = int(page_size)
+    except ValueError:
+        page_size = 0
+    if page_size < 1:
+        raise wz_exceptions.BadRequest('page_size must be a positive integer')
+    return page_size
+
+
+def depsgraph_task_query(manager_id: ObjectId,
+                         since_change_seq: typing.Optional[int],
+                         modified_since: typing.Optional[str]) -> typing.Optional[dict]:
+    """Returns the query for the depsgraph tasks of this Manager.
+
+    :returns: the query, or None when the Manager has no runnable jobs (with changed tasks).
+    """
+
+    import dateutil.parser
+
+    tasks_coll = current_flamenco.db('tasks')
+    jobs_coll = current_flamenco.db('jobs')
+
+    if since_change_seq is not None:
+        # Incremental query, served by the (manager, change_seq) index. Only tasks
+        # of runnable jobs are interesting, which is checked for only the jobs of
+        # the changed tasks.
+        log.debug('Querying all tasks changed since change sequence %d', since_change_seq)
+        task_query = {
             'manager': manager_id,
+            'change_seq': {'$gt': since_change_seq},
+            'status': {'$in': DEPSGRAPH_MODIFIED_SINCE_TASK_STATUSES},
+        }
+        changed_job_ids = tasks_coll.distinct('job', task_query)
+        if not changed_job_ids:
+            return None
+        jobs = jobs_coll.find({
+            '_id': {'$in': changed_job_ids},
             'status': {'$in': DEPSGRAPH_RUNNABLE_JOB_STATUSES}},
             projection={'_id': 1},
         )
         job_ids = [job['_id'] for job in jobs]
         if not job_ids:
-            log.debug('Returning empty depsgraph')
-            return '', 204  # empty response
+            return None
+        task_query['job'] = {'$in': job_ids}
+        return task_query
+
+    # Get runnable jobs first, as non-runnable jobs are not interesting.
+    # Note that jobs going from runnable to non-runnable should have their
+    # tasks set to cancel-requested, which is communicated to the Manager
+    # through a different channel.
+    jobs = jobs_coll.find({
+        'manager': manager_id,
+        'status': {'$in': DEPSGRAPH_RUNNABLE_JOB_STATUSES}},
+        projection={'_id': 1},
+    )
+    job_ids = [job['_id'] for job in jobs]
+    if not job_ids:
+        return None
 
-        log.debug('Requiring jobs to be in %s', job_ids)
-        task_query = {
-            'manager': manager_id,
-            'status': {'$nin': ['active']},
-            'job': {'$in': job_ids},
-        }
+    log.debug('Requiring jobs to be in %s', job_ids)
+    task_query = {
+        'manager': manager_id,
+        'status': {'$nin': ['active']},
+        'job': {'$in': job_ids},
+    }
 
-        if modified_since is None:
-            # "Clean slate" query.
-            task_query['status'] = {'$in': DEPSGRAPH_CLEAN_SLATE_TASK_STATUSES}
-        else:
-            # Not clean slate, just give all updated tasks assigned to this manager.
-            log.debug('Modified-since header: %s', modified_since)
-            modified_since = dateutil.parser.parse(modified_since)
-            task_query['_updated'] = {'$gt': modified_since}
-            task_query['status'] = {'$in': DEPSGRAPH_MODIFIED_SINCE_TASK_STATUSES}
-            log.debug('Querying all tasks changed since %s', modified_since)
+    if modified_since is None:
+        # "Clean slate" query.
+        task_query['status'] = {'$in': DEPSGRAPH_CLEAN_SLATE_TASK_STATUSES}
+    else:
+        # Not clean slate, just give all updated tasks assigned to this manager.
+        log.debug('Modified-since header: %s', modified_since)
+        modified_since = dateutil.parser.parse(modified_since)
+        task_query['_updated'] = {'$gt': modified_since}
+        task_query['status'] = {'$in': DEPSGRAPH_MODIFIED_SINCE_TASK_STATUSES}
+        log.debug('Querying all tasks changed since %s', modified_since)
 
-        cursor = tasks_coll.find(task_query)
-        depsgraph = list(cursor)
+    return task_query
 
-    if len(depsgraph) == 0:
-        log.debug('Returning empty depsgraph')
-        if modified_since is not None:
-            return '', 304  # Not Modified
-    else:
-        log.info('Returning depsgraph of %i tasks', len(depsgraph))
 
-    # Update the task status in the database to move queued tasks to claimed-by-manager.
-    # This also erases the link to any previously uploaded log files, to ensure the
-    # log is fresh and represents the current execution of the task.
-    task_query['status'] = 'queued'
-    tasks_coll.update_many(task_query, {
-        '$set': {'status': 'claimed-by-manager'},
+def claim_depsgraph_tasks(task_query: dict) -> dict:
+    """Moves the queued tasks matching the depsgraph query to claimed-by-manager.
+
+    This also erases the link to any previously uploaded log files, to ensure the
+    log is fresh and represents the current execution of the task.
+    The change sequence number is left untouched, as the Manager gets the new
+    status in the depsgraph response.
+
+    The claimed tasks are stamped with a claim token, which is used to count them
+    per job and removed again afterwards. This takes the same number of queries
+    regardless of the number of claimed tasks.
+
+    :returns: the query to read the depsgraph tasks with. It matches the claimed
+        tasks and the non-queued tasks matched by task_query, but not tasks that
+        were queued after they were claimed; those are left for the next request.
+    """
+
+    tasks_coll = current_flamenco.db('tasks')
+    claim_token = ObjectId()
+    result = tasks_coll.update_many({**task_query, 'status': 'queued'}, {
+        '$set': {'status': 'claimed-by-manager',
+                 'claim_token': claim_token},
         '$unset': {'log_file': True},
     })
 
-    # Update the returned task statuses. Unfortunately Mongo doesn't support
-    # find_and_modify() on multiple documents.
-    for task in depsgraph:
-        if task['status'] == 'queued':
-            task['status'] = 'claimed-by-manager'
+    if result.modified_count:
+        log.debug('Claimed %d tasks with claim token %s', result.modified_count, claim_token)
+        claimed_per_job = tasks_coll.aggregate([
+            {'$match': {'claim_token': claim_token}},
+            {'$group': {'_id': '$job', 'count': {'$sum': 1}}},
+        ])
+        current_flamenco.job_manager.update_task_status_counts({
+            job_count['_id']: {'queued': -job_count['count'],
+                               'claimed-by-manager': job_count['count']}
+            for job_count in claimed_per_job
+        })
+        # Only keep tokens of claims that are being counted in the sparse index.
+        tasks_coll.update_many({'claim_token': claim_token},
+                               {'$unset': {'claim_token': True}})
+
+    statuses = [status for status in task_query['status']['$in'] if status != 'queued']
+    return {**task_query, 'status': {'$in': statuses}}
+
+
+def stream_depsgraph(tasks: typing.Iterable[dict]) -> typing.Iterator[str]:
+    """Generator, yields the depsgraph response document as JSON in chunks."""
+
+    from pillar.api.utils import dumps
+
+    yield '{"depsgraph": ['
+    separator = ''
+    chunk = []
+    for task in tasks:
+        chunk.append(separator + dumps(task))
+        separator = ', '
+        if len(chunk) >= DEPSGRAPH_STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk.clear()
+    yield ''.join(chunk) + ']}'
 
-    # Must be a dict to convert to BSON.
-    respdoc = {
-        'depsgraph': depsgraph,
-    }
-    if request.accept_mimetypes.best == 'application/bson':
-        resp = bsonify(respdoc)
+
+@api_blueprint.route('/<manager_id>/depsgraph')
+@manager_api_call()
+def get_depsgraph(manager_id, request_json):
+    """Returns the dependency graph of all tasks assigned to the given Manager.
+
+    Use the HTTP header X-Flamenco-Depsgraph-Cursor to limit the dependency
+    graph to tasks that have been modified since the response that returned
+    that cursor. Every response includes the cursor for the next request. The
+    cursor only covers task writes that had completed when the request started,
+    so tasks that were being written at that time may be returned again by the
+    next request, but no changed task is ever skipped.
+
+    The HTTP header X-Flamenco-If-Updated-Since, which limits the dependency graph
+    to tasks that have been modified since that timestamp, is still supported for
+    older Managers.
+
+    Use the 'page_size' request parameter to limit the number of returned tasks.
+    When there may be more tasks, the X-Flamenco-Depsgraph-Continuation header
+    contains the token to pass as 'continuation' request parameter, together with
+    the same other headers and parameters, to get the next page.
+
+    Use the 'stream' request parameter to have the JSON response written while
+    the tasks are read from the database. BSON responses are never streamed.
+
+    Managers that accept the flamenco.managers.compact_depsgraph.MIMETYPE type get
+    only the task fields needed for scheduling, in a compact columnar document.
+    """
+
+    import pymongo
+    from pillar.api.utils import jsonify, bsonify, dumps
+    from flamenco.utils import report_duration
+    from . import compact_depsgraph
+
+    cursor_header = request.headers.get('X-Flamenco-Depsgraph-Cursor')
+    modified_since = request.headers.get('X-Flamenco-If-Updated-Since')
+    since_change_seq = decode_depsgraph_cursor(cursor_header) if cursor_header else None
+    not_modified_status = 304 if modified_since is not None or since_change_seq is not None \
+        else None
+
+    page_size = depsgraph_page_size()
+    continuation = request.args.get('continuation')
+    mimetype = request.accept_mimetypes.best
+    use_bson = mimetype == 'application/bson'
+    use_compact = mimetype == compact_depsgraph.MIMETYPE
+    stream = request.args.get('stream', '').lower() in {'1', 'true', 'yes'} \
+        and not (use_bson or use_compact)
+
+    def depsgraph_response(depsgraph: typing.List[dict]):
+        if use_compact:
+            return current_app.response_class(dumps(compact_depsgraph.encode(depsgraph)),
+                                              mimetype=compact_depsgraph.MIMETYPE)
+        # Must be a dict to convert to BSON.
+        respdoc = {
+            'depsgraph': depsgraph,
+        }
+        if use_bson:
+            return bsonify(respdoc)
+        return jsonify(respdoc)
+
+    if continuation:
+        after_task_id, change_seq = decode_depsgraph_continuation(continuation)
     else:
-        resp = jsonify(respdoc)
+        after_task_id = None
+        # All writes up to this change sequence number have completed before the tasks
+        # are queried below, so they are included in this response or were included in
+        # an earlier one. Tasks with a higher number may be returned again next time.
+        change_seq = current_flamenco.task_manager.committed_change_seq()
+        if since_change_seq is not None:
+            change_seq = max(change_seq, since_change_seq)
+    headers = {'X-Flamenco-Depsgraph-Cursor': encode_depsgraph_cursor(change_seq)}
 
-    if depsgraph:
+    with report_duration(log, 'depsgraph query'):
+        tasks_coll = current_flamenco.db('tasks')
+
+        task_query = depsgraph_task_query(manager_id, since_change_seq, modified_since)
+        if task_query is None:
+            log.debug('Returning empty depsgraph')
+            if since_change_seq is not None:
+                return '', 304, headers  # Not Modified
+            return '', 204, headers  # empty response
+
+        if after_task_id is not None:
+            task_query['_id'] = {'$gt': after_task_id}
+        sort = None
+        if page_size:
+            # Pages are in task ID order; find the last task ID of this page.
+            sort = [('_id', pymongo.ASCENDING)]
+            last_in_page = list(tasks_coll.find(task_query, projection={'_id': 1}, sort=sort)
+                                .skip(page_size - 1).limit(1))
+            if last_in_page:
+                last_task_id = last_in_page[0]['_id']
+                task_query['_id'] = {**task_query.get('_id', {}), '$lte': last_task_id}
+                headers['X-Flamenco-Depsgraph-Continuation'] = \
+                    encode_depsgraph_continuation(last_task_id, change_seq)
+
+        # Claim the queued tasks before reading them, so that exactly the claimed
+        # tasks are returned.
+        read_query = claim_depsgraph_tasks(task_query)
+        if use_compact:
+            projection = compact_depsgraph.PROJECTION
+        else:
+            # Tasks that are being claimed by a concurrent request still have a token,
+            # which doesn't have to be sent to the Manager.
+            projection = {'claim_token': False}
+
+        if stream:
+            last_updated_task = tasks_coll.find_one(read_query, projection={'_updated': 1},
+                                                    sort=[('_updated', pymongo.DESCENDING)])
+            if last_updated_task is None:
+                depsgraph = []
+            else:
+                cursor = tasks_coll.find(read_query, projection=projection, sort=sort,
+                                         batch_size=DEPSGRAPH_STREAM_CHUNK_SIZE)
+        else:
+            cursor = tasks_coll.find(read_query, projection=projection, sort=sort)
+            depsgraph = list(cursor)
+
+    if stream and last_updated_task is not None:
+        log.info('Streaming depsgraph')
+        resp = current_app.response_class(stream_depsgraph(cursor),
+                                          mimetype='application/json')
+        last_modification = last_updated_task['_updated']
+    elif len(depsgraph) == 0:
+        log.debug('Returning empty depsgraph')
+        if not_modified_status:
+            return '', not_modified_status, headers  # Not Modified
+        resp = depsgraph_response([])
+        last_modification = None
+    else:
+        log.info('Returning depsgraph of %i tasks', len(depsgraph))
+
+        resp = depsgraph_response(depsgraph)
         last_modification = max(task['_updated'] for task in depsgraph)
+
+    resp.headers.extend(headers)
+    if last_modification:
         log.debug('Last modification was %s', last_modification)
         # We need a format that can handle sub-second precision, which is not provided by the
         # HTTP date format (RFC 1123). This means that we can't use the Last-Modified header, as
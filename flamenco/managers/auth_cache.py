@@ -0,0 +1,119 @@
+"""Process-wide cache of Manager authorisation.
+
+Managers call the Manager API every few seconds, and every call checks that
+the service account making it actually belongs to the Manager. The outcome of
+that check only changes when authentication tokens are (re)generated or the
+Manager changes hands, so it is cached here for a short while.
+"""
+
+import collections
+import datetime
+import threading
+import time
+import typing
+
+import attr
+import bson
+
+from pillar import attrs_extra
+
+CacheKey = typing.Tuple[bson.ObjectId, bson.ObjectId]  # (service account ID, manager ID)
+
+# Log the cache statistics after this many lookups, or at the first lookup after
+# STATS_LOG_PERIOD, so that servers with little traffic log them too.
+STATS_LOG_INTERVAL = 10000
+STATS_LOG_PERIOD = datetime.timedelta(hours=1)
+
+
+@attr.s
+class ManagerAuthCache:
+    """Size-bounded TTL cache of (service account ID, manager ID) → allowed.
+
+    The least recently used entry is evicted when the cache is full. A max_size
+    of 0 disables the cache.
+    """
+
+    max_size: int = attr.ib(default=1000, validator=attr.validators.instance_of(int))
+    ttl: datetime.timedelta = attr.ib(default=datetime.timedelta(seconds=60),
+                                      validator=attr.validators.instance_of(datetime.timedelta))
+    hits: int = attr.ib(default=0, init=False)
+    misses: int = attr.ib(default=0, init=False)
+    evictions: int = attr.ib(default=0, init=False)
+    invalidations: int = attr.ib(default=0, init=False)
+
+    # Maps the key to (expiry as time.monotonic() value, allowed).
+    _entries: typing.MutableMapping[CacheKey, typing.Tuple[float, bool]] = attr.ib(
+        default=attr.Factory(collections.OrderedDict), init=False, repr=False)
+    _lock: threading.Lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+    # time.monotonic() value of the last time the statistics were logged.
+    _stats_logged_at: float = attr.ib(default=attr.Factory(time.monotonic), init=False,
+                                      repr=False)
+    _log = attrs_extra.log('%s.ManagerAuthCache' % __name__)
+
+    def get(self, service_account_id: bson.ObjectId, manager_id: bson.ObjectId) \
+            -> typing.Optional[bool]:
+        """Returns the cached authorisation, or None if it is not cached."""
+
+        key = (service_account_id, manager_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            lookups = self.hits + self.misses
+
+            log_stats = (lookups % STATS_LOG_INTERVAL == 0 or
+                         now - self._stats_logged_at >= STATS_LOG_PERIOD.total_seconds())
+            if log_stats:
+                self._stats_logged_at = now
+
+        if log_stats:
+            self._log.info('Manager authorisation cache: %s', self.stats())
+
+        return None if entry is None else entry[1]
+
+    def put(self, service_account_id: bson.ObjectId, manager_id: bson.ObjectId, allowed: bool):
+        if self.max_size <= 0:
+            return
+
+        key = (service_account_id, manager_id)
+        expires = time.monotonic() + self.ttl.total_seconds()
+        with self._lock:
+            self._entries[key] = (expires, allowed)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_manager(self, manager_id: bson.ObjectId):
+        """Removes all entries of the given Manager."""
+
+        with self._lock:
+            keys = [key for key in self._entries if key[1] == manager_id]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Returns the cache statistics."""
+
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
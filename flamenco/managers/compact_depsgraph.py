@@ -0,0 +1,84 @@
+"""Compact, columnar representation of the depsgraph for Managers.
+
+Instead of a list of full task documents, the compact depsgraph contains one
+list per task field ('columns'). Repeated values, such as job IDs and task
+types, are stored once in 'dictionaries'; their columns contain indices into
+those dictionaries. For example, the job ID of the third task is
+``dictionaries['job'][columns['job'][2]]``.
+
+Only the fields a Manager needs for scheduling are included.
+"""
+
+import typing
+
+MIMETYPE = 'application/vnd.flamenco.depsgraph.compact+json'
+FORMAT_VERSION = 1
+
+# Columns that are stored as-is.
+PLAIN_FIELDS = ('_id', '_etag', '_updated', 'name', 'priority', 'job_priority')
+# Columns that are stored as index into a dictionary of distinct values.
+DICTIONARY_FIELDS = ('job', 'manager', 'project', 'user', 'status', 'job_type', 'task_type')
+
+PROJECTION = {field: True
+              for field in PLAIN_FIELDS + DICTIONARY_FIELDS + ('parents', 'commands')}
+
+
+class _Dictionary:
+    """Assigns consecutive indices to distinct values."""
+
+    def __init__(self):
+        self.values = []
+        self._indices = {}
+
+    def index(self, value) -> int:
+        try:
+            return self._indices[value]
+        except KeyError:
+            idx = self._indices[value] = len(self.values)
+            self.values.append(value)
+            return idx
+
+
+def _str_or_none(value) -> typing.Optional[str]:
+    return None if value is None else str(value)
+
+
+def encode(tasks: typing.Iterable[dict]) -> dict:
+    """Returns the compact depsgraph document for the given tasks.
+
+    The tasks should have been queried with PROJECTION.
+    """
+
+    dictionaries = {field: _Dictionary() for field in DICTIONARY_FIELDS}
+    command_names = _Dictionary()
+    columns: typing.Dict[str, list] = {
+        field: [] for field in PLAIN_FIELDS + DICTIONARY_FIELDS + ('parents', 'commands')}
+
+    for task in tasks:
+        columns['_id'].append(str(task['_id']))
+        for field in PLAIN_FIELDS[1:]:
+            columns[field].append(task.get(field))
+
+        for field in DICTIONARY_FIELDS:
+            value = task.get(field)
+            columns[field].append(dictionaries[field].index(value))
+
+        parents = task.get('parents')
+        columns['parents'].append([str(parent) for parent in parents] if parents else None)
+        columns['commands'].append([
+            [command_names.index(command['name']), command.get('settings', {})]
+            for command in task.get('commands', [])
+        ])
+
+    # The distinct values are converted to strings here, so that ObjectIds are
+    # converted once per distinct value instead of once per task.
+    return {
+        'format': FORMAT_VERSION,
+        'count': len(columns['_id']),
+        'dictionaries': {
+            **{field: [_str_or_none(value) for value in dictionary.values]
+               for field, dictionary in dictionaries.items()},
+            'command_name': command_names.values,
+        },
+        'columns': columns,
+    }
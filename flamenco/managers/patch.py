@@ -11,7 +11,7 @@ from pillar.api.utils import authorization, str2id
 from pillar.api import patch_handler
 from pillar import current_app
 
-from .. import current_flamenco
+from .. import current_flamenco, request_cache
 
 log = logging.getLogger(__name__)
 patch_api_blueprint = Blueprint('flamenco.managers.patch', __name__)
@@ -114,6 +114,7 @@ class ManagerPatchHandler(patch_handler.AbstractPatchHandler):
             {'_id': manager_id},
             {'$set': update}
         )
+        request_cache.invalidate('managers', manager_id)
 
         if result.matched_count != 1:
             self.log.warning('User %s edits Manager %s but update matched %i items',
@@ -0,0 +1,119 @@
+"""Request-scoped caches.
+
+A single request often performs the same authorisation checks on different
+layers (Eve hooks, PATCH handlers, view functions), each of which fetches the
+same documents from MongoDB. The caches in this module are stored on flask.g,
+so that those documents are fetched only once per request.
+
+Outside of a request context nothing is cached; Celery tasks and CLI commands
+always see fresh data.
+"""
+
+import logging
+import typing
+
+import attr
+import flask
+
+log = logging.getLogger(__name__)
+
+_G_ATTR = 'flamenco_request_caches'
+
+
+@attr.s
+class RequestCache:
+    """Identity cache for values that do not change during a request."""
+
+    name: str = attr.ib(validator=attr.validators.instance_of(str))
+    hits: int = attr.ib(default=0)
+    misses: int = attr.ib(default=0)
+    _values: dict = attr.ib(default=attr.Factory(dict), repr=False)
+
+    def get(self, key: typing.Hashable, fetch: typing.Callable[[], typing.Any]):
+        """Returns the cached value for the key, calling fetch() on a cache miss.
+
+        A return value of None is cached as well, so that non-existing
+        documents are not looked up over and over again.
+        """
+
+        try:
+            value = self._values[key]
+        except KeyError:
+            self.misses += 1
+            value = self._values[key] = fetch()
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: typing.Hashable, value):
+        """Stores a value that was obtained in some other way."""
+        self._values[key] = value
+
+    def invalidate(self, key: typing.Hashable):
+        """Removes the key from the cache, if it is there."""
+        self._values.pop(key, None)
+
+
+def cache(name: str) -> RequestCache:
+    """Returns the named cache for the current request.
+
+    When there is no request context, returns a new, empty cache, so that
+    nothing is cached between calls.
+    """
+
+    if not flask.has_request_context():
+        return RequestCache(name)
+
+    caches = flask.g.get(_G_ATTR)
+    if caches is None:
+        caches = {}
+        setattr(flask.g, _G_ATTR, caches)
+
+    try:
+        return caches[name]
+    except KeyError:
+        cache = caches[name] = RequestCache(name)
+        return cache
+
+
+def invalidate(name: str, key: typing.Hashable):
+    """Removes the key from the named cache of the current request, if any."""
+
+    if not flask.has_request_context():
+        return
+    caches = flask.g.get(_G_ATTR) or {}
+    if name in caches:
+        caches[name].invalidate(key)
+
+
+def stats() -> typing.Dict[str, typing.Dict[str, int]]:
+    """Returns the hit & miss counters of the caches used in the current request."""
+
+    if not flask.has_request_context():
+        return {}
+    caches = flask.g.get(_G_ATTR) or {}
+    return {name: {'hits': cache.hits, 'misses': cache.misses}
+            for name, cache in caches.items()}
+
+
+def _reset_caches():
+    # The app context, and thus flask.g, can outlive a single request (for
+    # example in unit tests), so explicitly start every request with empty caches.
+    flask.g.pop(_G_ATTR, None)
+
+
+def _log_stats(exc):
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    cache_stats = stats()
+    if not cache_stats:
+        return
+    log.debug('Request cache stats for %s %s: %s',
+              flask.request.method, flask.request.path,
+              ', '.join(f'{name}: {counts["hits"]} hits / {counts["misses"]} misses'
+                        for name, counts in sorted(cache_stats.items())))
+
+
+def setup_app(app):
+    app.before_request(_reset_caches)
+    app.teardown_request(_log_stats)
@@ -1,5 +1,7 @@
 """Task management."""
 import collections
+import contextlib
+import copy
 import datetime
 import pathlib
 import typing
@@ -8,7 +10,9 @@ import attr
 
 import bson
 from flask import current_app
+import pymongo
 import pymongo.collection
+import pymongo.results
 import werkzeug.exceptions as wz_exceptions
 
 from pillar import attrs_extra
@@ -42,6 +46,15 @@ QUEUED_TASK_STATES = {'queued', 'claimed-by-manager', 'soft-failed'}
 LOG_UPLOAD_REQUESTABLE_TASK_STATES = {'canceled', 'cancel-requested', 'failed', 'completed',
                                       'claimed-by-manager', 'fail-requested', 'soft-failed'}
 
+# Number of tasks a TaskBatch inserts with one insert_many() call.
+TASK_BATCH_CHUNK_SIZE = 1000
+
+# Document ID in the flamenco_counters collection of the task change sequence number.
+TASK_CHANGE_SEQ_COUNTER = 'task_change_seq'
+# Change sequence numbers that are in flight for longer than this are ignored
+# by TaskManager.committed_change_seq(); their writer probably crashed.
+CHANGE_SEQ_IN_FLIGHT_EXPIRY = datetime.timedelta(minutes=10)
+
 
 @attr.s
 class TaskManager(object):
@@ -53,6 +66,84 @@ class TaskManager(object):
 
         return current_flamenco.db('tasks')
 
+    def next_change_seq(self) -> int:
+        """Allocates a new task change sequence number.
+
+        Every write to tasks should stamp the task(s) with a new number in the
+        'change_seq' field, so that Managers can fetch the tasks that changed
+        since their last depsgraph query. The number is 'in flight' until it is
+        passed to release_change_seq() after the write; use allocate_change_seq()
+        to do this automatically.
+        """
+        from pillar.api.utils import utcnow
+        from flamenco import current_flamenco
+
+        # A single atomic update increments the counter and registers the new
+        # number as in flight, so concurrent writers never have to retry. This
+        # uses an update pipeline, because the in-flight entry needs the value
+        # that $inc would produce.
+        counters_coll = current_flamenco.db('counters')
+        counter = counters_coll.find_one_and_update(
+            {'_id': TASK_CHANGE_SEQ_COUNTER},
+            [{'$set': {'seq': {'$add': [{'$ifNull': ['$seq', 0]}, 1]}}},
+             {'$set': {'in_flight': {'$concatArrays': [
+                 {'$ifNull': ['$in_flight', []]},
+                 [{'seq': '$seq', 'allocated': utcnow()}],
+             ]}}}],
+            projection={'seq': True},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER)
+        return counter['seq']
+
+    def release_change_seq(self, change_seq: int):
+        """Marks the writes stamped with this change sequence number as done."""
+        from flamenco import current_flamenco
+
+        counters_coll = current_flamenco.db('counters')
+        counters_coll.update_one({'_id': TASK_CHANGE_SEQ_COUNTER},
+                                 {'$pull': {'in_flight': {'seq': change_seq}}})
+
+    @contextlib.contextmanager
+    def allocate_change_seq(self) -> typing.Iterator[int]:
+        """Context manager, allocates a change sequence number for the writes in its body."""
+
+        change_seq = self.next_change_seq()
+        try:
+            yield change_seq
+        finally:
+            self.release_change_seq(change_seq)
+
+    def committed_change_seq(self) -> int:
+        """Returns the highest change sequence number whose writes, and those of all
+        lower numbers, are done.
+
+        Tasks stamped with a higher number may not have been written yet, or may
+        be written after a query that runs after this call. Numbers that have been
+        in flight for longer than CHANGE_SEQ_IN_FLIGHT_EXPIRY are assumed to
+        belong to a crashed writer, and are ignored.
+        """
+        from pillar.api.utils import utcnow
+        from flamenco import current_flamenco
+
+        counters_coll = current_flamenco.db('counters')
+        counter = counters_coll.find_one({'_id': TASK_CHANGE_SEQ_COUNTER})
+        if not counter:
+            return 0
+
+        expired = utcnow() - CHANGE_SEQ_IN_FLIGHT_EXPIRY
+        in_flight = counter.get('in_flight') or []
+        if any(entry['allocated'] <= expired for entry in in_flight):
+            self._log.warning('Task change sequence numbers %s were never released, ignoring',
+                              [entry['seq'] for entry in in_flight
+                               if entry['allocated'] <= expired])
+            counters_coll.update_one({'_id': TASK_CHANGE_SEQ_COUNTER},
+                                     {'$pull': {'in_flight': {'allocated': {'$lte': expired}}}})
+
+        in_flight_seqs = [entry['seq'] for entry in in_flight if entry['allocated'] > expired]
+        if in_flight_seqs:
+            return min(in_flight_seqs) - 1
+        return counter['seq']
+
     def api_create_task(self, job, commands, name, parents=None, priority=50,
                         status='queued', *, task_type: str) -> bson.ObjectId:
         """Creates a task in MongoDB for the given job, executing commands.
@@ -60,6 +151,24 @@ class TaskManager(object):
         Returns the ObjectId of the created task.
         """
 
+        task = self.task_doc(job, commands, name, parents, priority, status,
+                             task_type=task_type)
+
+        self._log.info('Creating task %s for manager %s, user %s',
+                       name, job['manager'], job['user'])
+
+        r, _, _, status = current_app.post_internal('flamenco_tasks', task)
+        if status != 201:
+            self._log.error('Error %i creating task %s: %s',
+                            status, task, r)
+            raise wz_exceptions.InternalServerError('Unable to create task')
+
+        return r['_id']
+
+    def task_doc(self, job, commands, name, parents=None, priority=50,
+                 status='queued', *, task_type: str) -> dict:
+        """Returns a new task document for the given job, executing commands."""
+
         task = {
             'job': job['_id'],
             'manager': job['manager'],
@@ -76,17 +185,11 @@ class TaskManager(object):
         # Insertion of None parents is not supported
         if parents:
             task['parents'] = parents
+        return task
 
-        self._log.info('Creating task %s for manager %s, user %s',
-                       name, job['manager'], job['user'])
-
-        r, _, _, status = current_app.post_internal('flamenco_tasks', task)
-        if status != 201:
-            self._log.error('Error %i creating task %s: %s',
-                            status, task, r)
-            raise wz_exceptions.InternalServerError('Unable to create task')
-
-        return r['_id']
+    def task_batch(self) -> 'TaskBatch':
+        """Returns a TaskBatch for creating many tasks at once."""
+        return TaskBatch(self)
 
     def tasks_for_job(self, job_id, status=None, *,
                       page=1, max_results=250,
@@ -146,6 +249,17 @@ class TaskManager(object):
             settings _updated on several tasks to the same timestamp.
         """
 
+        from flamenco import current_flamenco
+
+        self._set_task_status(task, new_status, now=now)
+
+        # Also inspect other tasks of the same job, and possibly update the job status as well.
+        current_flamenco.job_manager.update_job_after_task_status_change(
+            task['job'], task['_id'], new_status)
+
+    def _set_task_status(self, task: dict, new_status: str, *, now: datetime.datetime = None):
+        """Update the task with the new status, without touching the job."""
+
         extra_unset = set()  # type: typing.Set[str]
         if new_status == 'queued' and task['status'] != 'queued':
             # The task was requeued, so clear out the 'failed_by_workers' list.
@@ -159,9 +273,73 @@ class TaskManager(object):
                                        extra_unset=extra_unset,
                                        now=now)
 
-        # Also inspect other tasks of the same job, and possibly update the job status as well.
-        current_flamenco.job_manager.update_job_after_task_status_change(
-            task['job'], task['_id'], new_status)
+    def update_tasks(self, query: dict, update: dict) -> pymongo.results.UpdateResult:
+        """Performs update_many() on the tasks, maintaining the jobs' task status counters.
+
+        :param query: selects the tasks to update.
+        :param update: the update to perform. When it sets a new task status,
+            the 'tasks_status' counters of the affected jobs are updated too.
+            When it does not set 'change_seq', a new change sequence number is
+            allocated for it.
+        :returns: the combined result of the performed updates.
+        """
+        from flamenco import current_flamenco
+
+        tasks_coll = self.collection()
+        new_status = update.get('$set', {}).get('status')
+        if not new_status:
+            return tasks_coll.update_many(query, update)
+
+        if 'change_seq' not in update['$set']:
+            with self.allocate_change_seq() as change_seq:
+                update = {**update, '$set': {**update['$set'], 'change_seq': change_seq}}
+                return self.update_tasks(query, update)
+
+        # Mapping from job ID to mapping from task status to counter increment.
+        deltas: typing.MutableMapping[bson.ObjectId, typing.Counter[str]] = \
+            collections.defaultdict(collections.Counter)
+
+        def count_status_change(job_id, old_status: str, count: int):
+            if not count or old_status == new_status:
+                return
+            deltas[job_id][old_status] -= count
+            deltas[job_id][new_status] += count
+
+        if set(query.keys()) == {'_id'} and isinstance(query['_id'], bson.ObjectId):
+            # A single task can be updated while returning its previous status.
+            old_task = tasks_coll.find_one_and_update(query, update,
+                                                      projection={'job': 1, 'status': 1})
+            matched = int(old_task is not None)
+            if old_task:
+                count_status_change(old_task.get('job'), old_task.get('status'), 1)
+            raw_result = {'n': matched, 'nModified': matched}
+        else:
+            # Update the tasks per (job, current status), so that we know exactly how many
+            # tasks went from which status to the new one. A task can change status between
+            # grouping and updating, and then isn't matched by its group's update. The
+            # change sequence number of this update is unique, so such tasks are found
+            # and updated in the next round.
+            pending_query = {'$and': [query,
+                                      {'change_seq': {'$ne': update['$set']['change_seq']}}]}
+            raw_result = {'n': 0, 'nModified': 0}
+            while True:
+                groups = list(tasks_coll.aggregate([
+                    {'$match': pending_query},
+                    {'$group': {'_id': {'job': '$job', 'status': '$status'}}},
+                ]))
+                if not groups:
+                    break
+                for group in groups:
+                    job_id = group['_id'].get('job')
+                    old_status = group['_id'].get('status')
+                    group_query = {'$and': [pending_query, {'job': job_id, 'status': old_status}]}
+                    result = tasks_coll.update_many(group_query, update)
+                    raw_result['n'] += result.matched_count
+                    raw_result['nModified'] += result.modified_count
+                    count_status_change(job_id, old_status, result.modified_count)
+
+        current_flamenco.job_manager.update_task_status_counts(deltas)
+        return pymongo.results.UpdateResult(raw_result, acknowledged=True)
 
     def web_set_task_status(self, task_id, new_status):
         """Web-level call to updates the task status."""
@@ -174,14 +352,33 @@ class TaskManager(object):
 
     def api_set_task_status_for_job(self, job_id: bson.ObjectId, from_status: str, to_status: str,
                                     *, now: datetime.datetime = None):
-        """Updates the task status for all tasks of a job that have a particular status."""
+        """Updates the task status for all tasks of a job that have a particular status.
+
+        All tasks are updated with a single query, so they all get the same '_updated'
+        timestamp. Pass 'now' to use a specific timestamp, for example to give the job
+        the same timestamp as its tasks. The job status is re-evaluated once afterwards.
+        """
 
         self._log.info('Flipping all tasks of job %s from status %r to %r',
                        job_id, from_status, to_status)
 
-        tasks_coll = self.collection()
-        for task in tasks_coll.find({'job': job_id, 'status': from_status}):
-            self.api_set_task_status(task, to_status, now=now)
+        from flamenco import current_flamenco
+
+        extra_unset = set()  # type: typing.Set[str]
+        if to_status == 'queued' and from_status != 'queued':
+            # The tasks were requeued, so clear out the 'failed_by_workers' list,
+            # just like api_set_task_status() does.
+            extra_unset.add('failed_by_workers')
+
+        result = current_flamenco.update_status_q(
+            'tasks', {'job': job_id, 'status': from_status}, to_status,
+            extra_unset=extra_unset, now=now)
+        if not result.modified_count or from_status == to_status:
+            return
+
+        # Re-evaluate the job status once, rather than once per task.
+        current_flamenco.job_manager.update_job_after_task_status_change(
+            job_id, None, to_status)
 
     def api_set_activity(self, task_query: dict, new_activity: str):
         """Updates the activity for all tasks that match the query."""
@@ -196,7 +393,8 @@ class TaskManager(object):
         }
 
         tasks_coll = self.collection()
-        tasks_coll.update_many(task_query, {'$set': update})
+        with self.allocate_change_seq() as change_seq:
+            tasks_coll.update_many(task_query, {'$set': {**update, 'change_seq': change_seq}})
 
     def api_find_job_enders(self, job_id):
         """Returns a list of tasks that could be the last tasks of a job.
@@ -206,25 +404,9 @@ class TaskManager(object):
         :returns: list of task IDs
         :rtype: list
         """
+        from flamenco.jobs.graph import JobGraph
 
-        tasks_coll = self.collection()
-
-        # Get the distinct set of tasks used as parents.
-        parent_tasks = tasks_coll.aggregate([
-            {'$match': {'job': job_id}},
-            {'$project': {'parents': 1}},
-            {'$unwind': {'path': '$parents'}},
-            {'$group': {'_id': '$parents'}},
-        ])
-        parent_ids = [t['_id'] for t in parent_tasks]
-
-        # Get all the tasks that do not have such an ID.
-        tasks = tasks_coll.find({'job': job_id,
-                                 '_id': {'$nin': parent_ids}},
-                                projection={'_id': 1})
-
-        tids = [t['_id'] for t in tasks]
-        return tids
+        return JobGraph.load(job_id).enders()
 
     def api_delete_tasks_for_job(self, job_id: bson.ObjectId):
         """Deletes all tasks for a given job.
@@ -234,36 +416,42 @@ class TaskManager(object):
 
         from pymongo.results import DeleteResult
 
+        from flamenco import current_flamenco
+
         self._log.info('Deleting all tasks of job %s', job_id)
         tasks_coll = self.collection()
         delres: DeleteResult = tasks_coll.delete_many({'job': job_id})
         self._log.info('Deleted %i tasks of job %s', delres.deleted_count, job_id)
 
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.update_one({'_id': job_id}, {'$set': {'tasks_status': {'count': 0}}})
+
     def api_requeue_task_and_successors(self, task_id: bson.ObjectId):
-        """Recursively re-queue a task and its successors on the job's depsgraph.
+        """Re-queue a task and its successors on the job's depsgraph.
 
         Does not update the job status itself. This is the responsibility
         of the caller.
         """
         from flamenco import current_flamenco
 
-        tasks_coll = self.collection()
-        visited_tasks: typing.MutableSet[bson.ObjectId] = set()
+        to_requeue = {task_id} | set(self.successors(task_id))
+        self._log.info('Re-queueing task %s and its %d successors',
+                       task_id, len(to_requeue) - 1)
+        current_flamenco.update_status_q('tasks', {'_id': {'$in': list(to_requeue)}}, 'queued')
 
-        def visit_task(tid: bson.ObjectId, depth: int):
-            if depth > 10000:
-                raise ValueError('Infinite recursion detected')
+    def successors(self, task_id: bson.ObjectId) -> typing.List[bson.ObjectId]:
+        """Returns the IDs of all tasks that depend on this task, directly or indirectly.
 
-            if tid in visited_tasks:
-                return
-            visited_tasks.add(tid)
+        Every task is visited at most once, so cycles in the depsgraph are harmless.
+        """
+        from flamenco.jobs.graph import JobGraph
 
-            current_flamenco.update_status('tasks', tid, 'queued')
-            children = tasks_coll.find({'parents': tid}, projection={'_id': True})
-            for child in children:
-                visit_task(child['_id'], depth + 1)
+        task = self.collection().find_one({'_id': task_id}, projection={'job': True})
+        if not task:
+            return []
 
-        visit_task(task_id, 0)
+        return [tid for tid in JobGraph.load(task['job']).descendants(task_id)
+                if tid != task_id]
 
     def _tasklog_blob_fname(self, task: dict) -> str:
         """Construct the blob filename for this task's log file.
@@ -308,16 +496,109 @@ class TaskManager(object):
                        task['_id'], blob.name, task['project'])
 
         tasks_coll = self.collection()
-        tasks_coll.update_one({'_id': task['_id']}, {'$set': {
-            'log_file': {
-                'backend': blob.bucket.backend_name,
-                'file_path': blob.name,
-            },
-        }})
+        with self.allocate_change_seq() as change_seq:
+            tasks_coll.update_one({'_id': task['_id']}, {'$set': {
+                'log_file': {
+                    'backend': blob.bucket.backend_name,
+                    'file_path': blob.name,
+                },
+                'change_seq': change_seq,
+            }})
 
         return preexisting
 
 
+@attr.s
+class TaskBatch:
+    """Creates tasks in bulk.
+
+    Tasks are validated when they are added, and get their ObjectId assigned
+    immediately, so that they can be used as parents of subsequent tasks. They
+    are inserted with insert_many() once chunk_size tasks are pending, and when
+    flush() is called. Unlike TaskManager.api_create_task(), this bypasses Eve,
+    so the Eve hooks for inserting tasks are not called; the change sequence
+    number and job task status counters are maintained by the batch itself.
+    """
+
+    task_manager = attr.ib(validator=attr.validators.instance_of(TaskManager))
+    chunk_size = attr.ib(default=TASK_BATCH_CHUNK_SIZE)
+    _pending = attr.ib(default=attr.Factory(list), init=False)
+    _validator = attr.ib(default=None, init=False)
+    _log = attrs_extra.log('%s.TaskBatch' % __name__)
+
+    def add_task(self, job, commands, name, parents=None, priority=50,
+                 status='queued', *, task_type: str) -> bson.ObjectId:
+        """Adds a task to the batch; see TaskManager.api_create_task() for the parameters.
+
+        :returns: the ObjectId the task will have in the database.
+        """
+
+        task = self.task_manager.task_doc(job, commands, name, parents, priority, status,
+                                          task_type=task_type)
+        self._validate(task)
+
+        task['_id'] = bson.ObjectId()
+        self._pending.append(task)
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+        return task['_id']
+
+    def flush(self):
+        """Inserts the pending tasks into the database."""
+
+        from pillar.api.utils import random_etag, utcnow
+        from flamenco import current_flamenco
+
+        if not self._pending:
+            return
+
+        now = utcnow()
+        deltas: typing.MutableMapping[bson.ObjectId, typing.Counter[str]] = \
+            collections.defaultdict(collections.Counter)
+        for task in self._pending:
+            task['_created'] = now
+            task['_updated'] = now
+            task['_etag'] = random_etag()
+            deltas[task['job']]['count'] += 1
+            deltas[task['job']][task['status']] += 1
+
+        self._log.info('Inserting %d tasks', len(self._pending))
+        with self.task_manager.allocate_change_seq() as change_seq:
+            for task in self._pending:
+                task['change_seq'] = change_seq
+            self.task_manager.collection().insert_many(self._pending)
+        current_flamenco.job_manager.update_task_status_counts(deltas)
+        self._pending = []
+
+    def _validate(self, task: dict):
+        """Validates the task against the task schema.
+
+        References to other documents are not checked, as the task's parents may
+        not have been inserted yet.
+        """
+
+        if self._validator is None:
+            from flamenco import eve_settings
+
+            schema = copy.deepcopy(eve_settings.tasks_schema)
+            _remove_data_relations(schema)
+            self._validator = current_app.validator(schema, resource='flamenco_tasks')
+
+        if not self._validator.validate(task):
+            self._log.error('Error creating task %s: %s', task, self._validator.errors)
+            raise wz_exceptions.InternalServerError('Unable to create task')
+
+
+def _remove_data_relations(schema: dict):
+    """Recursively removes 'data_relation' rules from an Eve schema."""
+
+    for value in schema.values():
+        if not isinstance(value, dict):
+            continue
+        value.pop('data_relation', None)
+        _remove_data_relations(value)
+
+
 def setup_app(app):
     from . import eve_hooks, patch
 
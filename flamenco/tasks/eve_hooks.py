@@ -1,5 +1,6 @@
 # -*- encoding: utf-8 -*-
 
+import collections
 import logging
 import typing
 
@@ -81,6 +82,62 @@ def check_task_permissions_edit(task_doc, original_doc=None):
         # FIXME: check user access to the project.
 
 
+def stamp_change_seq(task_docs: typing.Union[list, dict], original_doc=None):
+    """Stamps the task(s) with a new change sequence number before writing them.
+
+    The number is released by release_change_seq() after writing.
+    """
+
+    change_seq = current_flamenco.task_manager.next_change_seq()
+    if isinstance(task_docs, dict):
+        task_docs = [task_docs]
+    for task_doc in task_docs:
+        task_doc['change_seq'] = change_seq
+
+
+def release_change_seq(task_docs: typing.Union[list, dict], original_doc=None):
+    """Releases the change sequence number stamped by stamp_change_seq()."""
+
+    if isinstance(task_docs, dict):
+        task_docs = [task_docs]
+    for change_seq in {task_doc['change_seq'] for task_doc in task_docs
+                       if 'change_seq' in task_doc}:
+        current_flamenco.task_manager.release_change_seq(change_seq)
+
+
+def count_inserted_tasks(task_docs: typing.List[dict]):
+    """Increments the task status counters of the jobs of newly created tasks."""
+
+    deltas = collections.defaultdict(collections.Counter)
+    for task_doc in task_docs:
+        job_deltas = deltas[task_doc.get('job')]
+        job_deltas['count'] += 1
+        job_deltas[task_doc.get('status')] += 1
+
+    current_flamenco.job_manager.update_task_status_counts(deltas)
+
+
+def count_deleted_task(task_doc: dict):
+    """Decrements the task status counters of the job of a deleted task."""
+
+    current_flamenco.job_manager.update_task_status_counts({
+        task_doc.get('job'): {'count': -1, task_doc.get('status'): -1},
+    })
+
+
+def count_task_status_change(updates: dict, original_doc: dict):
+    """Updates the task status counters of the job when the task status changed."""
+
+    new_status = updates.get('status')
+    old_status = original_doc.get('status')
+    if not new_status or new_status == old_status:
+        return
+
+    current_flamenco.job_manager.update_task_status_counts({
+        original_doc.get('job'): {old_status: -1, new_status: 1},
+    })
+
+
 def update_job_status(task_doc, original_doc):
     """Update the job status given the new task status."""
 
@@ -114,4 +171,16 @@ def setup_app(app):
     app.on_delete_flamenco_tasks += partial(check_task_edit_permissions, action='delete')
     app.on_update_flamenco_tasks += partial(check_task_edit_permissions, action='edit')
     app.on_replace_flamenco_tasks += check_task_permissions_edit
+
+    app.on_insert_flamenco_tasks += stamp_change_seq
+    app.on_update_flamenco_tasks += stamp_change_seq
+    app.on_replace_flamenco_tasks += stamp_change_seq
+    app.on_inserted_flamenco_tasks += release_change_seq
+    app.on_updated_flamenco_tasks += release_change_seq
+    app.on_replaced_flamenco_tasks += release_change_seq
+
+    app.on_inserted_flamenco_tasks += count_inserted_tasks
+    app.on_deleted_item_flamenco_tasks += count_deleted_task
+    app.on_updated_flamenco_tasks += count_task_status_change
+    app.on_replaced_flamenco_tasks += count_task_status_change
     app.on_replaced_flamenco_tasks += update_job_status
@@ -21,6 +21,10 @@ class FlamencoTestServer(PillarTestServer):
         jwt_test_path = pathlib.Path(__file__).with_name('jwt_keys')
         self.config['FLAMENCO_JWT_PRIVATE_KEY_PATH'] = str(jwt_test_path / 'test-private-2.pem')
         self.config['FLAMENCO_JWT_PUBLIC_KEYS_PATH'] = str(jwt_test_path / 'test-public-2.pem')
+        # Most tests expect the tasks to exist as soon as the job has been created.
+        self.config['FLAMENCO_ASYNC_JOB_COMPILATION'] = False
+        # Tests run the runnability checks explicitly, instead of through Celery.
+        self.config['FLAMENCO_RUNNABILITY_CHECK_ON_FAILURE'] = False
 
         from flamenco import FlamencoExtension
         self.load_extension(FlamencoExtension(), '/flamenco')
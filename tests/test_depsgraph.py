@@ -132,6 +132,27 @@ class DepsgraphTest(AbstractFlamencoTest):
             self.assertEqual(8 * ['claimed-by-manager'], [task['status'] for task in dbtasks])
         self.assertEqual(8 * ['claimed-by-manager'], [task['status'] for task in depsgraph])
 
+    def test_claimed_tasks_counted(self):
+        self.force_task_status(0, 'soft-failed')
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token)
+        depsgraph = resp.json['depsgraph']
+        self.assertTrue(all('claim_token' not in task for task in depsgraph))
+
+        with self.app.test_request_context():
+            dbtask0 = self.flamenco.db('tasks').find_one({'_id': self.task_ids[0]})
+            dbtask1 = self.flamenco.db('tasks').find_one({'_id': self.task_ids[1]})
+            job1 = self.flamenco.db('jobs').find_one({'_id': self.jobid1})
+
+        # The claim token is removed after counting the claimed tasks.
+        self.assertNotIn('claim_token', dbtask0)
+        self.assertNotIn('claim_token', dbtask1)
+        self.assertEqual('soft-failed', dbtask0['status'])
+        self.assertEqual({'count': 4, 'under-construction': 0, 'queued': 0,
+                          'claimed-by-manager': 3, 'soft-failed': 1},
+                         job1['tasks_status'])
+
     def test_get_clean_slate_some_tasks_unrunnable(self):
         self.force_task_status(0, 'failed')
         self.force_task_status(1, 'canceled')
@@ -203,6 +224,155 @@ class DepsgraphTest(AbstractFlamencoTest):
         self.assertEqual(2 * ['claimed-by-manager'],
                          [task['status'] for task in depsgraph])
 
+    def test_get_subsequent_call_with_cursor(self):
+        # Get a clean slate first, so that we get the cursor.
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token)
+        cursor = resp.headers['X-Flamenco-Depsgraph-Cursor']
+
+        # Do the subsequent call, it should return nothing.
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token,
+                        headers={'X-Flamenco-Depsgraph-Cursor': cursor},
+                        expected_status=304)
+        self.assertEqual(cursor, resp.headers['X-Flamenco-Depsgraph-Cursor'])
+
+        # Change some tasks to see what we get back; no need to wait for the clock to tick.
+        self.force_task_status(0, 'claimed-by-manager')
+        self.force_task_status(1, 'cancel-requested')
+        self.force_task_status(2, 'queued')
+
+        # Tasks of non-runnable jobs should not be returned.
+        with self.app.test_request_context():
+            paused_task = self.flamenco.db('tasks').find_one({'job': self.jobid4})
+        self.force_task_status(paused_task['_id'], 'queued')
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token,
+                        headers={'X-Flamenco-Depsgraph-Cursor': cursor})
+        next_cursor = resp.headers['X-Flamenco-Depsgraph-Cursor']
+        self.assertNotEqual(cursor, next_cursor)
+
+        depsgraph = resp.json['depsgraph']
+        deps_tids = {t['_id'] for t in depsgraph}
+        self.assertEqual({str(self.task_ids[0]),
+                          str(self.task_ids[2])},
+                         deps_tids)
+        self.assertEqual(2 * ['claimed-by-manager'],
+                         [task['status'] for task in depsgraph])
+
+        # Claiming the tasks should not cause them to be sent again.
+        self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                 auth_token=self.mngr_token,
+                 headers={'X-Flamenco-Depsgraph-Cursor': next_cursor},
+                 expected_status=304)
+
+    def test_cursor_with_write_in_flight(self):
+        url = '/api/flamenco/managers/%s/depsgraph' % self.mngr_id
+        resp = self.get(url, auth_token=self.mngr_token)
+        cursor = resp.headers['X-Flamenco-Depsgraph-Cursor']
+
+        # A concurrent writer allocates a change sequence number, but finishes its
+        # write only after a depsgraph request, and after a later writer.
+        with self.app.test_request_context():
+            task_manager = self.flamenco.task_manager
+            slow_change_seq = task_manager.next_change_seq()
+        self.force_task_status(1, 'queued')
+
+        resp = self.get(url, auth_token=self.mngr_token,
+                        headers={'X-Flamenco-Depsgraph-Cursor': cursor})
+        self.assertEqual([str(self.task_ids[1])], [t['_id'] for t in resp.json['depsgraph']])
+        cursor = resp.headers['X-Flamenco-Depsgraph-Cursor']
+
+        with self.app.test_request_context():
+            self.flamenco.db('tasks').update_one(
+                {'_id': self.task_ids[2]},
+                {'$set': {'status': 'queued', 'change_seq': slow_change_seq}})
+            task_manager.release_change_seq(slow_change_seq)
+
+        # The cursor must not have skipped the slow write.
+        resp = self.get(url, auth_token=self.mngr_token,
+                        headers={'X-Flamenco-Depsgraph-Cursor': cursor})
+        deps_tids = {t['_id'] for t in resp.json['depsgraph']}
+        self.assertIn(str(self.task_ids[2]), deps_tids)
+
+    def test_get_invalid_cursor(self):
+        self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                 auth_token=self.mngr_token,
+                 headers={'X-Flamenco-Depsgraph-Cursor': 'je moeder'},
+                 expected_status=400)
+
+    def test_get_clean_slate_paged(self):
+        url = '/api/flamenco/managers/%s/depsgraph' % self.mngr_id
+        resp = self.get(url + '?page_size=3', auth_token=self.mngr_token)
+        cursor = resp.headers['X-Flamenco-Depsgraph-Cursor']
+        depsgraph = resp.json['depsgraph']
+
+        while 'X-Flamenco-Depsgraph-Continuation' in resp.headers:
+            continuation = resp.headers['X-Flamenco-Depsgraph-Continuation']
+            resp = self.get(f'{url}?page_size=3&continuation={continuation}',
+                            auth_token=self.mngr_token)
+            self.assertEqual(cursor, resp.headers['X-Flamenco-Depsgraph-Cursor'])
+            self.assertLessEqual(len(resp.json['depsgraph']), 3)
+            depsgraph.extend(resp.json['depsgraph'])
+
+        self.assertEqual(sorted(str(tid) for tid in self.task_ids),
+                         [task['_id'] for task in depsgraph])
+        self.assertEqual(8 * ['claimed-by-manager'], [task['status'] for task in depsgraph])
+
+    def test_get_clean_slate_streamed(self):
+        from dateutil.parser import parse
+
+        self.force_task_status(0, 'claimed-by-manager')
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph?stream=1' % self.mngr_id,
+                        auth_token=self.mngr_token)
+        depsgraph = resp.json['depsgraph']
+        self.assertEqual({str(t['_id']) for t in self.tasks},
+                         {t['_id'] for t in depsgraph})
+        self.assertEqual(8 * ['claimed-by-manager'], [task['status'] for task in depsgraph])
+
+        # The 'X-Flamenco-Last-Updated' header should contain the last-changed task.
+        last_modified = parse(resp.headers['X-Flamenco-Last-Updated'])
+        with self.app.test_request_context():
+            task0 = self.flamenco.db('tasks').find_one({'_id': self.task_ids[0]})
+            dbtasks = self.flamenco.db('tasks').find({'_id': {'$in': self.task_ids}})
+            self.assertEqual(8 * ['claimed-by-manager'], [task['status'] for task in dbtasks])
+        self.assertEqual(task0['_updated'], last_modified)
+
+    def test_get_clean_slate_compact(self):
+        from flamenco.managers import compact_depsgraph
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token,
+                        headers={'Accept': compact_depsgraph.MIMETYPE})
+        self.assertEqual(compact_depsgraph.MIMETYPE, resp.mimetype)
+        compact = resp.json
+        self.assertEqual(8, compact['count'])
+
+        columns = compact['columns']
+        dictionaries = compact['dictionaries']
+        self.assertEqual({str(tid) for tid in self.task_ids}, set(columns['_id']))
+        self.assertEqual({str(self.jobid1), str(self.jobid2)}, set(dictionaries['job']))
+        self.assertEqual(['claimed-by-manager'], dictionaries['status'])
+        self.assertEqual(8 * [0], columns['status'])
+        self.assertNotIn('log', columns)
+
+        # Decode one of the tasks and compare with the database.
+        idx = columns['_id'].index(str(self.task_ids[1]))
+        task1 = self.tasks[1]
+        self.assertEqual(str(task1['job']), dictionaries['job'][columns['job'][idx]])
+        self.assertEqual(task1['name'], columns['name'][idx])
+        self.assertEqual(
+            task1['commands'],
+            [{'name': dictionaries['command_name'][name_idx], 'settings': settings}
+             for name_idx, settings in columns['commands'][idx]])
+
+    def test_get_invalid_page_size(self):
+        self.get('/api/flamenco/managers/%s/depsgraph?page_size=-1' % self.mngr_id,
+                 auth_token=self.mngr_token,
+                 expected_status=400)
+
     def test_changed_job_priority(self):
         # Get a clean slate first, so that we get the timestamp of last modification
         log.info('Getting clean slate first, for timestamp')
@@ -0,0 +1,69 @@
+import datetime
+
+import pymongo
+
+from abstract_flamenco_test import AbstractFlamencoTest
+
+
+class IndexRegistryTest(AbstractFlamencoTest):
+    def test_declared_indexes_exist(self):
+        from flamenco import indexes
+
+        with self.app.app_context():
+            report = indexes.report(self.app.db())
+
+        self.assertEqual([], report.missing)
+        self.assertEqual([], report.undeclared)
+
+    def test_missing_and_undeclared(self):
+        from flamenco import indexes
+
+        with self.app.app_context():
+            db = self.app.db()
+            db.flamenco_jobs.drop_index('project_1_status_1')
+            db.flamenco_jobs.create_index([('name', pymongo.ASCENDING)])
+
+            report = indexes.report(db)
+            self.assertEqual(['project_1_status_1'], [spec.name for spec in report.missing])
+            self.assertEqual(['name_1'], [index.name for index in report.undeclared])
+
+            indexes.create_indexes(db, self.app.config, specs=report.missing, background=True)
+            self.assertEqual([], indexes.report(db).missing)
+
+    def test_unused(self):
+        from flamenco import indexes
+
+        with self.app.app_context():
+            db = self.app.db()
+            unused_before = {(index.collection_name, index.name)
+                             for index in indexes.report(db).unused}
+            self.assertIn(('flamenco_jobs', 'project_1_status_1'), unused_before)
+
+            list(db.flamenco_jobs.find({'project': self.proj_id, 'status': 'active'}))
+            unused_after = {(index.collection_name, index.name)
+                            for index in indexes.report(db).unused}
+            self.assertNotIn(('flamenco_jobs', 'project_1_status_1'), unused_after)
+
+    def test_ttl_unset(self):
+        from flamenco import indexes
+
+        spec = next(spec for spec in indexes.INDEXES
+                    if spec.ttl_setting == 'FLAMENCO_TASK_LOG_TTL')
+
+        with self.app.app_context():
+            db = self.app.db()
+            db.flamenco_task_logs.drop_index(spec.name)
+            config = {'FLAMENCO_TASK_LOG_TTL': datetime.timedelta(days=30)}
+            indexes.create_index(db, spec, config)
+            index_info = db.flamenco_task_logs.index_information()[spec.name]
+            self.assertEqual(30 * 24 * 3600, index_info['expireAfterSeconds'])
+
+            # Unsetting the TTL should stop documents from expiring.
+            indexes.create_index(db, spec, {'FLAMENCO_TASK_LOG_TTL': None})
+            index_info = db.flamenco_task_logs.index_information()[spec.name]
+            self.assertEqual(indexes.TTL_DISABLED_SECONDS, index_info['expireAfterSeconds'])
+
+            # Setting it again should update the existing index.
+            indexes.create_index(db, spec, config)
+            index_info = db.flamenco_task_logs.index_information()[spec.name]
+            self.assertEqual(30 * 24 * 3600, index_info['expireAfterSeconds'])
@@ -97,6 +97,42 @@ class JobArchivalTest(AbstractJobArchivalTest):
                 self.assertEqual(set(expected_task.keys()), set(read_task.keys()))
                 self.assertEqual(expected_task, read_task)
 
+    def test_download_tasks_and_logs(self):
+        from flamenco.celery import job_archival
+
+        self._perform_task_updates()
+        task_ids = sorted(self.task_ids)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            job_archival.download_tasks_and_logs(tempdir, str(self.job_id),
+                                                 str(task_ids[1]), str(task_ids[2]))
+
+            written = sorted(path.name for path in pathlib.Path(tempdir).iterdir())
+            self.assertEqual(sorted([f'task-{task_ids[1]}.json', f'task-{task_ids[1]}.log.gz',
+                                     f'task-{task_ids[2]}.json', f'task-{task_ids[2]}.log.gz']),
+                             written)
+
+    @mock.patch('celery.chain')
+    @mock.patch('celery.group')
+    def test_archive_job_chunked(self, mocked_group, mocked_chain):
+        from flamenco.celery import job_archival
+
+        self.app.config['FLAMENCO_ARCHIVE_STREAMING'] = False
+        self.app.config['FLAMENCO_ARCHIVE_CHUNK_SIZE'] = 1
+        self.app.config['FLAMENCO_ARCHIVE_PARALLEL_CHUNKS'] = 3
+        self.force_job_status('completed')
+
+        with mock.patch('flamenco.celery.job_archival.download_tasks_and_logs') as mock_download:
+            mock_download.si.side_effect = lambda *args: args
+            job_archival.archive_job(str(self.job_id))
+
+        # One chunk per task, spread over three chains.
+        self.assertEqual(self.TASK_COUNT, mock_download.si.call_count)
+        self.assertEqual(3, mocked_chain.call_count)
+        chunks_per_chain = sorted(len(call[0]) for call in mocked_chain.call_args_list)
+        self.assertEqual([1, 1, 2], chunks_per_chain)
+        mocked_group.assert_called_once()
+
     def test_task_and_log_deletion(self):
         from flamenco.celery import job_archival
 
@@ -110,16 +146,148 @@ class JobArchivalTest(AbstractJobArchivalTest):
                          logs_coll.count_documents({'task': {'$in': self.task_ids}}))
         self.assertEqual(self.TASK_COUNT * self.UPDATES_PER_TASK, logs_coll.count_documents({}))
 
+        # Log entries from before they stored their job ID should be deleted too.
+        logs_coll.update_many({'task': self.task_ids[0]}, {'$unset': {'job': True}})
+
         job_archival.update_mongo('testblob', str(self.job_id))
 
         self.assertEqual(0, tasks_coll.count_documents({'job': self.job_id}))
         self.assertEqual(0, logs_coll.count_documents({'task': {'$in': self.task_ids}}))
         self.assertEqual(0, logs_coll.count_documents({}))
 
+    def test_stream_job_archive(self):
+        import io
+        import zipfile
+        from pillar.api.utils import dumps
+        from flamenco.celery import job_archival
+
+        self._perform_task_updates()
+
+        expected_log = ''.join(
+            40 * f'This is batch {batch_idx} mülti→line log entry\n'
+            for batch_idx in range(3))
+
+        self.force_job_status('completed')
+        job = self.flamenco.db('jobs').find_one(self.job_id)
+        tasks = {task['_id']: task for task in self.flamenco.db('tasks').find()}
+
+        # Log entries from before they stored their job ID should be archived too.
+        self.flamenco.db('task_logs').update_many({'task': self.task_ids[0]},
+                                                  {'$unset': {'job': True}})
+
+        uploaded = {}
+
+        def mock_upload_zip(project_id, zip_name, stream_to_upload, file_size):
+            contents = stream_to_upload.read()
+            self.assertEqual(file_size, len(contents))
+            uploaded[zip_name] = contents
+            return f'flamenco-jobs/{zip_name}'
+
+        with mock.patch('flamenco.celery.job_archival._upload_zip') as mock_upload, \
+                mock.patch('flamenco.celery.job_archival.TASK_BATCH_SIZE', 3):
+            mock_upload.side_effect = mock_upload_zip
+            blob_name = job_archival.stream_job_archive(job, dumps(job))
+
+        zip_name = f'flamenco-job-{self.job_id}.zip'
+        self.assertEqual(f'flamenco-jobs/{zip_name}', blob_name)
+        mock_upload.assert_called_once_with(str(job['project']), zip_name, mock.ANY, mock.ANY)
+
+        with zipfile.ZipFile(io.BytesIO(uploaded[zip_name])) as zipped:
+            self.assertEqual(1 + 2 * self.TASK_COUNT, len(zipped.namelist()))
+            self.assertEqual(json.loads(dumps(job)),
+                             json.loads(zipped.read(f'job-{self.job_id}.json')))
+
+            for task_id in self.task_ids:
+                self.assertEqual(json.loads(dumps(tasks[task_id])),
+                                 json.loads(zipped.read(f'task-{task_id}.json')))
+                log_gz = zipped.read(f'task-{task_id}.log.gz')
+                self.assertEqual(expected_log, gzip.decompress(log_gz).decode())
+
+    @mock.patch('flamenco.celery.job_archival._upload_zip')
+    def test_stream_job_archive_too_large(self, mock_upload):
+        from pillar.api.utils import dumps
+        from flamenco.celery import job_archival
+
+        self._perform_task_updates()
+        self.force_job_status('completed')
+        job = self.flamenco.db('jobs').find_one(self.job_id)
+
+        self.app.config['FLAMENCO_ARCHIVE_MAX_SIZE'] = 1000
+        with self.assertRaises(job_archival.ArchivalError):
+            job_archival.stream_job_archive(job, dumps(job))
+        mock_upload.assert_not_called()
+
+    @mock.patch('flamenco.celery.job_archival.update_mongo')
+    @mock.patch('flamenco.celery.job_archival.stream_job_archive')
+    def test_archive_job_streaming(self, mock_stream, mock_update_mongo):
+        from flamenco.celery import job_archival
+
+        mock_stream.return_value = 'flamenco-jobs/archive.zip'
+        self.force_job_status('completed')
+
+        with mock.patch('tempfile.mkdtemp') as mock_mkdtemp:
+            mock_mkdtemp.side_effect = [RuntimeError('NO tempfile allowed!')]
+            job_archival.archive_job(str(self.job_id))
+
+        mock_stream.assert_called_once()
+        mock_update_mongo.assert_called_once_with('flamenco-jobs/archive.zip', str(self.job_id))
+        self.assert_job_status('archiving')
+
+    @mock.patch('time.sleep')
+    def test_task_and_log_deletion_batched(self, mock_sleep):
+        from flamenco.celery import job_archival
+
+        self._perform_task_updates()
+        self.app.config['FLAMENCO_ARCHIVE_PURGE_BATCH_SIZE'] = 3
+
+        tasks_coll = self.flamenco.db('tasks')
+        logs_coll = self.flamenco.db('task_logs')
+
+        job_archival.update_mongo('testblob', str(self.job_id))
+
+        self.assertEqual(0, tasks_coll.count_documents({'job': self.job_id}))
+        self.assertEqual(0, logs_coll.count_documents({}))
+
+        # Two batches of tasks, so one pause in between.
+        mock_sleep.assert_called_once_with(0.1)
+        self.assert_job_status('archived')
+
+    @mock.patch('time.sleep')
+    @mock.patch('flamenco.celery.job_archival.stream_job_archive')
+    def test_archive_job_resumes_interrupted_purge(self, mock_stream, mock_sleep):
+        from flamenco.celery import job_archival
+
+        self._perform_task_updates()
+        self.app.config['FLAMENCO_ARCHIVE_PURGE_BATCH_SIZE'] = 3
+        self.force_job_status('archiving')
+
+        # Crash after purging the first batch of tasks.
+        mock_sleep.side_effect = [RuntimeError('worker crashed')]
+        with self.assertRaises(RuntimeError):
+            job_archival.update_mongo('flamenco-jobs/archive.zip', str(self.job_id))
+
+        tasks_coll = self.flamenco.db('tasks')
+        jobs_coll = self.flamenco.db('jobs')
+        self.assertEqual(1, tasks_coll.count_documents({'job': self.job_id}))
+        self.assertEqual('flamenco-jobs/archive.zip',
+                         jobs_coll.find_one(self.job_id)['archive_blob_name'])
+
+        # Resuming should purge the remaining task, and not create a new archive.
+        mock_sleep.side_effect = None
+        job_archival.archive_job(str(self.job_id))
+
+        mock_stream.assert_not_called()
+        self.assertEqual(0, tasks_coll.count_documents({'job': self.job_id}))
+        self.assertEqual(0, self.flamenco.db('task_logs').count_documents({}))
+        self.assertEqual('flamenco-jobs/archive.zip',
+                         jobs_coll.find_one(self.job_id)['archive_blob_name'])
+        self.assert_job_status('archived')
+
     @mock.patch('celery.group')
     def test_write_job_as_json(self, mocked_group):
         import tempfile
 
+        self.app.config['FLAMENCO_ARCHIVE_STREAMING'] = False
         self.force_job_status('completed')
         jobs_coll = self.flamenco.db('jobs')
         job = jobs_coll.find_one(self.job_id)
@@ -250,6 +418,119 @@ class CleanOrphanLogsTest(AbstractJobArchivalTest):
                       json=update_batch,
                       auth_token=self.mngr_token)
 
+    def test_orphan_log_cleanup_set_difference(self):
+        from flamenco import cli
+
+        logs_coll = self.flamenco.db('task_logs')
+        self._perform_task_updates()
+
+        # Orphans of non-existant tasks, both with and without job ID.
+        now = datetime.datetime.now(tz=bson.tz_util.utc)
+        orphan_task_ids = [bson.ObjectId() for _ in range(3)]
+        for orphan_idx, task_id in enumerate(orphan_task_ids):
+            logs_coll.insert_many([{
+                "task": task_id,
+                "received_on_manager": now,
+                "log": f"{now}: orphan log entry #{orphan_idx}.{entry_idx}"
+            } for entry_idx in range(5)])
+        logs_coll.insert_one({
+            "task": bson.ObjectId(),
+            "job": bson.ObjectId(),
+            "received_on_manager": now,
+            "log": f"{now}: orphan log entry of non-existant job"
+        })
+        self.assertEqual(self.TASK_COUNT * self.UPDATES_PER_TASK + 16,
+                         logs_coll.count_documents({}))
+
+        cli.delete_orphan_task_logs(set_difference=True)
+
+        self.assertEqual(self.TASK_COUNT * self.UPDATES_PER_TASK,
+                         logs_coll.count_documents({'task': {'$in': self.task_ids}}))
+        self.assertEqual(self.TASK_COUNT * self.UPDATES_PER_TASK,
+                         logs_coll.count_documents({}))
+
+        # A completed run shouldn't leave a checkpoint.
+        self.assertEqual(0, self.flamenco.db('cli_checkpoints').count_documents({}))
+
+    @mock.patch('flamenco.cli.ORPHAN_LOG_BATCH_SIZE', 2)
+    def test_orphan_log_cleanup_set_difference_batched(self):
+        from flamenco import cli
+
+        logs_coll = self.flamenco.db('task_logs')
+        self._perform_task_updates()
+
+        now = datetime.datetime.now(tz=bson.tz_util.utc)
+        logs_coll.insert_many([{
+            "task": bson.ObjectId(),
+            "job": bson.ObjectId(),
+            "received_on_manager": now,
+            "log": f"{now}: orphan log entry of non-existant job #{job_idx}"
+        } for job_idx in range(5)])
+
+        cli.delete_orphan_task_logs(set_difference=True)
+
+        self.assertEqual(self.TASK_COUNT * self.UPDATES_PER_TASK,
+                         logs_coll.count_documents({}))
+
+    def test_orphan_log_cleanup_set_difference_resume(self):
+        from flamenco import cli
+
+        logs_coll = self.flamenco.db('task_logs')
+        self._perform_task_updates()
+
+        now = datetime.datetime.now(tz=bson.tz_util.utc)
+        skipped_ids = logs_coll.insert_many([{
+            # Only the job phase would remove this one, and it is skipped.
+            "task": self.task_ids[0],
+            "job": bson.ObjectId(),
+            "received_on_manager": now,
+            "log": f"{now}: log entry of non-existant job",
+        }, {
+            # This task was checked by the interrupted run.
+            "task": bson.ObjectId(24 * '0'),
+            "received_on_manager": now,
+            "log": f"{now}: orphan log entry before the checkpoint",
+        }]).inserted_ids
+        logs_coll.insert_one({
+            "task": bson.ObjectId(),
+            "received_on_manager": now,
+            "log": f"{now}: orphan log entry after the checkpoint",
+        })
+        self.flamenco.db('cli_checkpoints').insert_one({
+            '_id': 'delete_orphan_task_logs',
+            'jobs_done': True,
+            'last_task': bson.ObjectId(24 * '1'),
+        })
+
+        cli.delete_orphan_task_logs(set_difference=True, resume=True)
+
+        self.assertEqual(self.TASK_COUNT * self.UPDATES_PER_TASK + 2,
+                         logs_coll.count_documents({}))
+        self.assertEqual(2, logs_coll.count_documents({'_id': {'$in': skipped_ids}}))
+        self.assertEqual(0, self.flamenco.db('cli_checkpoints').count_documents({}))
+
+    def test_backfill_task_log_jobs(self):
+        from flamenco import cli
+
+        logs_coll = self.flamenco.db('task_logs')
+        self._perform_task_updates()
+        self.assertEqual(self.TASK_COUNT * self.UPDATES_PER_TASK,
+                         logs_coll.count_documents({'job': self.job_id}))
+
+        # Mimick log entries stored by older versions of Flamenco.
+        logs_coll.update_many({}, {'$unset': {'job': True}})
+        orphan_id = logs_coll.insert_one({
+            'task': bson.ObjectId(),
+            'received_on_manager': utcnow(),
+            'log': 'orphan log entry',
+        }).inserted_id
+
+        cli.backfill_task_log_jobs()
+
+        self.assertEqual(self.TASK_COUNT * self.UPDATES_PER_TASK,
+                         logs_coll.count_documents({'job': self.job_id}))
+        self.assertNotIn('job', logs_coll.find_one(orphan_id))
+
     def test_orphan_log_cleanup(self):
         from flamenco import cli
 
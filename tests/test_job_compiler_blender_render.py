@@ -62,13 +62,13 @@ class BlenderRenderTest(AbstractFlamencoTest):
         # - 1 move-to-final task
         # so that's 4 tasks in total.
         task_ids = [ObjectId() for _ in range(4)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_render.BlenderRender(
             task_manager=task_manager, job_manager=job_manager)
         compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             # Render tasks
             mock.call(
                 job_doc,
@@ -167,13 +167,13 @@ class BlenderRenderTest(AbstractFlamencoTest):
         # - 1 move-to-final task
         # so that's 5 tasks in total.
         task_ids = [ObjectId() for _ in range(5)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_render.BlenderRender(
             task_manager=task_manager, job_manager=job_manager)
         compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             # Override task
             mock.call(
                 job_doc,
@@ -284,7 +284,7 @@ class BlenderRenderTest(AbstractFlamencoTest):
         # - 1 move-to-final task.
         # so that's 4 tasks in total.
         task_ids = [ObjectId() for _ in range(4)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_render.BlenderRender(
             task_manager=task_manager, job_manager=job_manager)
@@ -292,7 +292,7 @@ class BlenderRenderTest(AbstractFlamencoTest):
         with self.app.app_context():
             compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             # Render tasks
             mock.call(
                 job_doc,
@@ -392,7 +392,7 @@ class BlenderRenderTest(AbstractFlamencoTest):
         # - 1 move-to-final task.
         # so that's 3 tasks in total.
         task_ids = [ObjectId() for _ in range(4)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_render.BlenderRender(
             task_manager=task_manager, job_manager=job_manager)
@@ -400,7 +400,7 @@ class BlenderRenderTest(AbstractFlamencoTest):
         with self.app.app_context():
             compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             # Render tasks
             mock.call(
                 job_doc,
@@ -486,7 +486,7 @@ class BlenderRenderTest(AbstractFlamencoTest):
         # - 1 move-to-final task.
         # so that's 2 tasks in total.
         task_ids = [ObjectId() for _ in range(2)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_render.BlenderRender(
             task_manager=task_manager, job_manager=job_manager)
@@ -494,7 +494,7 @@ class BlenderRenderTest(AbstractFlamencoTest):
         with self.app.app_context():
             compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             # Render tasks
             mock.call(
                 job_doc,
@@ -568,7 +568,7 @@ class BlenderRenderTest(AbstractFlamencoTest):
         # - 1 move-to-final task.
         # so that's 4 tasks in total.
         task_ids = [ObjectId() for _ in range(4)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_render.BlenderRender(
             task_manager=task_manager, job_manager=job_manager)
@@ -576,7 +576,7 @@ class BlenderRenderTest(AbstractFlamencoTest):
         with self.app.app_context():
             compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             # Render tasks
             mock.call(
                 job_doc,
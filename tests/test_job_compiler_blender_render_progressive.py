@@ -175,14 +175,14 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
         mock_datetime.now.side_effect = [mock_now]
 
         task_ids = [ObjectId() for _ in range(17)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_render_progressive.BlenderRenderProgressive(
             task_manager=task_manager, job_manager=job_manager)
         compiler._uncapped_chunk_count = 3  # Reduce to a testable number of tasks.
         compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             # Pre-existing intermediate directory is destroyed.
             mock.call(  # task 0
                 job_doc,
@@ -520,14 +520,14 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
         mock_datetime.now.side_effect = [mock_now]
 
         task_ids = [ObjectId() for _ in range(17)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_render_progressive.BlenderRenderProgressive(
             task_manager=task_manager, job_manager=job_manager)
         compiler._uncapped_chunk_count = 3  # Reduce to a testable number of tasks.
         compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             # Pre-existing intermediate directory is destroyed.
             mock.call(  # task 0
                 job_doc,
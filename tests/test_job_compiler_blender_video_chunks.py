@@ -65,7 +65,7 @@ class BlenderVideoChunksTest(AbstractFlamencoTest):
         # - 1 move-to-final task
         # so that's 10 tasks in total.
         task_ids = [ObjectId() for _ in range(10)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_video_chunks.BlenderVideoChunks(
             task_manager=task_manager, job_manager=job_manager)
@@ -74,7 +74,7 @@ class BlenderVideoChunksTest(AbstractFlamencoTest):
         frames = '/tmp/render/spring/export/frames'
         expected_final_output = f'/tmp/render/spring/export/' \
                                 f'{self.mock_now:%Y_%m_%d}-sprloing{extension}'
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             mock.call(  # 0
                 job_doc,
                 [commands.MoveOutOfWay(src=frames)],
@@ -247,7 +247,7 @@ class BlenderVideoChunksTest(AbstractFlamencoTest):
         # - 1 move-to-final task
         # so that's 7 tasks in total.
         task_ids = [ObjectId() for _ in range(7)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_batch.return_value.add_task.side_effect = task_ids
 
         compiler = blender_video_chunks.BlenderVideoChunks(
             task_manager=task_manager, job_manager=job_manager)
@@ -256,7 +256,7 @@ class BlenderVideoChunksTest(AbstractFlamencoTest):
         frames = '/tmp/render/spring/export/frames'
         expected_final_output = f'/tmp/render/spring/export/' \
                                 f'{self.mock_now:%Y_%m_%d}-sprloing{extension}'
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             mock.call(  # 0
                 job_doc,
                 [commands.MoveOutOfWay(src=frames)],
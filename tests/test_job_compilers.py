@@ -45,6 +45,7 @@ class SleepSimpleTest(unittest.TestCase):
         compiler.compile(job_doc)
 
         self._expect_create_task_calls(task_manager, job_doc)
+        task_manager.task_batch.return_value.flush.assert_called_once_with()
 
         # Both calls should be performed with the same 'now'.
         task_manager.api_set_task_status_for_job.assert_called_with(
@@ -54,7 +55,7 @@ class SleepSimpleTest(unittest.TestCase):
     def _expect_create_task_calls(self, task_manager, job_doc):
         from flamenco.job_compilers import commands
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_batch.return_value.add_task.assert_has_calls([
             mock.call(
                 job_doc,
                 [
@@ -0,0 +1,72 @@
+import unittest
+
+from bson import ObjectId
+
+
+class JobGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.job_id = ObjectId()
+        self.tids = [ObjectId() for _ in range(5)]
+        t = self.tids
+
+        #   0 → 1 → 2
+        #    ↘-----↗
+        #   3       4 (its parent is not part of the job)
+        self.tasks = [
+            {'_id': t[0], 'status': 'completed', 'priority': 0},
+            {'_id': t[1], 'status': 'failed', 'priority': 1, 'parents': [t[0]]},
+            {'_id': t[2], 'status': 'queued', 'priority': 2, 'parents': [t[0], t[1]]},
+            {'_id': t[3], 'status': 'queued', 'priority': 3},
+            {'_id': t[4], 'status': 'queued', 'priority': 4, 'parents': [ObjectId()]},
+        ]
+
+    def graph(self):
+        from flamenco.jobs.graph import JobGraph
+
+        return JobGraph.from_tasks(self.job_id, self.tasks)
+
+    def test_adjacency(self):
+        t = self.tids
+        graph = self.graph()
+
+        self.assertEqual(5, len(graph))
+        self.assertIn(t[2], graph)
+        self.assertNotIn(ObjectId(), graph)
+
+        self.assertEqual([t[1], t[2]], graph.children(t[0]))
+        self.assertEqual([t[0], t[1]], graph.parents(t[2]))
+        self.assertEqual([], graph.parents(t[4]))
+        self.assertEqual('failed', graph.status(t[1]))
+        self.assertEqual(3, graph.priority(t[3]))
+
+    def test_roots_and_enders(self):
+        t = self.tids
+        graph = self.graph()
+
+        self.assertEqual([t[0], t[3], t[4]], graph.roots())
+        self.assertEqual([t[2], t[3], t[4]], graph.enders())
+
+    def test_descendants_and_ancestors(self):
+        t = self.tids
+        graph = self.graph()
+
+        self.assertEqual([t[1], t[2]], graph.descendants(t[0]))
+        self.assertEqual([], graph.descendants(t[2]))
+        self.assertEqual({t[0], t[1]}, set(graph.ancestors(t[2])))
+
+    def test_topological_order(self):
+        t = self.tids
+        order = self.graph().topological_order()
+
+        self.assertEqual(set(t), set(order))
+        self.assertLess(order.index(t[0]), order.index(t[1]))
+        self.assertLess(order.index(t[1]), order.index(t[2]))
+
+    def test_cycle(self):
+        t = self.tids
+        self.tasks[0]['parents'] = [t[2]]
+        graph = self.graph()
+
+        self.assertEqual({t[0], t[1], t[2]}, set(graph.descendants(t[0])))
+        with self.assertRaises(ValueError):
+            graph.topological_order()
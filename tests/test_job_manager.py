@@ -1,5 +1,7 @@
 from unittest import mock
 
+from bson import ObjectId
+
 from pillar.tests import common_test_data as ctd
 from abstract_flamenco_test import AbstractFlamencoTest
 
@@ -36,6 +38,8 @@ class JobManagerTest(AbstractFlamencoTest):
 
             self.assertEqual('Wörk wørk w°rk.', job['description'])
             self.assertEqual('sleep', job['job_type'])
+            self.assertEqual({'count': 2, 'under-construction': 0, 'queued': 2},
+                             job['tasks_status'])
 
         # Test the tasks
         with self.app.test_request_context():
@@ -66,6 +70,178 @@ class JobManagerTest(AbstractFlamencoTest):
                 }
             }, task['commands'][1])
 
+    @mock.patch('flamenco.celery.job_compilation.compile_job')
+    def test_create_job_async_compilation(self, mock_compile_job):
+        from pillar.api.utils.authentication import force_cli_user
+
+        manager, _, _ = self.create_manager_service_account()
+        self.app.config['FLAMENCO_ASYNC_JOB_COMPILATION'] = True
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'test job',
+                'Wörk wørk w°rk.',
+                'sleep',
+                {
+                    'frames': '12-18, 20-22',
+                    'chunk_size': 5,
+                    'time_in_seconds': 3,
+                },
+                self.proj_id,
+                ctd.EXAMPLE_PROJECT_OWNER_ID,
+                manager['_id'],
+            )
+        job_id = job['_id']
+
+        mock_compile_job.delay.assert_called_once_with(str(job_id), mock.ANY)
+        reason = mock_compile_job.delay.call_args[0][1]
+
+        with self.app.test_request_context():
+            jobs_coll = self.flamenco.db('jobs')
+            tasks_coll = self.flamenco.db('tasks')
+
+            db_job = jobs_coll.find_one(job_id)
+            self.assertEqual('under-construction', db_job['status'])
+            self.assertEqual({'count': 0}, db_job['tasks_status'])
+            self.assertEqual(0, tasks_coll.count_documents({}))
+
+            # This is what the Celery task does.
+            self.jmngr.api_compile_job(job_id, reason=reason)
+
+            db_job = jobs_coll.find_one(job_id)
+            self.assertEqual('queued', db_job['status'])
+            self.assertEqual(2, db_job['tasks_status']['count'])
+            self.assertEqual(2, tasks_coll.count_documents({'status': 'queued'}))
+
+    @mock.patch('flamenco.celery.job_compilation.compile_job')
+    def test_compile_job_failure(self, mock_compile_job):
+        from pillar.api.utils.authentication import force_cli_user
+
+        manager, _, _ = self.create_manager_service_account()
+        self.app.config['FLAMENCO_ASYNC_JOB_COMPILATION'] = True
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'test job', 'Wörk wørk w°rk.', 'sleep',
+                {'frames': '12-18, 20-22', 'chunk_size': 5, 'time_in_seconds': 3},
+                self.proj_id, ctd.EXAMPLE_PROJECT_OWNER_ID, manager['_id'],
+            )
+        job_id = job['_id']
+        mock_compile_job.delay.assert_called_once_with(str(job_id), mock.ANY)
+
+        with self.app.test_request_context(), \
+                mock.patch('flamenco.job_compilers.compile_job') as mock_compile:
+            mock_compile.side_effect = KeyError('frames')
+            self.jmngr.api_compile_job(job_id, reason='unittest')
+
+            db_job = self.flamenco.db('jobs').find_one(job_id)
+            self.assertEqual('construction-failed', db_job['status'])
+            self.assertIn('compilation failed', db_job['status_reason'])
+
+    def _create_async_job(self, manager_id: ObjectId) -> ObjectId:
+        from pillar.api.utils.authentication import force_cli_user
+
+        self.app.config['FLAMENCO_ASYNC_JOB_COMPILATION'] = True
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'test job', 'Wörk wørk w°rk.', 'sleep',
+                {'frames': '12-18, 20-22', 'chunk_size': 5, 'time_in_seconds': 3},
+                self.proj_id, ctd.EXAMPLE_PROJECT_OWNER_ID, manager_id,
+            )
+        return job['_id']
+
+    @mock.patch('flamenco.celery.job_compilation.compile_job')
+    def test_compile_job_scheduling_failure(self, mock_compile_job):
+        manager, _, _ = self.create_manager_service_account()
+        mock_compile_job.delay.side_effect = ConnectionError('broker is down')
+        job_id = self._create_async_job(manager['_id'])
+
+        with self.app.test_request_context():
+            db_job = self.flamenco.db('jobs').find_one(job_id)
+            self.assertEqual('construction-failed', db_job['status'])
+            self.assertIn('scheduling compilation failed', db_job['status_reason'])
+
+    @mock.patch('flamenco.celery.job_compilation.compile_job')
+    def test_resume_job_compilation(self, mock_compile_job):
+        import datetime
+        from pillar.api.utils import utcnow
+        from flamenco.celery import job_compilation
+
+        manager, _, _ = self.create_manager_service_account()
+        lost_job_id = self._create_async_job(manager['_id'])
+        halfway_job_id = self._create_async_job(manager['_id'])
+        recent_job_id = self._create_async_job(manager['_id'])
+        mock_compile_job.delay.reset_mock()
+
+        with self.app.test_request_context():
+            jobs_coll = self.flamenco.db('jobs')
+            long_ago = utcnow() - datetime.timedelta(hours=2)
+            jobs_coll.update_many({'_id': {'$in': [lost_job_id, halfway_job_id]}},
+                                  {'$set': {'_updated': long_ago}})
+            jobs_coll.update_one({'_id': halfway_job_id}, {'$set': {'tasks_status.count': 1}})
+
+            job_compilation.resume_job_compilation()
+
+            mock_compile_job.delay.assert_called_once_with(str(lost_job_id), mock.ANY)
+            self.assertEqual('under-construction', jobs_coll.find_one(lost_job_id)['status'])
+            self.assertGreater(jobs_coll.find_one(lost_job_id)['_updated'], long_ago)
+            self.assertEqual('construction-failed',
+                             jobs_coll.find_one(halfway_job_id)['status'])
+            self.assertEqual('under-construction', jobs_coll.find_one(recent_job_id)['status'])
+
+
+class JobDepsgraphViewTest(AbstractFlamencoTest):
+    def test_depsgraph_elements(self):
+        from pillar.api.utils.authentication import force_cli_user
+        from flamenco.job_compilers import commands
+        from flamenco.jobs.graph import JobGraph
+        from flamenco.jobs.routes import _depsgraph_elements
+
+        manager, _, _ = self.create_manager_service_account()
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job_doc = self.jmngr.api_create_job(
+                'test job',
+                'Wörk wørk w°rk.',
+                'sleep',
+                {
+                    'frames': '12-18, 20-22',
+                    'chunk_size': 5,
+                    'time_in_seconds': 3,
+                },
+                self.proj_id,
+                ctd.EXAMPLE_PROJECT_OWNER_ID,
+                manager['_id'],
+            )
+            job_id = job_doc['_id']
+            root_ids = [t['_id'] for t in self.flamenco.db('tasks').find({'job': job_id})]
+            child_id = self.tmngr.api_create_task(
+                job_doc, [commands.Echo(message='ẑžƶźz')], 'child', parents=root_ids,
+                task_type='sleep')
+
+            graph = JobGraph.load(job_id)
+            elements = _depsgraph_elements(graph)
+            self.assertEqual({str(tid) for tid in root_ids}, set(elements['roots']))
+
+            nodes = {item['data']['id']: item['data']
+                     for item in elements['elements'] if item['group'] == 'nodes'}
+            edges = {(item['data']['source'], item['data']['target'])
+                     for item in elements['elements'] if item['group'] == 'edges'}
+            self.assertEqual(3, len(nodes))
+            self.assertEqual('child', nodes[str(child_id)]['label'])
+            self.assertEqual({(str(tid), str(child_id)) for tid in root_ids}, edges)
+
+            # Focusing on the child task should mark it as such.
+            elements = _depsgraph_elements(graph, child_id)
+            focussed = [item['data']['id'] for item in elements['elements']
+                        if item['group'] == 'nodes' and item['data']['focus']]
+            self.assertEqual([str(child_id)], focussed)
+
 
 class JobStatusChangeTest(AbstractFlamencoTest):
     def setUp(self, **kwargs):
@@ -134,6 +310,26 @@ class JobStatusChangeTest(AbstractFlamencoTest):
                          "Task %i:\n   has status: '%s'\n but expected: '%s'" % (
                              task_idx, task['status'], expected_status))
 
+    def test_tasks_status_counters(self):
+        with self.app.app_context():
+            jobs_coll = self.flamenco.db('jobs')
+            job = jobs_coll.find_one(self.job_id)
+            recounted = self.jmngr.api_recount_task_statuses(self.job_id)
+
+        maintained = {status: count for status, count in job['tasks_status'].items() if count}
+        self.assertEqual(recounted, maintained)
+        self.assertEqual(1, maintained['soft-failed'])
+        self.assertNotIn('under-construction', maintained)
+
+        with self.app.app_context():
+            # Legacy jobs without counters should get them from counting their tasks.
+            jobs_coll.update_one({'_id': self.job_id}, {'$unset': {'tasks_status': True}})
+            counts = self.jmngr.task_status_counts(self.job_id)
+            job = jobs_coll.find_one(self.job_id)
+
+        self.assertEqual(recounted, job['tasks_status'])
+        self.assertEqual(recounted['count'], sum(counts.values()))
+
     def test_status_from_queued_to_active(self):
         # This shouldn't change any of the tasks.
         self.force_job_status('queued')
@@ -240,8 +436,7 @@ class JobStatusChangeTest(AbstractFlamencoTest):
         with self.app.app_context():
             # Update all tasks, including the file management task that is
             # otherwise ignored by the tests.
-            tasks_coll = self.app.db('flamenco_tasks')
-            tasks_coll.update_many({'job': self.job_id}, {'$set': {'status': 'completed'}})
+            self.flamenco.update_status_q('tasks', {'job': self.job_id}, 'completed')
         self.force_job_status('canceled')
 
         # This should re-queue all non-completed tasks, see that they are all
@@ -157,6 +157,26 @@ class JobPatchingTest(AbstractFlamencoTest):
             self.job_id, from_status='failed', to_status='queued')
         self.assert_job_status('active')
 
+    @mock.patch('flamenco.jobs.JobManager.handle_job_status_change')
+    def test_job_doc_cached(self, mock_handle_job_status_change):
+        from pillar.api.utils.authentication import force_cli_user
+        from flamenco import request_cache
+
+        mock_handle_job_status_change.return_value = ''
+        self.force_job_status('queued')
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.job_doc(self.job_id)
+            self.assertEqual({'_id': self.job_id, 'project': self.proj_id, 'status': 'queued'},
+                             job)
+            self.assertIs(job, self.jmngr.job_doc(self.job_id))
+            self.assertEqual({'hits': 1, 'misses': 1}, request_cache.stats()['jobs'])
+
+            # Status changes made through the JobManager invalidate the cache.
+            self.jmngr.api_set_job_status(self.job_id, 'paused')
+            self.assertEqual('paused', self.jmngr.job_doc(self.job_id)['status'])
+
 
 class AbstractRNAOverridesTest(AbstractFlamencoTest):
 
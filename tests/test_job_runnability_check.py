@@ -1,3 +1,5 @@
+from unittest import mock
+
 from bson import ObjectId
 
 from pillar.tests import common_test_data as ctd
@@ -118,3 +120,51 @@ class JobRunnabilityTest(AbstractFlamencoTest):
 
         jrc.runnability_check(str(self.job_id))
         self.assert_job_status('fail-requested')
+
+    def test_failed_tasks_check(self):
+        self.job_id = self.create_job('blender-render')
+
+        tasks = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        self.assertIn(tasks[0]['_id'], tasks[-1]['parents'])
+        self.force_job_status('active')
+
+        self.enter_app_context()
+
+        from flamenco.celery import job_runnability_check as jrc
+
+        task0_id = ObjectId(tasks[0]['_id'])
+        task1_id = ObjectId(tasks[1]['_id'])
+        self.force_task_status(task0_id, 'failed')
+        self.force_task_status(task1_id, 'failed')
+
+        # Only the first failure should schedule a check.
+        with mock.patch('flamenco.celery.job_runnability_check.failed_tasks_check') as mock_check:
+            jrc.mark_failed_tasks(self.job_id, [task0_id])
+            jrc.mark_failed_tasks(self.job_id, [task1_id])
+        mock_check.apply_async.assert_called_once_with((str(self.job_id),), countdown=30.0)
+
+        marked = self.flamenco.db('runnability_checks').find_one(self.job_id)
+        self.assertEqual([task0_id, task1_id], marked['failed_tasks'])
+
+        jrc.failed_tasks_check(str(self.job_id))
+        self.assert_job_status('fail-requested')
+        self.assertIsNone(self.flamenco.db('runnability_checks').find_one(self.job_id))
+
+    @mock.patch('flamenco.celery.job_runnability_check.mark_failed_tasks')
+    def test_task_failure_marks_job(self, mock_mark):
+        self.job_id = self.create_job('blender-render')
+        self.app.config['FLAMENCO_RUNNABILITY_CHECK_ON_FAILURE'] = True
+
+        tasks = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        task_id = ObjectId(tasks[0]['_id'])
+
+        self.enter_app_context()
+        self.force_task_status(task_id, 'failed')
+        self.jmngr.update_jobs_after_task_status_changes([
+            (self.job_id, ObjectId(tasks[1]['_id']), 'completed'),
+            (self.job_id, task_id, 'failed'),
+        ])
+
+        mock_mark.assert_called_once_with(self.job_id, [task_id])
@@ -0,0 +1,130 @@
+import datetime
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+
+from abstract_flamenco_test import AbstractFlamencoTest
+
+
+class ManagerAuthCacheTest(unittest.TestCase):
+    def setUp(self):
+        from flamenco.managers.auth_cache import ManagerAuthCache
+
+        self.cache = ManagerAuthCache(max_size=2, ttl=datetime.timedelta(seconds=10))
+        self.account_id = ObjectId()
+        self.mngr_ids = [ObjectId() for _ in range(3)]
+
+    def test_get_put(self):
+        m = self.mngr_ids
+
+        self.assertIsNone(self.cache.get(self.account_id, m[0]))
+        self.cache.put(self.account_id, m[0], True)
+        self.cache.put(self.account_id, m[1], False)
+        self.assertTrue(self.cache.get(self.account_id, m[0]))
+        self.assertFalse(self.cache.get(self.account_id, m[1]))
+
+        stats = self.cache.stats()
+        self.assertEqual(2, stats['size'])
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_size_bound(self):
+        m = self.mngr_ids
+
+        self.cache.put(self.account_id, m[0], True)
+        self.cache.put(self.account_id, m[1], True)
+        self.cache.get(self.account_id, m[0])  # makes m[1] the least recently used.
+        self.cache.put(self.account_id, m[2], True)
+
+        self.assertTrue(self.cache.get(self.account_id, m[0]))
+        self.assertIsNone(self.cache.get(self.account_id, m[1]))
+        self.assertTrue(self.cache.get(self.account_id, m[2]))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    @mock.patch('time.monotonic')
+    def test_expiry(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        self.cache.put(self.account_id, self.mngr_ids[0], True)
+
+        mock_monotonic.return_value = 109.0
+        self.assertTrue(self.cache.get(self.account_id, self.mngr_ids[0]))
+
+        mock_monotonic.return_value = 110.0
+        self.assertIsNone(self.cache.get(self.account_id, self.mngr_ids[0]))
+        self.assertEqual(0, self.cache.stats()['size'])
+
+    @mock.patch('time.monotonic')
+    def test_stats_logged_periodically(self, mock_monotonic):
+        from flamenco.managers.auth_cache import ManagerAuthCache, STATS_LOG_PERIOD
+
+        mock_monotonic.return_value = 100.0
+        cache = ManagerAuthCache()
+
+        with mock.patch.object(cache, '_log') as mock_log:
+            cache.get(self.account_id, self.mngr_ids[0])
+            mock_log.info.assert_not_called()
+
+            mock_monotonic.return_value = 100.0 + STATS_LOG_PERIOD.total_seconds()
+            cache.get(self.account_id, self.mngr_ids[0])
+            mock_log.info.assert_called_once_with('Manager authorisation cache: %s',
+                                                  cache.stats())
+
+            # The period starts again after logging.
+            cache.get(self.account_id, self.mngr_ids[0])
+            self.assertEqual(1, mock_log.info.call_count)
+
+    def test_invalidate_manager(self):
+        m = self.mngr_ids
+        other_account_id = ObjectId()
+
+        self.cache.put(self.account_id, m[0], True)
+        self.cache.put(other_account_id, m[1], False)
+        self.cache.invalidate_manager(m[0])
+
+        self.assertIsNone(self.cache.get(self.account_id, m[0]))
+        self.assertFalse(self.cache.get(other_account_id, m[1]))
+        self.assertEqual(1, self.cache.stats()['invalidations'])
+
+    def test_disabled(self):
+        from flamenco.managers.auth_cache import ManagerAuthCache
+
+        cache = ManagerAuthCache(max_size=0)
+        cache.put(self.account_id, self.mngr_ids[0], True)
+        self.assertIsNone(cache.get(self.account_id, self.mngr_ids[0]))
+
+
+class ManagerAuthCacheUsageTest(AbstractFlamencoTest):
+    def setUp(self, **kwargs):
+        AbstractFlamencoTest.setUp(self, **kwargs)
+
+        mngr_doc, account, token = self.create_manager_service_account()
+        self.mngr_id = mngr_doc['_id']
+        self.mngr_token = token['token']
+
+    def get_depsgraph(self, expected_status=200):
+        return self.get(f'/api/flamenco/managers/{self.mngr_id}/depsgraph',
+                        auth_token=self.mngr_token,
+                        expected_status=expected_status)
+
+    def test_cached_authorisation(self):
+        auth_cache = self.flamenco.manager_manager.auth_cache
+
+        self.get_depsgraph(204)
+        self.get_depsgraph(204)
+        stats = auth_cache.stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['hits'])
+
+        # Sharing the Manager invalidates the cached authorisation.
+        with self.app.test_request_context():
+            from pillar.api.utils.authentication import force_cli_user
+
+            force_cli_user()
+            other_user_id = self.create_user(user_id=24 * 'e', roles={'subscriber'})
+            self.flamenco.manager_manager.share_unshare_manager(
+                self.mngr_id, self.flamenco.manager_manager.ShareAction.share, other_user_id)
+        self.assertEqual(0, auth_cache.stats()['size'])
+
+        self.get_depsgraph(204)
+        self.assertEqual(2, auth_cache.stats()['misses'])
@@ -0,0 +1,352 @@
+"""Query plan regression tests for the hot queries of Flamenco Server.
+
+These tests seed a synthetic render farm directly into MongoDB, run explain()
+on every query registered with @hot_query, and fail when the winning plan
+scans an entire collection or examines far more documents than it returns.
+They need a real mongod, just like the rest of the test suite.
+
+By default the farm is small, to keep the test suite fast; COLLSCAN stages
+are still caught. To check the plans against a farm of realistic size, set the
+FLAMENCO_QUERY_PLAN_TASKS environment variable, for example to 200000.
+"""
+
+import datetime
+import os
+import typing
+
+import attr
+import pymongo
+from bson import ObjectId
+from bson.tz_util import utc
+
+from abstract_flamenco_test import AbstractFlamencoTest
+
+TASK_COUNT = int(os.environ.get('FLAMENCO_QUERY_PLAN_TASKS', 5000))
+PROJECT_COUNT = 5
+TASKS_PER_JOB = 250
+# Every Manager gets at least an active and a queued job.
+MANAGER_COUNT = max(1, min(50, TASK_COUNT // TASKS_PER_JOB // 2))
+LOG_ENTRIES_PER_TASK = 20
+INSERT_BATCH_SIZE = 10000
+
+# A query may examine this many documents per returned document, or
+# MIN_EXAMINED_ALLOWANCE documents in total, whichever is larger.
+MAX_EXAMINED_PER_RETURNED = 2
+MIN_EXAMINED_ALLOWANCE = 1000
+
+
+@attr.s(auto_attribs=True)
+class Farm:
+    """IDs of interesting documents in the synthetic farm."""
+
+    manager_id: ObjectId
+    project_id: ObjectId
+    active_job_id: ObjectId
+    failed_task_ids: typing.List[ObjectId]
+    logged_task_id: ObjectId
+    change_seq_before_active: int
+    updated_before_active: datetime.datetime
+
+
+@attr.s(auto_attribs=True)
+class HotQuery:
+    name: str
+    collection: str  # without 'flamenco_' prefix
+    # Returns (filter, sort) for find queries, or a pipeline for aggregations.
+    build: typing.Callable[[Farm], typing.Union[tuple, list]]
+    # Maximum number of examined documents, instead of the ratio-based check.
+    max_examined: typing.Optional[int] = None
+
+
+HOT_QUERIES: typing.List[HotQuery] = []
+
+
+def hot_query(collection: str, *, max_examined: typing.Optional[int] = None):
+    """Decorator, registers a function that builds a hot query."""
+
+    def decorator(build):
+        HOT_QUERIES.append(HotQuery(build.__name__, collection, build, max_examined))
+        return build
+
+    return decorator
+
+
+@hot_query('jobs')
+def depsgraph_runnable_jobs(farm: Farm):
+    from flamenco.managers.api import DEPSGRAPH_RUNNABLE_JOB_STATUSES
+
+    return {'manager': farm.manager_id,
+            'status': {'$in': DEPSGRAPH_RUNNABLE_JOB_STATUSES}}, None
+
+
+@hot_query('tasks')
+def depsgraph_clean_slate(farm: Farm):
+    from flamenco.managers.api import depsgraph_task_query
+
+    return depsgraph_task_query(farm.manager_id, None, None), None
+
+
+@hot_query('tasks')
+def depsgraph_modified_since(farm: Farm):
+    from flamenco.managers.api import depsgraph_task_query
+
+    modified_since = farm.updated_before_active.isoformat()
+    return depsgraph_task_query(farm.manager_id, None, modified_since), None
+
+
+@hot_query('tasks')
+def depsgraph_incremental(farm: Farm):
+    from flamenco.managers.api import depsgraph_task_query
+
+    return depsgraph_task_query(farm.manager_id, farm.change_seq_before_active, None), None
+
+
+@hot_query('tasks')
+def depsgraph_page(farm: Farm):
+    from flamenco.managers.api import depsgraph_task_query
+
+    query = depsgraph_task_query(farm.manager_id, None, None)
+    return query, [('_id', pymongo.ASCENDING)]
+
+
+@hot_query('tasks')
+def tasks_cancel_requested(farm: Farm):
+    return {'manager': farm.manager_id, 'status': 'cancel-requested'}, None
+
+
+@hot_query('tasks', max_examined=TASKS_PER_JOB)
+def job_task_status_counts(farm: Farm):
+    # Same pipeline as JobManager.api_recount_task_statuses()
+    return [
+        {'$match': {'job': farm.active_job_id}},
+        {'$group': {'_id': '$status', 'count': {'$sum': 1}}},
+    ]
+
+
+@hot_query('tasks')
+def job_graph(farm: Farm):
+    return {'job': farm.active_job_id}, None
+
+
+@hot_query('tasks')
+def runnability_children(farm: Farm):
+    from flamenco.tasks import QUEUED_TASK_STATES
+
+    return {'job': farm.active_job_id,
+            'parents': {'$in': farm.failed_task_ids},
+            'status': {'$in': list(QUEUED_TASK_STATES)}}, None
+
+
+@hot_query('task_logs')
+def task_log_entries(farm: Farm):
+    return {'task': farm.logged_task_id}, [('task', pymongo.ASCENDING),
+                                           ('received_on_manager', pymongo.ASCENDING)]
+
+
+@hot_query('task_logs')
+def archive_task_logs(farm: Farm):
+    from flamenco.celery.job_archival import _task_logs_query
+
+    return _task_logs_query([farm.active_job_id], [farm.logged_task_id]), \
+        [('task', pymongo.ASCENDING), ('received_on_manager', pymongo.ASCENDING)]
+
+
+@hot_query('jobs')
+def jobs_for_project(farm: Farm):
+    return {'project': farm.project_id, 'status': {'$ne': 'archived'}}, None
+
+
+@hot_query('managers')
+def managers_for_project(farm: Farm):
+    return {'projects': farm.project_id}, None
+
+
+def _active_task_status(task_idx: int) -> str:
+    """Task status distribution of the active jobs."""
+    if task_idx % 50 == 1:
+        return 'failed'
+    return ['completed', 'completed', 'queued', 'queued', 'queued', 'queued', 'queued',
+            'claimed-by-manager', 'active', 'soft-failed', 'cancel-requested',
+            'queued', 'queued', 'queued', 'queued', 'queued', 'queued', 'queued', 'queued',
+            'queued'][task_idx % 20]
+
+
+def seed_farm(db) -> Farm:
+    """Inserts managers, jobs, tasks and task logs directly into MongoDB.
+
+    Every Manager has one active job, one queued job, and a number of completed
+    jobs. The tasks of the completed jobs are inserted (and thus updated) first.
+    """
+
+    now = datetime.datetime.now(tz=utc)
+    long_ago = now - datetime.timedelta(days=30)
+    project_ids = [ObjectId() for _ in range(PROJECT_COUNT)]
+    manager_ids = [ObjectId() for _ in range(MANAGER_COUNT)]
+    jobs_per_manager = max(2, TASK_COUNT // TASKS_PER_JOB // MANAGER_COUNT)
+
+    db.flamenco_managers.insert_many([
+        {'_id': manager_id, 'name': f'manager {idx}', 'owner': ObjectId(),
+         'service_account': ObjectId(), 'projects': [project_ids[idx % PROJECT_COUNT]]}
+        for idx, manager_id in enumerate(manager_ids)])
+
+    jobs = []
+    for mngr_idx, manager_id in enumerate(manager_ids):
+        for job_idx in range(jobs_per_manager):
+            status = {0: 'active', 1: 'queued'}.get(job_idx, 'completed')
+            jobs.append({'_id': ObjectId(), 'name': f'job {mngr_idx}-{job_idx}',
+                         'manager': manager_id, 'project': project_ids[mngr_idx % PROJECT_COUNT],
+                         'status': status, 'job_type': 'sleep'})
+    # Completed jobs first, so that their tasks have the oldest change sequence numbers.
+    jobs.sort(key=lambda job: job['status'] != 'completed')
+
+    change_seq = 0
+    change_seq_before_active = None
+    tasks: typing.List[dict] = []
+    failed_task_ids: typing.Dict[ObjectId, typing.List[ObjectId]] = {}
+    for job in jobs:
+        recent = job['status'] != 'completed'
+        if recent and change_seq_before_active is None:
+            change_seq_before_active = change_seq
+        for task_idx in range(TASKS_PER_JOB):
+            change_seq += 1
+            if job['status'] == 'active':
+                status = _active_task_status(task_idx)
+            elif job['status'] == 'queued':
+                status = 'queued'
+            else:
+                status = 'completed'
+            task = {
+                '_id': ObjectId(),
+                'job': job['_id'],
+                'manager': job['manager'],
+                'project': job['project'],
+                'name': f'task {task_idx}',
+                'status': status,
+                'priority': 50,
+                'job_priority': 50,
+                'change_seq': change_seq,
+                '_updated': now if recent else long_ago,
+            }
+            if task_idx:
+                task['parents'] = [tasks[-1]['_id']]
+            if status == 'failed':
+                failed_task_ids.setdefault(job['_id'], []).append(task['_id'])
+            tasks.append(task)
+
+    db.flamenco_jobs.insert_many(jobs)
+    for start in range(0, len(tasks), INSERT_BATCH_SIZE):
+        db.flamenco_tasks.insert_many(tasks[start:start + INSERT_BATCH_SIZE], ordered=False)
+
+    manager_id = manager_ids[0]
+    active_job = next(job for job in jobs
+                      if job['manager'] == manager_id and job['status'] == 'active')
+    active_tasks = [task for task in tasks if task['job'] == active_job['_id']]
+
+    db.flamenco_task_logs.insert_many([
+        {'task': task['_id'], 'job': task['job'], 'log': f'line {line_idx}\n',
+         'received_on_manager': long_ago + datetime.timedelta(seconds=line_idx)}
+        for task in active_tasks[:50]
+        for line_idx in range(LOG_ENTRIES_PER_TASK)])
+
+    return Farm(
+        manager_id=manager_id,
+        project_id=active_job['project'],
+        active_job_id=active_job['_id'],
+        failed_task_ids=failed_task_ids[active_job['_id']],
+        logged_task_id=active_tasks[10]['_id'],
+        change_seq_before_active=change_seq_before_active,
+        updated_before_active=now - datetime.timedelta(minutes=1),
+    )
+
+
+def winning_plan_stages(explanation: dict) -> typing.Set[str]:
+    """Returns the names of the stages of the winning plan(s) in the explain() output."""
+
+    stages = set()
+
+    def walk(node, in_winning_plan: bool):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key in {'rejectedPlans', 'allPlansExecution'}:
+                    continue
+                if key == 'stage' and in_winning_plan:
+                    stages.add(value)
+                walk(value, in_winning_plan or key == 'winningPlan')
+        elif isinstance(node, list):
+            for item in node:
+                walk(item, in_winning_plan)
+
+    walk(explanation, False)
+    return stages
+
+
+def execution_stats(explanation: dict) -> typing.Optional[dict]:
+    """Returns the first 'executionStats' in the explain() output."""
+
+    if isinstance(explanation, dict):
+        if 'executionStats' in explanation:
+            return explanation['executionStats']
+        children = explanation.values()
+    elif isinstance(explanation, list):
+        children = explanation
+    else:
+        return None
+
+    for child in children:
+        found = execution_stats(child)
+        if found is not None:
+            return found
+    return None
+
+
+class QueryPlanTest(AbstractFlamencoTest):
+    def explain(self, db, query: HotQuery, farm: Farm) -> dict:
+        coll_name = f'flamenco_{query.collection}'
+        built = query.build(farm)
+
+        if isinstance(built, list):
+            return db.command('explain',
+                              {'aggregate': coll_name, 'pipeline': built, 'cursor': {}},
+                              verbosity='executionStats')
+
+        query_filter, sort = built
+        self.assertIsNotNone(query_filter, f'{query.name} did not produce a query')
+        return db[coll_name].find(query_filter, sort=sort).explain()
+
+    def test_hot_queries(self):
+        with self.app.test_request_context():
+            db = self.app.db()
+            farm = seed_farm(db)
+
+            for query in HOT_QUERIES:
+                with self.subTest(query.name):
+                    explanation = self.explain(db, query, farm)
+
+                    stages = winning_plan_stages(explanation)
+                    self.assertTrue(stages, f'{query.name}: no winning plan in {explanation}')
+                    self.assertNotIn('COLLSCAN', stages,
+                                     f'{query.name} performs a collection scan')
+
+                    stats = execution_stats(explanation)
+                    self.assertIsNotNone(stats, f'{query.name}: no execution stats')
+                    examined = stats['totalDocsExamined']
+                    if query.max_examined is not None:
+                        limit = query.max_examined
+                    else:
+                        limit = max(MAX_EXAMINED_PER_RETURNED * stats['nReturned'],
+                                    MIN_EXAMINED_ALLOWANCE)
+                    self.assertLessEqual(
+                        examined, limit,
+                        f'{query.name} examined {examined} documents to return '
+                        f'{stats["nReturned"]}')
+
+    def test_collscan_detected(self):
+        """Guards the harness itself: an unindexed query must be caught."""
+
+        with self.app.app_context():
+            db = self.app.db()
+            db.flamenco_tasks.insert_many([{'name': f'task {idx}'} for idx in range(10)])
+            explanation = db.flamenco_tasks.find({'name': 'task 3'}).explain()
+
+        self.assertIn('COLLSCAN', winning_plan_stages(explanation))
+        self.assertEqual(10, execution_stats(explanation)['totalDocsExamined'])
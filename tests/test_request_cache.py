@@ -0,0 +1,84 @@
+from unittest import mock
+
+from bson import ObjectId
+
+from abstract_flamenco_test import AbstractFlamencoTest
+
+
+class RequestCacheTest(AbstractFlamencoTest):
+    def test_hits_and_misses(self):
+        from flamenco import request_cache
+
+        fetch = mock.Mock(return_value='value')
+        with self.app.test_request_context():
+            cache = request_cache.cache('test')
+            self.assertIs(cache, request_cache.cache('test'))
+
+            self.assertEqual('value', cache.get('key', fetch))
+            self.assertEqual('value', cache.get('key', fetch))
+            fetch.assert_called_once_with()
+            self.assertEqual({'test': {'hits': 1, 'misses': 1}}, request_cache.stats())
+
+            request_cache.invalidate('test', 'key')
+            cache.get('key', fetch)
+            self.assertEqual(2, fetch.call_count)
+
+        # A new request starts with empty caches.
+        with self.app.test_request_context():
+            self.assertEqual({}, request_cache.stats())
+            request_cache.cache('test').get('key', fetch)
+            self.assertEqual(3, fetch.call_count)
+
+    def test_none_is_cached(self):
+        from flamenco import request_cache
+
+        fetch = mock.Mock(return_value=None)
+        with self.app.test_request_context():
+            cache = request_cache.cache('test')
+            self.assertIsNone(cache.get('key', fetch))
+            self.assertIsNone(cache.get('key', fetch))
+            fetch.assert_called_once_with()
+
+    def test_no_request_context(self):
+        from flamenco import request_cache
+
+        fetch = mock.Mock(return_value='value')
+        with self.app.app_context():
+            request_cache.cache('test').get('key', fetch)
+            request_cache.cache('test').get('key', fetch)
+            self.assertEqual(2, fetch.call_count)
+            self.assertEqual({}, request_cache.stats())
+
+    def test_manager_doc(self):
+        from pillar.api.utils.authentication import force_cli_user
+        from flamenco import request_cache
+
+        mngr_doc, _, _ = self.create_manager_service_account()
+        mngr_id = mngr_doc['_id']
+        mngr_man = self.flamenco.manager_manager
+
+        with self.app.test_request_context():
+            force_cli_user()
+            mngr_coll = self.flamenco.db('managers')
+
+            self.assertEqual(mngr_id, mngr_man.manager_doc(mngr_id)['_id'])
+            self.assertEqual(mngr_id, mngr_man.manager_doc(mngr_id)['_id'])
+            self.assertEqual({'hits': 1, 'misses': 1}, request_cache.stats()['managers'])
+
+            # Changes made through the ManagerManager invalidate the cache.
+            mngr_man.api_assign_to_project(mngr_id, self.proj_id, 'assign')
+            self.assertEqual([self.proj_id], mngr_man.manager_doc(mngr_id)['projects'])
+
+            job_id, task_id = ObjectId(), ObjectId()
+            mngr_man.queue_task_log_request(mngr_id, job_id, task_id)
+            self.assertEqual([{'job': job_id, 'task': task_id}],
+                             mngr_man.manager_doc(mngr_id)['upload_task_file_queue'])
+            mngr_man.dequeue_task_log_request(mngr_id, task_id)
+            self.assertEqual([], mngr_man.manager_doc(mngr_id)['upload_task_file_queue'])
+
+            # Changes made behind its back are not seen during the request.
+            mngr_coll.update_one({'_id': mngr_id}, {'$set': {'name': 'changed'}})
+            self.assertNotEqual('changed', mngr_man.manager_doc(mngr_id)['name'])
+
+        with self.app.test_request_context():
+            self.assertEqual('changed', mngr_man.manager_doc(mngr_id)['name'])
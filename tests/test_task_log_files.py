@@ -94,6 +94,19 @@ class TaskLogTest(AbstractFlamencoTest):
         # self.assertEqual('gzip', resp.headers['Content-Encoding'])
         # self.assertEqual(f'filename="task-{tid}.log.gz"', resp.headers['Content-Disposition'])
 
+    def test_attach_task_log_changes_task(self):
+        with self.app.app_context():
+            tasks_coll = self.flamenco.db('tasks')
+            change_seq_before = tasks_coll.find_one(self.tid)['change_seq']
+
+        self.attach_log()
+
+        # The task should show up in incremental depsgraph queries.
+        with self.app.app_context():
+            task = tasks_coll.find_one(self.tid)
+            self.assertGreater(task['change_seq'], change_seq_before)
+            self.assertLessEqual(task['change_seq'], self.tmngr.committed_change_seq())
+
     def attach_log(self):
         log_contents = 'hello there\nsecond line²'
         gzipped = gzip.compress(log_contents.encode('utf8'))
@@ -0,0 +1,113 @@
+import datetime
+import gzip
+from unittest import mock
+
+import bson
+
+from pillar.api.utils import utcnow
+from test_job_archival import AbstractJobArchivalTest
+
+
+class TaskLogCompactionTest(AbstractJobArchivalTest):
+    TASK_COUNT = 4
+
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.job_id = self.create_job()
+        self.task_ids = [bson.ObjectId(t['_id']) for t in self.do_schedule_tasks()]
+        self.enter_app_context()
+
+    def _send_log(self, task_id: bson.ObjectId, received_on_manager: datetime.datetime, line):
+        self.post(f'/api/flamenco/managers/{self.mngr_id}/task-update-batch',
+                  json=[{'_id': str(bson.ObjectId()),
+                         'task_id': str(task_id),
+                         'activity': 'logging',
+                         'log': line,
+                         'received_on_manager': received_on_manager.isoformat()}],
+                  auth_token=self.mngr_token)
+
+    @mock.patch('flamenco.tasks.TaskManager.api_attach_log')
+    def test_compact_task_logs(self, mock_attach_log):
+        from flamenco.celery import task_log_retention
+
+        now = utcnow()
+        long_ago = now - datetime.timedelta(days=100)
+
+        # Task 0 is idle, task 1 logged recently, task 2 has a log file uploaded by the Manager.
+        self._send_log(self.task_ids[0], long_ago, 'line 1\n')
+        self._send_log(self.task_ids[0], long_ago + datetime.timedelta(seconds=1), 'line 2\n')
+        self._send_log(self.task_ids[1], long_ago, 'old line\n')
+        self._send_log(self.task_ids[1], now, 'new line\n')
+        self._send_log(self.task_ids[2], long_ago, 'uploaded line\n')
+
+        tasks_coll = self.flamenco.db('tasks')
+        logs_coll = self.flamenco.db('task_logs')
+        tasks_coll.update_one({'_id': self.task_ids[2]}, {'$set': {
+            'log_file': {'backend': 'local', 'file_path': 'flamenco-task-logs/task.log.gz'}}})
+
+        attached_logs = {}
+
+        def attach_log(task, file_obj):
+            attached_logs[task['_id']] = gzip.decompress(file_obj.read()).decode()
+            return False
+
+        mock_attach_log.side_effect = attach_log
+        task_log_retention.compact_task_logs()
+
+        self.assertEqual({self.task_ids[0]: 'line 1\nline 2\n'}, attached_logs)
+        self.assertEqual(0, logs_coll.count_documents({'task': self.task_ids[0]}))
+        self.assertEqual(2, logs_coll.count_documents({'task': self.task_ids[1]}))
+        self.assertEqual(0, logs_coll.count_documents({'task': self.task_ids[2]}))
+
+    @mock.patch('flamenco.tasks.TaskManager.api_attach_log')
+    def test_per_project_retention(self, mock_attach_log):
+        from flamenco.celery import task_log_retention
+
+        self._send_log(self.task_ids[0], utcnow() - datetime.timedelta(days=100), 'line 1\n')
+        self.app.config['FLAMENCO_TASK_LOG_RETENTION_PER_PROJECT'] = {str(self.proj_id): None}
+
+        task_log_retention.compact_task_logs()
+
+        mock_attach_log.assert_not_called()
+        logs_coll = self.flamenco.db('task_logs')
+        self.assertEqual(1, logs_coll.count_documents({'task': self.task_ids[0]}))
+
+    @mock.patch('flamenco.tasks.TaskManager.api_attach_log')
+    def test_late_log_entry_kept(self, mock_attach_log):
+        from flamenco.celery import task_log_retention
+
+        long_ago = utcnow() - datetime.timedelta(days=100)
+        self._send_log(self.task_ids[0], long_ago + datetime.timedelta(seconds=1), 'line 2\n')
+
+        def attach_log(task, file_obj):
+            # A log entry with an older timestamp arrives after the log file was written.
+            self._send_log(self.task_ids[0], long_ago, 'late line 1\n')
+            return False
+
+        mock_attach_log.side_effect = attach_log
+        task_log_retention.compact_task_logs()
+
+        logs_coll = self.flamenco.db('task_logs')
+        self.assertEqual(['late line 1\n'],
+                         [entry['log'] for entry in logs_coll.find({'task': self.task_ids[0]})])
+
+    def test_compacted_log_stored(self):
+        from flamenco.celery import task_log_retention
+
+        long_ago = utcnow() - datetime.timedelta(days=100)
+        self._send_log(self.task_ids[0], long_ago, 'line 1\n')
+        self._send_log(self.task_ids[0], long_ago + datetime.timedelta(seconds=1), 'line 2\n')
+
+        task_log_retention.compact_task_logs()
+
+        tasks_coll = self.flamenco.db('tasks')
+        task = tasks_coll.find_one({'_id': self.task_ids[0]})
+        file_path = f'flamenco-task-logs/job-{self.job_id}/task-{self.task_ids[0]}.log.gz'
+        self.assertEqual(file_path, task['log_file']['file_path'])
+        self.assertEqual(0, self.flamenco.db('task_logs').count_documents(
+            {'task': self.task_ids[0]}))
+
+        pid = str(self.proj_id)
+        resp = self.get(f'https://localhost.local/api/storage/file/{pid[:2]}/{pid}/fl/{file_path}')
+        self.assertEqual('line 1\nline 2\n', gzip.decompress(resp.data).decode())
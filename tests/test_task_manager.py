@@ -67,6 +67,61 @@ class TaskManagerTest(AbstractFlamencoTest):
 
         return job_doc['_id']
 
+    def test_task_batch(self):
+        from pillar.api.utils.authentication import force_cli_user
+        from flamenco.job_compilers import commands
+
+        job_id = self.test_create_task()
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job_doc = self.flamenco.db('jobs').find_one(job_id)
+
+            batch = self.tmngr.task_batch()
+            batch.chunk_size = 2
+            parent_id = batch.add_task(job_doc, [commands.Echo(message='ẑžƶźz')], 'parent',
+                                       status='under-construction', task_type='sleep')
+            child_ids = [
+                batch.add_task(job_doc, [commands.Sleep(time_in_seconds=3)], f'child-{idx}',
+                               parents=[parent_id], status='under-construction',
+                               task_type='sleep')
+                for idx in range(3)
+            ]
+
+            # The first chunk should have been inserted already.
+            tasks_coll = self.flamenco.db('tasks')
+            batch_query = {'_id': {'$in': [parent_id] + child_ids}}
+            self.assertEqual(2, tasks_coll.count_documents(batch_query))
+
+            batch.flush()
+            dbtasks = list(tasks_coll.find(batch_query))
+            self.assertEqual(4, len(dbtasks))
+            for dbtask in dbtasks:
+                self.assertIn('_etag', dbtask)
+                self.assertIn('_updated', dbtask)
+                self.assertIn('change_seq', dbtask)
+                if dbtask['_id'] != parent_id:
+                    self.assertEqual([parent_id], dbtask['parents'])
+
+            # The job's task status counters should include the new tasks.
+            job_doc = self.flamenco.db('jobs').find_one(job_id)
+            self.assertEqual(7, job_doc['tasks_status']['count'])
+            self.assertEqual(5, job_doc['tasks_status']['under-construction'])
+
+    def test_task_batch_invalid_task(self):
+        import werkzeug.exceptions as wz_exceptions
+        from flamenco.job_compilers import commands
+
+        job_id = self.test_create_task()
+
+        with self.app.test_request_context():
+            job_doc = self.flamenco.db('jobs').find_one(job_id)
+
+            batch = self.tmngr.task_batch()
+            with self.assertRaises(wz_exceptions.InternalServerError):
+                batch.add_task(job_doc, [commands.Echo(message='ẑžƶźz')], 'invalid',
+                               task_type='je-moeder')
+
     def test_api_find_jobfinal_tasks(self):
         from pillar.api.utils.authentication import force_cli_user
         from flamenco.job_compilers import commands
@@ -121,6 +176,60 @@ class TaskManagerTest(AbstractFlamencoTest):
             job_enders = self.tmngr.api_find_job_enders(job_id)
             self.assertEqual({taskid2, taskid3, taskid4}, set(job_enders))
 
+    def test_api_requeue_task_and_successors(self):
+        from pillar.api.utils.authentication import force_cli_user
+        from flamenco.job_compilers import commands
+
+        manager, _, _ = self.create_manager_service_account()
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job_doc = self.jmngr.api_create_job(
+                'test job',
+                'Wörk wørk w°rk.',
+                'sleep', {
+                    'frames': '12-18, 20-22',
+                    'chunk_size': 7,
+                    'time_in_seconds': 3,
+                },
+                self.proj_id,
+                ctd.EXAMPLE_PROJECT_OWNER_ID,
+                manager['_id'],
+            )
+            job_id = job_doc['_id']
+            tasks_coll = self.flamenco.db('tasks')
+            compiled_ids = [t['_id'] for t in tasks_coll.find({'job': job_id},
+                                                              projection={'_id': 1})]
+
+            taskid1 = self.tmngr.api_create_task(
+                job_doc, [commands.Echo(message='ẑžƶźz')], 'zzz 1', parents=compiled_ids[:1],
+                task_type='sleep',
+            )
+            taskid2 = self.tmngr.api_create_task(
+                job_doc, [commands.Echo(message='ẑžƶźz')], 'zzz 2', parents=[taskid1],
+                task_type='sleep',
+            )
+            taskid3 = self.tmngr.api_create_task(
+                job_doc, [commands.Echo(message='ẑžƶźz')], 'zzz 3', parents=[taskid1, taskid2],
+                task_type='sleep',
+            )
+            # Introduce a cycle; this should not cause infinite recursion.
+            tasks_coll.update_one({'_id': taskid1}, {'$push': {'parents': taskid3}})
+
+            self.flamenco.update_status_q('tasks', {'job': job_id}, 'completed')
+            self.assertEqual({taskid2, taskid3}, set(self.tmngr.successors(taskid1)))
+
+            self.tmngr.api_requeue_task_and_successors(taskid1)
+
+            statuses = {t['_id']: t['status'] for t in tasks_coll.find({'job': job_id})}
+            self.assertEqual({
+                compiled_ids[0]: 'completed',
+                compiled_ids[1]: 'completed',
+                taskid1: 'queued',
+                taskid2: 'queued',
+                taskid3: 'queued',
+            }, statuses)
+
     def test_api_set_task_status_for_job(self):
         import time
 
@@ -158,6 +267,27 @@ class TaskManagerTest(AbstractFlamencoTest):
             self.assertNotEqual(pre_flip_etags[1], post_flip_etags[1])
             self.assertEqual(pre_flip_etags[2], post_flip_etags[2])
 
+    def test_api_set_task_status_for_job_single_timestamp(self):
+        import datetime
+        from unittest import mock
+        from bson import tz_util
+        from flamenco.jobs import JobManager
+
+        job_id = self.test_create_task()
+        now = datetime.datetime(2019, 4, 1, 12, 34, 56, 789000, tzinfo=tz_util.utc)
+
+        with self.app.test_request_context():
+            with mock.patch.object(JobManager, 'update_job_after_task_status_change') as mock_upd:
+                self.tmngr.api_set_task_status_for_job(job_id, 'queued', 'active', now=now)
+
+            # The job should be re-evaluated once, not once per task.
+            mock_upd.assert_called_once_with(job_id, None, 'active')
+
+            tasks_coll = self.flamenco.db('tasks')
+            db_tasks = list(tasks_coll.find({'job': job_id, 'status': 'active'}))
+            self.assertEqual(2, len(db_tasks))
+            self.assertEqual(2 * [now], [task['_updated'] for task in db_tasks])
+
     def test_api_set_activity(self):
         job_id = self.test_create_task()
 
@@ -186,3 +316,38 @@ class TaskManagerTest(AbstractFlamencoTest):
             self.assertEqual('Activiteit geüpdated.', dbtasks[0]['activity'])
             self.assertEqual('', dbtasks[1]['activity'])
             self.assertEqual('Trés active', dbtasks[2]['activity'])
+
+    def test_update_tasks_status_changed_concurrently(self):
+        from unittest import mock
+        import pymongo.collection
+
+        job_id = self.test_create_task()
+
+        with self.app.test_request_context():
+            tasks_coll = self.tmngr.collection()
+            task_ids = [task['_id'] for task in tasks_coll.find({'job': job_id},
+                                                                 sort=[('_id', 1)])]
+            real_aggregate = pymongo.collection.Collection.aggregate
+
+            def aggregate_then_change_status(coll, pipeline, *args, **kwargs):
+                # Another request changes a task's status after the tasks were grouped.
+                result = list(real_aggregate(coll, pipeline, *args, **kwargs))
+                if mock_aggregate.call_count == 1:
+                    tasks_coll.update_one({'_id': task_ids[0]}, {'$set': {'status': 'active'}})
+                    self.jmngr.update_task_status_counts({job_id: {'queued': -1, 'active': 1}})
+                return iter(result)
+
+            with mock.patch.object(pymongo.collection.Collection, 'aggregate', autospec=True,
+                                   side_effect=aggregate_then_change_status) as mock_aggregate:
+                result = self.tmngr.update_tasks({'_id': {'$in': task_ids}},
+                                                 {'$set': {'status': 'canceled'}})
+
+            self.assertEqual(3, result.matched_count)
+            self.assertEqual(3 * ['canceled'],
+                             [task['status'] for task in tasks_coll.find({'job': job_id})])
+
+            counts = self.flamenco.db('jobs').find_one(job_id)['tasks_status']
+            self.assertEqual(3, counts['canceled'])
+            self.assertEqual(0, counts.get('active', 0))
+            self.assertEqual(0, counts.get('queued', 0))
+            self.assertEqual(0, counts.get('under-construction', 0))
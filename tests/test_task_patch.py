@@ -164,7 +164,7 @@ class TaskPatchingTest(AbstractFlamencoTest):
 
         with self.app.app_context():
             tasks_coll = self.app.db('flamenco_tasks')
-            tasks_coll.update_many({}, {'$set': {'status': 'completed'}})
+            self.flamenco.update_status_q('tasks', {}, 'completed')
             tasks = list(tasks_coll.find({'job': self.job_id}))
             one_task_id = tasks[-1]['_id']
 
@@ -299,7 +299,7 @@ class ComplexerJobTest(AbstractFlamencoTest):
     def test_requeue_task_and_successors(self):
         with self.app.app_context():
             tasks_coll = self.app.db('flamenco_tasks')
-            tasks_coll.update_many({}, {'$set': {'status': 'completed'}})
+            self.flamenco.update_status_q('tasks', {}, 'completed')
             self.force_job_status('completed')
 
             one_task = tasks_coll.find_one({'name': 'frame-chunk-200-250', 'job': self.job_id})
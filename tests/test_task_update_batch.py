@@ -1,3 +1,5 @@
+from unittest import mock
+
 from bson import ObjectId
 
 from pillar.tests import common_test_data as ctd
@@ -477,6 +479,94 @@ class TaskBatchUpdateTest(AbstractTaskBatchUpdateTest):
         self.assertEqual(db_task['activity'], 'testing more stuff')
         self.assertEqual(db_task['log'], 'this is log-tail line 3\nthis is log-tail line 4\n')
 
+    def test_multiple_updates_per_task_in_one_batch(self):
+        import dateutil.parser
+
+        tasks = self.do_schedule_tasks()
+        update_ids = [str(ObjectId()) for _ in range(4)]
+
+        resp = self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                         auth_token=self.mngr_token,
+                         json=[{
+                             '_id': update_ids[0],
+                             'task_id': tasks[0]['_id'],
+                             'task_status': 'active',
+                             'activity': 'starting',
+                             'received_on_manager': '2018-03-04T3:27:47+02:00',
+                             'log': 'first log\n',
+                         }, {
+                             '_id': update_ids[1],
+                             'task_id': tasks[1]['_id'],
+                             'task_status': 'active',
+                             'activity': 'other task',
+                             'received_on_manager': '2018-03-04T3:27:48+02:00',
+                         }, {
+                             '_id': update_ids[2],
+                             'task_id': tasks[0]['_id'],
+                             'task_status': 'completed',
+                             'activity': 'done',
+                             'received_on_manager': '2018-03-04T3:27:49+02:00',
+                             'log': 'second log\n',
+                         }, {
+                             '_id': update_ids[3],
+                             'task_id': str(ObjectId()),
+                             'task_status': 'completed',
+                         }])
+        self.assertEqual(update_ids, resp.json['handled_update_ids'])
+
+        # The last update of each task should win.
+        db_task = self.assert_task_status(tasks[0]['_id'], 'completed')
+        self.assertEqual('done', db_task['activity'])
+        self.assertEqual(dateutil.parser.parse('2018-03-04T3:27:49+02:00'), db_task['_updated'])
+        self.assertEqual('second log\n', db_task['log'])
+        db_task = self.assert_task_status(tasks[1]['_id'], 'active')
+        self.assertEqual('other task', db_task['activity'])
+
+        # Every log entry should have been stored.
+        with self.app.app_context():
+            logs_coll = self.flamenco.db('task_logs')
+            task_logs = list(logs_coll.find({'task': ObjectId(tasks[0]['_id'])}))
+        self.assertEqual({ObjectId(update_ids[0]), ObjectId(update_ids[2])},
+                         {task_log['_id'] for task_log in task_logs})
+        self.assertEqual({ObjectId(tasks[0]['job'])},
+                         {task_log['job'] for task_log in task_logs})
+        self.assert_job_status('active')
+
+
+    def test_task_status_changed_concurrently(self):
+        import collections
+        import pymongo.collection
+        from flamenco import current_flamenco
+
+        tasks = self.do_schedule_tasks()
+        task_ids = [ObjectId(task['_id']) for task in tasks]
+        real_bulk_write = pymongo.collection.Collection.bulk_write
+
+        def cancel_then_bulk_write(coll, requests, *args, **kwargs):
+            # A user cancels tasks after the batch fetched their status.
+            if coll.name == 'flamenco_tasks' and mock_bulk_write.call_count == 1:
+                current_flamenco.update_status_q('tasks', {'_id': {'$in': task_ids[:2]}},
+                                                 'cancel-requested')
+            return real_bulk_write(coll, requests, *args, **kwargs)
+
+        with mock.patch.object(pymongo.collection.Collection, 'bulk_write', autospec=True,
+                               side_effect=cancel_then_bulk_write) as mock_bulk_write:
+            self.do_batch_update(tasks, [0, 1, 2], ['active', 'completed', 'active'],
+                                 expect_cancel_task_ids={tasks[0]['_id']})
+
+        # 'active' is refused after cancel-requested, but 'completed' is accepted.
+        self.assert_task_status(task_ids[0], 'cancel-requested')
+        self.assert_task_status(task_ids[1], 'completed')
+        self.assert_task_status(task_ids[2], 'active')
+
+        with self.app.app_context():
+            tasks_coll = self.flamenco.db('tasks')
+            actual_counts = collections.Counter(
+                task['status'] for task in tasks_coll.find({'job': self.job_id}))
+            job = self.flamenco.db('jobs').find_one(self.job_id)
+        self.assertEqual(actual_counts,
+                         {status: count for status, count in job['tasks_status'].items()
+                          if count})
 
 class LargeTaskBatchUpdateTest(AbstractTaskBatchUpdateTest):
     """Similar tests to TaskBatchUpdateTest, but with a job consisting of many more tasks."""
@@ -555,3 +645,18 @@ class LargeTaskBatchUpdateTest(AbstractTaskBatchUpdateTest):
             tasks, [10, 11, 12, 13], 4 * ['canceled'],
             expect_cancel_task_ids={t['_id'] for t in tasks[14:]})
         self.assert_job_status('failed')
+
+    def test_job_status_evaluated_once_per_batch(self):
+        from flamenco.jobs import JobManager
+
+        self.force_job_status('queued')
+        tasks = self.do_schedule_tasks()
+
+        with mock.patch.object(JobManager, 'task_status_counts', autospec=True,
+                               side_effect=JobManager.task_status_counts) as mock_counts:
+            self.do_batch_update(
+                tasks, list(range(self.TASK_COUNT)), self.TASK_COUNT * ['completed'])
+
+        # All tasks completed in the same batch, which should count them only once.
+        self.assert_job_status('completed')
+        mock_counts.assert_called_once()